@@ -7,6 +7,8 @@ from six import add_metaclass
 
 logging.getLogger("").addHandler(logging.NullHandler())
 
+default_app_config = 'django_lti_tool_provider.apps.LTIToolProviderConfig'
+
 
 # pylint: disable=unused-argument
 # This class specifies method signatures; while pylint is intelligent enough to ignore unused args in abstractmethods
@@ -44,6 +46,16 @@ class AbstractApplicationHookManager(object):
         """
         return None
 
+    def roster_username(self, lti_data):
+        """
+        Gets username of the user a roster member (see roster module) is, before their first launch. lti_data holds
+        the member's user_id, lis_person_sourcedid, lis_person_contact_email_primary, lis_person_name_* and roles,
+        when known. Should agree with authentication_hook on the username it logs the member in as.
+
+        Defaults to lis_person_sourcedid (passed to authentication_hook as username), falling back to user_id.
+        """
+        return lti_data.get('lis_person_sourcedid') or lti_data['user_id']
+
     def optional_lti_parameters(self):
         """
         Return a dictionary of LTI parameters supported/required by this AuthenticationHookManager in addition
@@ -0,0 +1,322 @@
+"""
+LTI Advantage Assignment and Grade Services (AGS): publishing scores to LTI 1.3 platforms.
+
+Score posts are authorized with OAuth2 access tokens obtained by the client credentials grant, authenticated with
+a JWT signed by the tool's private key (LTI13_TOOL_PRIVATE_KEY, PEM, and LTI13_TOOL_KEY_ID settings) and posted to
+the platform's `auth_token_url` (see LTI13_PLATFORMS in platforms module). Tokens are cached per platform and scope
+and shared by all threads of the process, so a grade normally costs just the score post.
+
+LtiUserData.send_lti_grade publishes through AGS for LTI 1.3 launches that came with an AGS line item;
+publish_scores sends many scores at once, grouped by line item, over keep-alive connections.
+"""
+import json
+import logging
+import socket
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils import timezone
+from six.moves import http_client
+from six.moves.urllib.parse import urlencode, urlsplit
+from six.moves.urllib.request import Request, urlopen
+
+from django_lti_tool_provider.executor import get_executor
+from django_lti_tool_provider.platforms import get_platform
+
+
+_logger = logging.getLogger(__name__)
+
+SCORE_SCOPE = 'https://purl.imsglobal.org/spec/lti-ags/scope/score'
+SCORE_CONTENT_TYPE = 'application/vnd.ims.lis.v1.score+json'
+CLIENT_ASSERTION_TYPE = 'urn:ietf:params:oauth:client-assertion-type:jwt-bearer'
+
+
+class AgsError(Exception):
+    """ Platform refused to issue an access token or could not be reached """
+    def __init__(self, message):
+        super(AgsError, self).__init__(message)
+        self.message = message
+
+
+class ScoreResult(object):
+    """ Outcome of a score post, quacking like ims_lti_py OutcomeResponse where send_lti_grade callers need it """
+    def __init__(self, score, status, description):
+        self.score = score
+        self.status = status
+        self.description = description
+
+    def is_success(self):
+        return self.status is not None and 200 <= self.status < 300
+
+    def __repr__(self):
+        return u"ScoreResult({}, {})".format(self.status, self.description)
+
+
+class Score(object):
+    """ A score for a user on a line item of an LTI 1.3 platform """
+    def __init__(self, issuer, lineitem, user_id, score_given, score_maximum=1.0, comment=None, timestamp=None):
+        self.issuer = issuer
+        self.lineitem = lineitem
+        self.user_id = user_id
+        self.score_given = score_given
+        self.score_maximum = score_maximum
+        self.comment = comment
+        self.timestamp = timestamp or timezone.now()
+
+    @classmethod
+    def for_lti_user_data(cls, lti_user_data, grade):
+        """ Score for a [0..1] grade of a user's LTI 1.3 launch, see LtiUserData.uses_ags """
+        parameters = lti_user_data.edx_lti_parameters
+        return cls(parameters['iss'], parameters['ags_endpoint']['lineitem'], parameters['user_id'], grade)
+
+    @property
+    def scores_url(self):
+        # the scores endpoint is the line item URL with /scores appended to its path
+        path, _, query = self.lineitem.partition('?')
+        return path.rstrip('/') + '/scores' + ('?' + query if query else '')
+
+    def to_json(self):
+        document = {
+            'userId': self.user_id,
+            'scoreGiven': self.score_given,
+            'scoreMaximum': self.score_maximum,
+            'activityProgress': 'Completed',
+            'gradingProgress': 'FullyGraded',
+            'timestamp': self.timestamp.isoformat(),
+        }
+        if self.comment:
+            document['comment'] = self.comment
+        return json.dumps(document)
+
+
+class _Token(object):
+    def __init__(self, value, expires_at):
+        self.value = value
+        self.expires_at = expires_at
+
+
+class AccessTokenCache(object):
+    """
+    Access tokens by platform issuer and scopes. A token is reused until refresh_margin seconds before it expires;
+    within that margin it is still served while a new one is requested on the background thread pool, so threads
+    only wait for the platform when there is no token yet, or the cached one is about to expire (min_validity).
+    Concurrent requests for the same token wait for a single fetch.
+    """
+    def __init__(self, refresh_margin=60, min_validity=5, timeout=5, executor=None):
+        self.refresh_margin = refresh_margin
+        self.min_validity = min_validity
+        self.timeout = timeout
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._tokens = {}
+        self._fetch_locks = {}
+        self._refreshing = set()
+
+    def get_token(self, issuer, scopes=(SCORE_SCOPE,)):
+        key = (issuer, tuple(sorted(scopes)))
+        token = self._valid_token(key, self.min_validity)
+        if token is not None:
+            if token.expires_at - time.time() < self.refresh_margin:
+                self._schedule_refresh(key)
+            return token.value
+
+        with self._fetch_lock(key):
+            # a concurrent request might have fetched it while this one was waiting for the lock
+            token = self._valid_token(key, self.min_validity)
+            if token is None:
+                token = self._fetch(key)
+        return token.value
+
+    def invalidate(self, issuer, scopes, value):
+        """ Forgets token `value`, e.g. one the platform did not accept, unless it was replaced already """
+        key = (issuer, tuple(sorted(scopes)))
+        with self._lock:
+            token = self._tokens.get(key)
+            if token is not None and token.value == value:
+                del self._tokens[key]
+
+    def clear(self):
+        with self._lock:
+            self._tokens = {}
+
+    def _valid_token(self, key, min_validity):
+        with self._lock:
+            token = self._tokens.get(key)
+        if token is not None and token.expires_at - time.time() >= min_validity:
+            return token
+        return None
+
+    def _fetch_lock(self, key):
+        with self._lock:
+            return self._fetch_locks.setdefault(key, threading.Lock())
+
+    def _schedule_refresh(self, key):
+        with self._lock:
+            if key in self._refreshing:
+                return
+            self._refreshing.add(key)
+        executor = self._executor if self._executor is not None else get_executor()
+        executor.submit(self._refresh_in_background, key)
+
+    def _refresh_in_background(self, key):
+        try:
+            with self._fetch_lock(key):
+                if self._valid_token(key, self.refresh_margin) is None:
+                    self._fetch(key)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def _fetch(self, key):
+        issuer, scopes = key
+        value, expires_in = _request_access_token(get_platform(issuer), scopes, self.timeout)
+        token = _Token(value, time.time() + expires_in)
+        with self._lock:
+            self._tokens[key] = token
+        _logger.debug(u"Obtained AGS access token from %s, valid for %s seconds", issuer, expires_in)
+        return token
+
+
+def _client_assertion(platform):
+    # imported on first use, so that importing the models (which deliver grades through this module) does not load
+    # PyJWT and cryptography
+    import jwt
+    now = int(time.time())
+    claims = {
+        'iss': platform['client_id'],
+        'sub': platform['client_id'],
+        'aud': platform.get('auth_audience') or platform['auth_token_url'],
+        'iat': now,
+        'exp': now + 300,
+        'jti': uuid.uuid4().hex,
+    }
+    headers = {'kid': settings.LTI13_TOOL_KEY_ID}
+    assertion = jwt.encode(claims, settings.LTI13_TOOL_PRIVATE_KEY, algorithm='RS256', headers=headers)
+    return assertion.decode('ascii') if isinstance(assertion, bytes) else assertion
+
+
+def _request_access_token(platform, scopes, timeout):
+    """ Client credentials grant. Returns access token and its lifetime in seconds """
+    body = urlencode({
+        'grant_type': 'client_credentials',
+        'client_assertion_type': CLIENT_ASSERTION_TYPE,
+        'client_assertion': _client_assertion(platform),
+        'scope': ' '.join(scopes),
+    }).encode('ascii')
+    request = Request(platform['auth_token_url'], body, {'Content-Type': 'application/x-www-form-urlencoded'})
+    try:
+        response = urlopen(request, timeout=timeout)
+        try:
+            document = json.loads(response.read().decode('utf-8'))
+        finally:
+            response.close()
+        return document['access_token'], int(document.get('expires_in', 3600))
+    except (IOError, ValueError, KeyError) as e:
+        raise AgsError(u"Failed to obtain access token from {}: {!r}".format(platform['auth_token_url'], e))
+
+
+token_cache = AccessTokenCache(  # pylint: disable=invalid-name
+    refresh_margin=getattr(settings, 'LTI13_TOKEN_REFRESH_MARGIN', 60),
+    timeout=getattr(settings, 'LTI13_AGS_TIMEOUT', 5),
+)
+
+
+class _Connections(object):
+    """ Keep-alive HTTP connections by scheme and host, for posting a batch of scores """
+    def __init__(self, timeout):
+        self.timeout = timeout
+        self._connections = {}
+
+    def post(self, url, body, headers):
+        """ Returns response status and body """
+        parts = urlsplit(url)
+        path = parts.path + ('?' + parts.query if parts.query else '')
+        for attempt in (1, 2):
+            connection = self._connection(parts.scheme, parts.netloc)
+            try:
+                connection.request('POST', path, body, headers)
+                response = connection.getresponse()
+                return response.status, response.read()
+            except (http_client.HTTPException, socket.error):
+                # the platform might have closed an idle keep-alive connection - retry once on a fresh one
+                connection.close()
+                del self._connections[(parts.scheme, parts.netloc)]
+                if attempt == 2:
+                    raise
+
+    def _connection(self, scheme, netloc):
+        connection = self._connections.get((scheme, netloc))
+        if connection is None:
+            connection_class = http_client.HTTPSConnection if scheme == 'https' else http_client.HTTPConnection
+            connection = self._connections[(scheme, netloc)] = connection_class(netloc, timeout=self.timeout)
+        return connection
+
+    def close(self):
+        for connection in self._connections.values():
+            connection.close()
+        self._connections = {}
+
+
+def publish_score(score, tokens=None):
+    """ Posts a single score, returning ScoreResult """
+    return publish_scores([score], tokens)[0]
+
+
+def publish_scores(scores, tokens=None):
+    """
+    Posts scores, grouped by line item: each group needs one access token lookup, and all groups share keep-alive
+    connections (one per platform host). Within a group only the latest score of each user is posted - AGS keeps
+    the score with the latest timestamp anyway. Returns ScoreResult for each score, in order (results of superseded
+    scores are those of the posted ones). Errors obtaining a token or reaching the platform are reported as results
+    with None status.
+    """
+    tokens = tokens if tokens is not None else token_cache
+    batches = OrderedDict()
+    for score in scores:
+        batches.setdefault((score.issuer, score.lineitem), OrderedDict())[score.user_id] = score
+
+    results = {}
+    connections = _Connections(tokens.timeout)
+    try:
+        for (issuer, lineitem), batch in batches.items():
+            results[(issuer, lineitem)] = _publish_batch(issuer, list(batch.values()), tokens, connections)
+            _logger.debug(u"Published %d scores to %s", len(batch), lineitem)
+    finally:
+        connections.close()
+
+    return [results[(score.issuer, score.lineitem)][score.user_id] for score in scores]
+
+
+def _publish_batch(issuer, batch, tokens, connections):
+    results = {}
+    try:
+        token = tokens.get_token(issuer, (SCORE_SCOPE,))
+    except AgsError as e:
+        _logger.error(e.message)
+        return {score.user_id: ScoreResult(score, None, e.message) for score in batch}
+
+    for score in batch:
+        try:
+            status, body = _post_score(score, token, connections)
+            if status == 401:
+                # revoked or expired early - get a new token and retry once
+                tokens.invalidate(issuer, (SCORE_SCOPE,), token)
+                token = tokens.get_token(issuer, (SCORE_SCOPE,))
+                status, body = _post_score(score, token, connections)
+        except (AgsError, http_client.HTTPException, socket.error) as e:
+            _logger.exception(u"Failed to publish score to %s", score.lineitem)
+            results[score.user_id] = ScoreResult(score, None, repr(e))
+            continue
+        results[score.user_id] = ScoreResult(score, status, body.decode('utf-8', 'replace') if body else u'')
+    return results
+
+
+def _post_score(score, token, connections):
+    headers = {
+        'Authorization': 'Bearer ' + token,
+        'Content-Type': SCORE_CONTENT_TYPE,
+    }
+    return connections.post(score.scores_url, score.to_json(), headers)
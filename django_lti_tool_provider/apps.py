@@ -1,6 +1,21 @@
+import atexit
+
 from django.apps import AppConfig
+from django.core.signals import request_finished
+from django.db.models.signals import post_save
 
 
 class LTIToolProviderConfig(AppConfig):
     name = "django_lti_tool_provider"
-    verbose_name = "Django LTI Tool Provider"
\ No newline at end of file
+    verbose_name = "Django LTI Tool Provider"
+
+    def ready(self):
+        from django_lti_tool_provider.models import delivery_log_buffer
+        from django_lti_tool_provider.routers import pin_on_save
+
+        # connected per model: a receiver for any sender would also disable fast deletes project-wide
+        for model in self.get_models():
+            post_save.connect(pin_on_save, sender=model, dispatch_uid="django_lti_pin_on_save")
+
+        request_finished.connect(delivery_log_buffer.flush_receiver, dispatch_uid="django_lti_flush_delivery_log")
+        atexit.register(delivery_log_buffer.flush)
@@ -0,0 +1,213 @@
+"""
+Outcome delivery backends: how LtiUserData.send_lti_grade (and everything built on it - Signals.Grade.updated,
+submit_grade) gets a grade to the LMS. Selected with LTI_OUTCOME_BACKEND setting (dotted path to a backend class):
+
+* HttpBackend (default) - posts the grade right away: LTI 1.1 replaceResult, or AGS score for LTI 1.3 launches.
+* OutboxBackend - stores the grade in the PendingGrade table (in the caller's transaction, if any); the
+  deliver_lti_outbox command delivers them later, sending only the newest pending grade of each user and key.
+* InMemoryBackend - keeps grades in InMemoryBackend.outbox, for tests and load tests without an LMS.
+* NullBackend - drops grades.
+
+Backends implement send_grade(lti_user_data, grade), returning an outcome with is_success() and description.
+"""
+import logging
+import threading
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import router
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from django_lti_tool_provider.ags import Score, publish_score
+from django_lti_tool_provider.protocol import tool_provider
+
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_BACKEND = 'django_lti_tool_provider.backends.HttpBackend'
+
+
+class DeliveryOutcome(object):
+    """ Outcome of a grade that did not go to the LMS (yet). log_status overrides the delivery log status """
+    def __init__(self, success, description, log_status=None):
+        self.success = success
+        self.description = description
+        self.log_status = log_status
+
+    def is_success(self):
+        return self.success
+
+    def __repr__(self):
+        return u"DeliveryOutcome({}, {})".format(self.success, self.description)
+
+
+class BaseOutcomeBackend(object):
+    def send_grade(self, lti_user_data, grade):
+        """ Delivers grade ([0..1], already validated) for lti_user_data. Returns outcome """
+        raise NotImplementedError()
+
+
+class HttpBackend(BaseOutcomeBackend):
+    def send_grade(self, lti_user_data, grade):
+        if lti_user_data.uses_ags:
+            return publish_score(Score.for_lti_user_data(lti_user_data, grade))
+
+        provider = tool_provider(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, lti_user_data.edx_lti_parameters)
+        return provider.post_replace_result(grade)
+
+
+class OutboxBackend(BaseOutcomeBackend):
+    def send_grade(self, lti_user_data, grade, sequence=None):
+        """ Queues the grade, with its sequence number if it has one (see LtiUserData.send_lti_grade) """
+        from django_lti_tool_provider.models import OutcomeDeliveryLog, PendingGrade
+        PendingGrade.objects.using(router.db_for_write(PendingGrade)).create(
+            lti_user_data=lti_user_data, grade=grade, sequence=sequence
+        )
+        return DeliveryOutcome(True, u"queued", log_status=OutcomeDeliveryLog.QUEUED)
+
+
+class InMemoryBackend(BaseOutcomeBackend):
+    """ Records (lti_user_data, grade) in the class-level outbox list. Clear it with InMemoryBackend.clear() """
+    outbox = []
+    _lock = threading.Lock()
+
+    def send_grade(self, lti_user_data, grade):
+        with self._lock:
+            self.outbox.append((lti_user_data, grade))
+        return DeliveryOutcome(True, u"recorded")
+
+    @classmethod
+    def clear(cls):
+        with cls._lock:
+            del cls.outbox[:]
+
+
+class NullBackend(BaseOutcomeBackend):
+    def send_grade(self, lti_user_data, grade):
+        return DeliveryOutcome(True, u"discarded")
+
+
+_backends = {}
+
+
+def get_outcome_backend(path=None):
+    """ Returns backend instance for path (LTI_OUTCOME_BACKEND setting by default), one per process """
+    path = path or getattr(settings, 'LTI_OUTCOME_BACKEND', DEFAULT_BACKEND)
+    backend = _backends.get(path)
+    if backend is None:
+        backend = _backends.setdefault(path, import_string(path)())
+    return backend
+
+
+class OutboxStats(object):
+    def __init__(self):
+        self.delivered = 0
+        self.superseded = 0
+        self.failed = 0
+        self.dropped = 0
+        self.skipped = 0
+
+    def __repr__(self):
+        return (
+            u"delivered: {}, superseded: {}, failed (to be retried): {}, dropped after too many attempts: {}, "
+            u"skipped (claimed by another run or record gone): {}"
+        ).format(self.delivered, self.superseded, self.failed, self.dropped, self.skipped)
+
+
+def deliver_outbox(batch_size=100, backend=None, max_attempts=None, claim_seconds=None):
+    """
+    Delivers grades queued by OutboxBackend with backend (LTI_OUTBOX_DELIVERY_BACKEND setting, HttpBackend by
+    default), in the order they were queued. Only one pending grade of each LtiUserData is delivered - the one with
+    the highest sequence number, or the latest one queued without a sequence number - the others are superseded.
+    Sequenced grades are delivered in order (see LtiUserData.send_lti_grade). Failed grades stay queued for the next
+    run, until they fail max_attempts times (LTI_OUTBOX_MAX_ATTEMPTS, 5 by default). Each pending grade is tried at
+    most once per run. Returns OutboxStats.
+
+    A grade is claimed for claim_seconds (LTI_OUTBOX_CLAIM_SECONDS, 300 by default) before it is delivered, so
+    concurrent runs don't deliver it twice; the claim of a run that died expires. Everything is read from the
+    primary database - a replica might not have the grades or their LtiUserData yet.
+    """
+    from django_lti_tool_provider.models import LtiUserData, PendingGrade
+
+    backend = backend or get_outcome_backend(getattr(settings, 'LTI_OUTBOX_DELIVERY_BACKEND', DEFAULT_BACKEND))
+    if isinstance(backend, OutboxBackend):
+        raise ImproperlyConfigured(u"Outbox can't be delivered with OutboxBackend")
+    max_attempts = max_attempts or getattr(settings, 'LTI_OUTBOX_MAX_ATTEMPTS', 5)
+    claim_seconds = claim_seconds or getattr(settings, 'LTI_OUTBOX_CLAIM_SECONDS', 300)
+    pending_grades = PendingGrade.objects.using(router.db_for_write(PendingGrade))
+    stats = OutboxStats()
+    attempted = set()
+    last_pk = 0
+    while True:
+        batch = list(pending_grades.filter(pk__gt=last_pk).order_by('pk').values_list('pk', 'lti_user_data_id')[
+            :batch_size
+        ])
+        if not batch:
+            break
+        last_pk = batch[-1][0]
+
+        # all grades of each user in the batch, even those queued after the batch
+        queued = defaultdict(list)
+        lti_user_data_ids = set(lti_user_data_id for pk, lti_user_data_id in batch if pk not in attempted)
+        for pending_grade in pending_grades.filter(lti_user_data_id__in=lti_user_data_ids):
+            queued[pending_grade.lti_user_data_id].append(pending_grade)
+        lti_user_data = LtiUserData.objects.using(router.db_for_write(LtiUserData)).in_bulk(list(queued))
+
+        for lti_user_data_id, grades in queued.items():
+            pending_grade = max(grades, key=lambda grade: (grade.sequence or 0, grade.pk))
+            attempted.add(pending_grade.pk)
+            if lti_user_data_id not in lti_user_data or not _claim(pending_grades, pending_grade, claim_seconds):
+                stats.skipped += 1
+                continue
+            stats.superseded += pending_grades.filter(
+                pk__in=[grade.pk for grade in grades if grade.pk != pending_grade.pk]
+            ).exclude(claimed_until__gt=timezone.now()).delete()[0]
+            _deliver_pending_grade(
+                lti_user_data[lti_user_data_id], pending_grade, pending_grades, backend, max_attempts, stats
+            )
+
+        if len(batch) < batch_size:
+            break
+    return stats
+
+
+def _claim(pending_grades, pending_grade, claim_seconds):
+    """ Claims pending_grade unless another run holds an unexpired claim on it; returns whether it was claimed """
+    now = timezone.now()
+    claimed = pending_grades.filter(pk=pending_grade.pk).filter(
+        Q(claimed_until__isnull=True) | Q(claimed_until__lte=now)
+    ).update(claimed_until=now + timedelta(seconds=claim_seconds))
+    return claimed == 1
+
+
+def _deliver_pending_grade(lti_user_data, pending_grade, pending_grades, backend, max_attempts, stats):
+    try:
+        outcome = lti_user_data.send_lti_grade(pending_grade.grade, sequence=pending_grade.sequence, backend=backend)
+        error = None if outcome is None or outcome.is_success() else outcome.description
+    except Exception as exc:  # pylint: disable=broad-except
+        outcome, error = None, repr(exc)
+
+    rows = pending_grades.filter(pk=pending_grade.pk)
+    if error is None and outcome is None:
+        # a newer grade was delivered meanwhile
+        rows.delete()
+        stats.superseded += 1
+    elif error is None:
+        rows.delete()
+        stats.delivered += 1
+    elif pending_grade.attempts + 1 >= max_attempts:
+        _logger.error(
+            u"Dropping LTI grade %s for %s after %d failed attempts: %s",
+            pending_grade.grade, lti_user_data, pending_grade.attempts + 1, error
+        )
+        rows.delete()
+        stats.dropped += 1
+    else:
+        rows.update(
+            attempts=pending_grade.attempts + 1, last_error=u"{}".format(error or '')[:255], claimed_until=None
+        )
+        stats.failed += 1
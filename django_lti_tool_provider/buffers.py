@@ -0,0 +1,66 @@
+"""
+Buffered inserts for append-only tables, so that writing a log row does not cost a database round-trip per event.
+"""
+import logging
+import threading
+import time
+
+from django.db import router, transaction
+
+
+_logger = logging.getLogger(__name__)
+
+
+class BulkInsertBuffer(object):
+    """
+    Collects unsaved model instances and inserts them with bulk_create once batch_size instances are buffered or
+    flush_interval seconds passed since the last flush (checked when adding). Also flushed at the end of each request
+    and at process exit (see LTIToolProviderConfig.ready). Failures to insert are logged and the batch is dropped -
+    the buffer is meant for diagnostics and must never break the code path that produces the rows.
+
+    An add() inside a transaction defers the flush until it commits: rows buffered by other threads must not be
+    lost if the transaction rolls back, nor the transaction be made longer by the insert.
+    """
+    def __init__(self, model, batch_size=100, flush_interval=5.0):
+        self.model = model
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._pending = []
+        self._last_flush = time.time()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, instance):
+        with self._lock:
+            self._pending.append(instance)
+            due = len(self._pending) >= self.batch_size or time.time() - self._last_flush >= self.flush_interval
+        if not due:
+            return
+        database = router.db_for_write(self.model)
+        if transaction.get_connection(database).in_atomic_block:
+            # on rollback the callback is discarded, but the rows stay buffered for the next flush
+            transaction.on_commit(self.flush, using=database)
+        else:
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._last_flush = time.time()
+        if not pending:
+            return 0
+        database = router.db_for_write(self.model)
+        try:
+            # savepoint - a failed insert must not break a transaction the caller might be in
+            with transaction.atomic(using=database):
+                self.model.objects.using(database).bulk_create(pending)
+        except Exception:  # pylint: disable=broad-except
+            _logger.exception(u"Failed to store %d %s records", len(pending), self.model.__name__)
+            return 0
+        return len(pending)
+
+    def flush_receiver(self, sender, **kwargs):  # pylint: disable=unused-argument
+        """ Signal receiver flavour of flush(), e.g. for request_finished """
+        self.flush()
@@ -0,0 +1,106 @@
+"""
+Deduplication of double-submitted launches (an LMS re-posting the launch form, or a learner double-clicking it).
+
+Enabled with LTI_LAUNCH_DEDUPE setting. A launch claims its key - derived from the signed launch (OAuth nonce and
+signature, or LTI 1.3 id_token) and the LTI user - in the cache (LTI_LAUNCH_DEDUPE_CACHE alias, `default` by
+default; it must be shared by all processes serving launches). Copies of the launch arriving while it is in flight
+wait for it, up to LTI_LAUNCH_DEDUPE_WAIT seconds, and for LTI_LAUNCH_DEDUPE_TTL seconds after it completes reuse
+its outcome - the launched user is logged into their session and they are redirected to the same page - instead of
+running the authentication hook, storing LTI parameters and sending Signals.LTI.received again. A copy is verified
+(LTIView._verify_duplicate_launch) before the outcome is reused: its signature, and for LTI 1.3 - whose launches are
+bound to the browser session that started the login - that it comes from the original launch's session.
+
+Only authenticated launches are recorded: a copy of a launch that failed validation, raised, or went through the
+anonymous flow runs in full, as does any launch whose wait for the original timed out - without recording its
+outcome, as the key is still the original's.
+"""
+import hashlib
+import logging
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+
+
+_logger = logging.getLogger(__name__)
+
+IN_FLIGHT = 'in-flight'
+# returned by LaunchRegistry.claim when it gave up on claiming the key - the launch runs, but does not own the key
+NOT_CLAIMED = 'not-claimed'
+
+
+class LaunchOutcome(object):
+    """
+    Outcome of a completed launch: launched user, authentication backend they were logged in with, redirect, and
+    keys of the session the launch came in (before and after logging the user in)
+    """
+    def __init__(self, user_id, backend, location, session_keys=()):
+        self.user_id = user_id
+        self.backend = backend
+        self.location = location
+        self.session_keys = tuple(session_key for session_key in session_keys if session_key)
+
+
+class LaunchRegistry(object):
+    # claim attempts finding the key neither claimable nor set before the launch is processed without a claim
+    MAX_MISSES = 2
+
+    def __init__(self, cache_alias='default', ttl=30, wait=5.0, poll_interval=0.05):
+        self.cache_alias = cache_alias
+        self.ttl = ttl
+        self.wait = wait
+        self.poll_interval = poll_interval
+
+    @property
+    def enabled(self):
+        return getattr(settings, 'LTI_LAUNCH_DEDUPE', False)
+
+    @property
+    def cache(self):
+        return caches[self.cache_alias]
+
+    @staticmethod
+    def launch_key(*parts):
+        """ Cache key of a launch identified by parts (strings) """
+        digest = hashlib.sha1(u'\n'.join(part or u'' for part in parts).encode('utf-8')).hexdigest()
+        return 'lti_launch:' + digest
+
+    def claim(self, key):
+        """
+        Claims key for a launch about to run. Returns None if claimed - the caller must then complete() or release()
+        it - or LaunchOutcome of the same launch, completed meanwhile (waiting for it if it is in flight). If the wait
+        times out or the cache is not usable, returns NOT_CLAIMED: the launch runs without touching the key, which
+        another launch might still hold.
+        """
+        deadline = time.time() + self.wait
+        misses = 0
+        while True:
+            if self.cache.add(key, IN_FLIGHT, self.ttl):
+                return None
+            value = self.cache.get(key)
+            if isinstance(value, LaunchOutcome):
+                return value
+            if value is None:
+                # original launch failed and released the key in the meantime - retry the claim; a cache that keeps
+                # refusing add() without storing anything is not usable for deduplication, so stop retrying then
+                misses += 1
+                if misses >= self.MAX_MISSES:
+                    _logger.warning(u"Could not claim launch %s in the cache, processing it without deduplication", key)
+                    return NOT_CLAIMED
+            if time.time() >= deadline:
+                _logger.warning(u"Gave up waiting for in-flight launch %s, processing it again", key)
+                return NOT_CLAIMED
+            time.sleep(self.poll_interval)
+
+    def complete(self, key, outcome):
+        self.cache.set(key, outcome, self.ttl)
+
+    def release(self, key):
+        self.cache.delete(key)
+
+
+launch_registry = LaunchRegistry(  # pylint: disable=invalid-name
+    cache_alias=getattr(settings, 'LTI_LAUNCH_DEDUPE_CACHE', 'default'),
+    ttl=getattr(settings, 'LTI_LAUNCH_DEDUPE_TTL', 30),
+    wait=getattr(settings, 'LTI_LAUNCH_DEDUPE_WAIT', 5.0),
+)
@@ -0,0 +1,148 @@
+"""
+Compact in-process cache of outcome endpoints for grade workers.
+
+Sending a grade needs a handful of the stored launch parameters - the result sourcedid and outcome service URL (or,
+for LTI 1.3, the issuer, LTI user id and AGS line item) - yet loading LtiUserData brings the whole launch parameters
+JSON with it. With LTI_ENDPOINT_CACHE_SIZE set, grade delivery (see signals module) looks endpoints up here instead:
+one slim OutcomeEndpoint tuple per (user, custom key), least recently used ones evicted beyond the size limit.
+Strings shared by many learners - outcome service URLs, line items, issuers, course ids - are interned in a
+per-cache table, so a course's worth of endpoints holds a single copy of each.
+
+Entries are dropped when store_lti_parameters updates the record in this process, when a delivery through them
+fails, and LTI_ENDPOINT_CACHE_TTL seconds (300 by default) after they were loaded - which bounds how long a worker
+may use parameters replaced by a launch served by another process. A lookup racing with an invalidation of its
+entry returns what it loaded without caching it.
+"""
+from collections import OrderedDict, namedtuple
+import json
+import threading
+import time
+
+from django.conf import settings
+import six
+
+
+class OutcomeEndpoint(namedtuple('OutcomeEndpoint', (
+    'pk', 'user_id', 'custom_key', 'context_id', 'sourcedid', 'outcome_url', 'issuer', 'lti_user_id', 'lineitem'
+))):
+    """ Delivery fields of an LtiUserData record """
+    __slots__ = ()
+
+    def parameters(self):
+        """ The subset of launch parameters grade delivery reads """
+        parameters = {}
+        for name, value in (
+            ('context_id', self.context_id), ('lis_result_sourcedid', self.sourcedid),
+            ('lis_outcome_service_url', self.outcome_url), ('iss', self.issuer), ('user_id', self.lti_user_id),
+        ):
+            if value is not None:
+                parameters[name] = value
+        if self.lineitem is not None:
+            parameters['ags_endpoint'] = {'lineitem': self.lineitem}
+        return parameters
+
+    def to_lti_user_data(self):
+        """ Unsaved LtiUserData carrying only the delivery fields - enough for send_lti_grade """
+        from django_lti_tool_provider.models import LtiUserData
+        return LtiUserData(
+            pk=self.pk, user_id=self.user_id, custom_key=self.custom_key, edx_lti_parameters=self.parameters()
+        )
+
+
+class EndpointCache(object):
+    def __init__(self, max_size=0, ttl=300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._strings = {}
+        self._lock = threading.Lock()
+        # invalidation generation: bumped by every invalidate() and clear(); _invalidated maps keys to the generation
+        # they were last invalidated in, so that a load racing with an invalidation does not cache what it read.
+        # Forgetting older invalidations (to keep _invalidated bounded) counts as invalidating every key.
+        self._generation = 0
+        self._invalidated = {}
+        self._forgotten_generation = 0
+
+    @property
+    def enabled(self):
+        return self.max_size > 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id, custom_key):
+        """ Returns OutcomeEndpoint of user's LtiUserData for custom_key; raises LtiUserData.DoesNotExist """
+        key = (user_id, custom_key)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                # move to the most recently used end
+                del self._entries[key]
+                self._entries[key] = entry
+                return entry[1]
+            generation = self._generation
+
+        endpoint = self._load(user_id, custom_key)
+        with self._lock:
+            if self._invalidated.get(key, self._forgotten_generation) > generation:
+                # invalidated while loading - what was loaded might predate the change
+                return endpoint
+            self._entries.pop(key, None)
+            self._entries[key] = (now + self.ttl, endpoint)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return endpoint
+
+    def invalidate(self, user_id, custom_key):
+        with self._lock:
+            self._entries.pop((user_id, custom_key), None)
+            if len(self._invalidated) >= max(self.max_size, 1):
+                self._forget_invalidations()
+            self._generation += 1
+            self._invalidated[(user_id, custom_key)] = self._generation
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._strings.clear()
+            self._generation += 1
+            self._forget_invalidations()
+
+    def _forget_invalidations(self):
+        self._invalidated.clear()
+        self._forgotten_generation = self._generation
+
+    def _intern(self, value):
+        if value is None:
+            return None
+        with self._lock:
+            if len(self._strings) > self.max_size:
+                # strings of evicted endpoints are never dropped one by one - start over instead
+                self._strings.clear()
+            return self._strings.setdefault(value, value)
+
+    def _load(self, user_id, custom_key):
+        from django_lti_tool_provider.models import LtiUserData
+        pk, parameters = LtiUserData.objects.get_for_grade(user_id, custom_key, fields=('pk', 'edx_lti_parameters'))
+        if isinstance(parameters, six.string_types):
+            # depending on jsonfield version, values_list returns stored JSON undecoded
+            parameters = json.loads(parameters)
+        parameters = parameters or {}
+        return OutcomeEndpoint(
+            pk=pk,
+            user_id=user_id,
+            custom_key=custom_key,
+            context_id=self._intern(parameters.get('context_id')),
+            sourcedid=parameters.get('lis_result_sourcedid'),
+            outcome_url=self._intern(parameters.get('lis_outcome_service_url')),
+            issuer=self._intern(parameters.get('iss')),
+            lti_user_id=parameters.get('user_id'),
+            lineitem=self._intern((parameters.get('ags_endpoint') or {}).get('lineitem')),
+        )
+
+
+endpoint_cache = EndpointCache(  # pylint: disable=invalid-name
+    max_size=getattr(settings, 'LTI_ENDPOINT_CACHE_SIZE', 0),
+    ttl=getattr(settings, 'LTI_ENDPOINT_CACHE_TTL', 300),
+)
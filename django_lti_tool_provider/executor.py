@@ -0,0 +1,121 @@
+"""
+Minimal thread pool used to run work (signal receivers, grade delivery) off the request thread.
+"""
+import atexit
+import logging
+import sys
+import threading
+
+from django.conf import settings
+from django.db import close_old_connections
+import six
+from six.moves import queue
+
+
+_logger = logging.getLogger(__name__)
+
+
+class Task(object):
+    """ Handle for a callable submitted to BackgroundExecutor: can be waited on, polled or ignored """
+    def __init__(self, func, args, kwargs):
+        self._func = func
+        self._args = args
+        self._kwargs = kwargs
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+
+    def run(self):
+        try:
+            self._result = self._func(*self._args, **self._kwargs)
+        except Exception:  # pylint: disable=broad-except
+            self._exc_info = sys.exc_info()
+            _logger.exception(u"Background task %s failed", self._func)
+        finally:
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """ Blocks until the task completes or timeout (in seconds) expires. Returns True if task completed """
+        return self._done.wait(timeout)
+
+    def exception(self, timeout=None):
+        """ Returns the exception raised by the task, if any; raises RuntimeError if it is not done within timeout """
+        if not self.wait(timeout):
+            raise RuntimeError(u"Background task did not complete within {} seconds".format(timeout))
+        return self._exc_info[1] if self._exc_info else None
+
+    def result(self, timeout=None):
+        """ Returns the task result, re-raising the exception if the task failed """
+        if self.exception(timeout) is not None:
+            six.reraise(*self._exc_info)
+        return self._result
+
+
+class BackgroundExecutor(object):
+    """
+    Fixed-size pool of daemon threads consuming a FIFO queue of tasks. With more than one worker, tasks submitted
+    in order may complete out of order. If given, initializer is called in each worker thread before it takes tasks.
+    """
+    def __init__(self, workers=2, name='lti-background', initializer=None):
+        self._workers = workers
+        self._name = name
+        self._initializer = initializer
+        self._queue = queue.Queue()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def _start(self):
+        with self._lock:
+            if self._threads:
+                return
+            for index in range(self._workers):
+                thread = threading.Thread(target=self._work, name='{}-{}'.format(self._name, index))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def _work(self):
+        if self._initializer is not None:
+            self._initializer()
+        while True:
+            task = self._queue.get()
+            if task is None:
+                break
+            try:
+                task.run()
+            finally:
+                close_old_connections()
+
+    def submit(self, func, *args, **kwargs):
+        """ Schedules func(*args, **kwargs) to run on a worker thread and returns its Task handle """
+        self._start()
+        task = Task(func, args, kwargs)
+        self._queue.put(task)
+        return task
+
+    def shutdown(self, wait=True):
+        """ Lets already submitted tasks finish and stops worker threads """
+        with self._lock:
+            threads, self._threads = self._threads, []
+        for _ in threads:
+            self._queue.put(None)
+        if wait:
+            for thread in threads:
+                thread.join()
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """ Returns process-wide executor, sized by LTI_BACKGROUND_WORKERS setting (2 by default) """
+    global _executor  # pylint: disable=global-statement
+    with _executor_lock:
+        if _executor is None:
+            _executor = BackgroundExecutor(workers=getattr(settings, 'LTI_BACKGROUND_WORKERS', 2))
+            atexit.register(_executor.shutdown)
+    return _executor
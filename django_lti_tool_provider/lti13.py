@@ -0,0 +1,354 @@
+"""
+LTI 1.3 launches: OpenID Connect third-party initiated login and id_token (JWT) launch, verified against platform
+key sets (JWKS).
+
+Platforms are configured in LTI13_PLATFORMS setting, keyed by issuer - see platforms module.
+
+Verified launch claims are flattened into LTI 1.1 parameter names (user_id, resource_link_id, context_id, roles,
+custom_*, ...), so Lti13LaunchView drives the same AbstractApplicationHookManager hooks and LtiUserData storage as
+LTIView does. Requires PyJWT with cryptography (`pip install PyJWT[crypto]`).
+"""
+import json
+import logging
+import threading
+import time
+import uuid
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.http import HttpResponseBadRequest, HttpResponseRedirect
+from django.utils.decorators import method_decorator
+from django.views.decorators.clickjacking import xframe_options_exempt
+from django.views.decorators.csrf import csrf_exempt
+from django.views.generic import View
+from six.moves.urllib.parse import urlencode
+from six.moves.urllib.request import urlopen
+
+from django_lti_tool_provider.dedupe import launch_registry
+from django_lti_tool_provider.executor import get_executor
+from django_lti_tool_provider.platforms import Lti13LaunchError, get_platform
+from django_lti_tool_provider.views import LTIView
+
+try:
+    import jwt
+    from jwt.algorithms import RSAAlgorithm
+except ImportError:  # pragma: no cover
+    jwt = RSAAlgorithm = None
+
+
+_logger = logging.getLogger(__name__)
+
+LTI_CLAIM = 'https://purl.imsglobal.org/spec/lti/claim/'
+BASIC_OUTCOME_CLAIM = 'https://purl.imsglobal.org/spec/lti-bo/claim/basicoutcome'
+AGS_ENDPOINT_CLAIM = 'https://purl.imsglobal.org/spec/lti-ags/claim/endpoint'
+NRPS_CLAIM = 'https://purl.imsglobal.org/spec/lti-nrps/claim/namesroleservice'
+
+LTI_VERSION = '1.3.0'
+RESOURCE_LINK_MESSAGE_TYPE = 'LtiResourceLinkRequest'
+
+# allowed clock difference between the platform and the tool, seconds
+CLOCK_SKEW = 10
+
+# (claim, nested claim or None, LTI 1.1 parameter name)
+CLAIM_TO_PARAMETER = (
+    ('sub', None, 'user_id'),
+    ('email', None, 'lis_person_contact_email_primary'),
+    ('name', None, 'lis_person_name_full'),
+    ('given_name', None, 'lis_person_name_given'),
+    ('family_name', None, 'lis_person_name_family'),
+    (LTI_CLAIM + 'roles', None, 'roles'),
+    (LTI_CLAIM + 'deployment_id', None, 'deployment_id'),
+    (LTI_CLAIM + 'message_type', None, 'lti_message_type'),
+    (LTI_CLAIM + 'version', None, 'lti_version'),
+    (LTI_CLAIM + 'resource_link', 'id', 'resource_link_id'),
+    (LTI_CLAIM + 'resource_link', 'title', 'resource_link_title'),
+    (LTI_CLAIM + 'context', 'id', 'context_id'),
+    (LTI_CLAIM + 'context', 'label', 'context_label'),
+    (LTI_CLAIM + 'context', 'title', 'context_title'),
+    (LTI_CLAIM + 'lis', 'person_sourcedid', 'lis_person_sourcedid'),
+    (LTI_CLAIM + 'lis', 'course_section_sourcedid', 'lis_course_section_sourcedid'),
+    (LTI_CLAIM + 'launch_presentation', 'return_url', 'launch_presentation_return_url'),
+    (LTI_CLAIM + 'launch_presentation', 'locale', 'launch_presentation_locale'),
+    (BASIC_OUTCOME_CLAIM, 'lis_result_sourcedid', 'lis_result_sourcedid'),
+    (BASIC_OUTCOME_CLAIM, 'lis_outcome_service_url', 'lis_outcome_service_url'),
+    (AGS_ENDPOINT_CLAIM, None, 'ags_endpoint'),
+    (NRPS_CLAIM, None, 'names_role_service'),
+)
+
+
+def _fetch_key_set(jwks_url, timeout):
+    """ Fetches JWKS document and returns its RSA signing keys by key id """
+    response = urlopen(jwks_url, timeout=timeout)
+    try:
+        document = json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+    keys = {}
+    for jwk in document.get('keys', []):
+        if jwk.get('kty') != 'RSA' or jwk.get('use', 'sig') != 'sig' or not jwk.get('kid'):
+            continue
+        try:
+            keys[jwk['kid']] = RSAAlgorithm.from_jwk(json.dumps(jwk))
+        except Exception:  # pylint: disable=broad-except
+            _logger.warning(u"Skipping malformed key %s in %s", jwk['kid'], jwks_url)
+    return keys
+
+
+class _KeySet(object):
+    def __init__(self):
+        self.keys = {}
+        self.fetched_at = None
+        self.attempted_at = None
+        self.refreshing = False
+        self.fetch_lock = threading.Lock()
+
+
+class JwksCache(object):
+    """
+    Process-wide cache of platform signing keys, by JWKS URL and key id.
+
+    Launches signed with a cached key need no outbound request. Once a key set is older than max_age seconds it is
+    still served, and a refresh is scheduled on the background thread pool, so key rotation is picked up without
+    launches waiting for it. A launch signed with an unknown key id (a key the platform just rotated in) fetches the
+    key set synchronously - at most once per min_refresh_interval seconds per URL, so tokens with made up key ids
+    cannot flood the platform. A failed fetch keeps the keys cached so far.
+    """
+    def __init__(self, max_age=3600, min_refresh_interval=10, timeout=5, executor=None):
+        self.max_age = max_age
+        self.min_refresh_interval = min_refresh_interval
+        self.timeout = timeout
+        self._executor = executor
+        self._lock = threading.Lock()
+        self._key_sets = {}
+
+    def _key_set(self, jwks_url):
+        with self._lock:
+            return self._key_sets.setdefault(jwks_url, _KeySet())
+
+    def get_key(self, jwks_url, kid):
+        """ Returns public key for kid, raising Lti13LaunchError if the platform does not publish it """
+        key_set = self._key_set(jwks_url)
+        key = key_set.keys.get(kid)
+        if key is not None:
+            self._schedule_refresh_if_stale(jwks_url, key_set)
+            return key
+
+        with key_set.fetch_lock:
+            # a concurrent launch might have fetched it while this one was waiting for the lock
+            key = key_set.keys.get(kid)
+            if key is None and self._may_fetch(key_set):
+                self._refresh(jwks_url, key_set)
+                key = key_set.keys.get(kid)
+
+        if key is None:
+            raise Lti13LaunchError(u"Key {} is not published by {}".format(kid, jwks_url))
+        return key
+
+    def refresh(self, jwks_url):
+        """ Fetches key set from jwks_url now. Returns True on success """
+        key_set = self._key_set(jwks_url)
+        with key_set.fetch_lock:
+            return self._refresh(jwks_url, key_set)
+
+    def clear(self):
+        with self._lock:
+            self._key_sets = {}
+
+    def _may_fetch(self, key_set):
+        return key_set.attempted_at is None or time.time() - key_set.attempted_at >= self.min_refresh_interval
+
+    def _schedule_refresh_if_stale(self, jwks_url, key_set):
+        with self._lock:
+            if key_set.refreshing or time.time() - key_set.fetched_at < self.max_age:
+                return
+            key_set.refreshing = True
+        executor = self._executor if self._executor is not None else get_executor()
+        executor.submit(self._refresh_in_background, jwks_url, key_set)
+
+    def _refresh_in_background(self, jwks_url, key_set):
+        try:
+            with key_set.fetch_lock:
+                self._refresh(jwks_url, key_set)
+        finally:
+            key_set.refreshing = False
+
+    def _refresh(self, jwks_url, key_set):
+        key_set.attempted_at = time.time()
+        try:
+            keys = _fetch_key_set(jwks_url, self.timeout)
+        except Exception:  # pylint: disable=broad-except
+            _logger.exception(u"Failed to fetch LTI 1.3 platform keys from %s", jwks_url)
+            return False
+        # replaced rather than updated - keys the platform stopped publishing are no longer accepted
+        key_set.keys = keys
+        key_set.fetched_at = time.time()
+        _logger.debug(u"Fetched %d LTI 1.3 platform keys from %s", len(keys), jwks_url)
+        return True
+
+
+jwks_cache = JwksCache(  # pylint: disable=invalid-name
+    max_age=getattr(settings, 'LTI13_JWKS_MAX_AGE', 3600),
+    min_refresh_interval=getattr(settings, 'LTI13_JWKS_MIN_REFRESH_INTERVAL', 10),
+    timeout=getattr(settings, 'LTI13_JWKS_TIMEOUT', 5),
+)
+
+
+def decode_launch_token(id_token, key_cache=None):
+    """
+    Verifies id_token signature, issuer, audience, expiry and LTI version and returns its claims. Raises
+    Lti13LaunchError if the token is not a valid LTI 1.3 resource link launch from a configured platform.
+    """
+    key_cache = key_cache if key_cache is not None else jwks_cache
+    try:
+        kid = jwt.get_unverified_header(id_token).get('kid')
+        unverified = jwt.decode(id_token, options={'verify_signature': False, 'verify_aud': False, 'verify_exp': False})
+        issuer = unverified.get('iss')
+        platform = get_platform(issuer)
+        key = key_cache.get_key(platform['jwks_url'], kid)
+        claims = jwt.decode(
+            id_token, key, algorithms=['RS256'], audience=platform['client_id'], issuer=issuer, leeway=CLOCK_SKEW
+        )
+    except jwt.InvalidTokenError as e:
+        raise Lti13LaunchError(u"Invalid id_token: {}".format(e))
+
+    audience = claims['aud']
+    if isinstance(audience, list) and len(audience) > 1 and claims.get('azp') != platform['client_id']:
+        raise Lti13LaunchError(u"Invalid id_token: authorized party does not match client id")
+    if claims.get(LTI_CLAIM + 'version') != LTI_VERSION:
+        raise Lti13LaunchError(u"Unsupported LTI version {}".format(claims.get(LTI_CLAIM + 'version')))
+    if claims.get(LTI_CLAIM + 'message_type') != RESOURCE_LINK_MESSAGE_TYPE:
+        raise Lti13LaunchError(u"Unsupported LTI message type {}".format(claims.get(LTI_CLAIM + 'message_type')))
+    deployment_ids = platform.get('deployment_ids')
+    if deployment_ids is not None and claims.get(LTI_CLAIM + 'deployment_id') not in deployment_ids:
+        raise Lti13LaunchError(u"Unknown deployment {}".format(claims.get(LTI_CLAIM + 'deployment_id')))
+    if not claims.get('sub'):
+        raise Lti13LaunchError(u"Anonymous LTI 1.3 launches are not supported")
+    return claims
+
+
+def claims_to_parameters(claims):
+    """ Flattens launch claims into LTI 1.1 parameter names """
+    parameters = {'iss': claims['iss'], 'client_id': claims.get('azp') or claims['aud']}
+    if isinstance(parameters['client_id'], list):
+        parameters['client_id'] = parameters['client_id'][0]
+    for claim, nested_claim, name in CLAIM_TO_PARAMETER:
+        value = claims.get(claim)
+        if nested_claim is not None:
+            value = (value or {}).get(nested_claim)
+        if value is not None:
+            parameters[name] = value
+    for name, value in (claims.get(LTI_CLAIM + 'custom') or {}).items():
+        parameters['custom_' + name] = value
+    return parameters
+
+
+class Lti13LoginView(View):
+    """
+    OpenID Connect third-party initiated login: the first leg of an LTI 1.3 launch. Redirects to the platform's
+    authorization endpoint, which then posts the id_token to Lti13LaunchView (target_link_uri).
+    """
+    SESSION_KEY = 'lti13_login_states'
+    # states of logins started in other tabs remain valid, up to this many
+    MAX_PENDING_LOGINS = 10
+
+    @method_decorator(csrf_exempt)
+    @method_decorator(xframe_options_exempt)
+    def dispatch(self, *args, **kwargs):
+        return super(Lti13LoginView, self).dispatch(*args, **kwargs)
+
+    def get(self, request, *args, **kwargs):
+        return self.process_login(request, request.GET)
+
+    def post(self, request, *args, **kwargs):
+        return self.process_login(request, request.POST)
+
+    def process_login(self, request, parameters):
+        try:
+            platform = get_platform(parameters.get('iss'))
+            if parameters.get('client_id', platform['client_id']) != platform['client_id']:
+                raise Lti13LaunchError(u"Unknown client id {}".format(parameters['client_id']))
+            if not parameters.get('login_hint') or not parameters.get('target_link_uri'):
+                raise Lti13LaunchError(u"login_hint and target_link_uri are required")
+        except Lti13LaunchError as e:
+            _logger.warning(u"Invalid LTI 1.3 login: %s", e.message)
+            return HttpResponseBadRequest(u"Invalid LTI Request: " + e.message)
+
+        state, nonce = uuid.uuid4().hex, uuid.uuid4().hex
+        pending = request.session.get(self.SESSION_KEY, [])
+        request.session[self.SESSION_KEY] = (pending + [[state, nonce]])[-self.MAX_PENDING_LOGINS:]
+
+        authentication_request = {
+            'scope': 'openid',
+            'response_type': 'id_token',
+            'response_mode': 'form_post',
+            'prompt': 'none',
+            'client_id': platform['client_id'],
+            'redirect_uri': parameters['target_link_uri'],
+            'login_hint': parameters['login_hint'],
+            'state': state,
+            'nonce': nonce,
+        }
+        if parameters.get('lti_message_hint'):
+            authentication_request['lti_message_hint'] = parameters['lti_message_hint']
+
+        auth_login_url = platform['auth_login_url']
+        separator = '&' if '?' in auth_login_url else '?'
+        return HttpResponseRedirect(auth_login_url + separator + urlencode(authentication_request))
+
+    @classmethod
+    def pop_nonce(cls, request, state):
+        """ Returns nonce issued with state, forgetting it, or None if this session did not start such a login """
+        pending = request.session.get(cls.SESSION_KEY, [])
+        for index, (pending_state, nonce) in enumerate(pending):
+            if pending_state == state:
+                request.session[cls.SESSION_KEY] = pending[:index] + pending[index + 1:]
+                return nonce
+        return None
+
+
+class Lti13LaunchView(LTIView):
+    """
+    LTI 1.3 resource link launch: verifies the id_token posted by the platform and then works the same way as
+    LTIView - authentication hook, LtiUserData storage, Signals.LTI.received and redirects.
+    """
+    INVALID_REQUEST_ERRORS = (Lti13LaunchError,)
+
+    @method_decorator(csrf_exempt)
+    @method_decorator(xframe_options_exempt)
+    def dispatch(self, *args, **kwargs):
+        if jwt is None:
+            raise ImproperlyConfigured(u"LTI 1.3 launches require PyJWT with cryptography installed")
+        return super(Lti13LaunchView, self).dispatch(*args, **kwargs)
+
+    @classmethod
+    def _get_lti_parameters_from_request(cls, request):
+        id_token = request.POST.get('id_token')
+        if not id_token:
+            raise Lti13LaunchError(u"id_token is missing")
+        claims = decode_launch_token(id_token)
+
+        # checked after the signature, so that forged tokens do not consume pending logins
+        nonce = Lti13LoginView.pop_nonce(request, request.POST.get('state'))
+        if nonce is None or claims.get('nonce') != nonce:
+            raise Lti13LaunchError(u"Launch does not match a login started in this session")
+        return claims_to_parameters(claims)
+
+    @classmethod
+    def _launch_key(cls, request):
+        # the id_token is signed and carries user's sub; its nonce is spent by the first copy of the launch
+        id_token = request.POST.get('id_token')
+        return launch_registry.launch_key(id_token, request.POST.get('state')) if id_token else None
+
+    @classmethod
+    def _verify_duplicate_launch(cls, request, outcome):
+        # the original launch spent the login's nonce, so instead of the login check the copy must come from the
+        # session the original did (its key from before or after the user was logged in) - a copy of the id_token
+        # posted from any other session must not log into the launched user's account
+        decode_launch_token(request.POST.get('id_token'))
+        if request.COOKIES.get(settings.SESSION_COOKIE_NAME) not in getattr(outcome, 'session_keys', ()):
+            raise Lti13LaunchError(u"Launch does not match a login started in this session")
+
+    @classmethod
+    def _is_new_lti_request(cls, request):
+        return 'id_token' in request.POST
@@ -0,0 +1,25 @@
+"""
+Delivers grades queued by OutboxBackend (see backends module) to the LMS.
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lti_tool_provider.backends import deliver_outbox
+
+
+class Command(BaseCommand):
+    help = "Delivers queued LTI grades, the latest one per user and key; failed grades stay queued for the next run"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100, help="Number of queued grades read at a time")
+        parser.add_argument(
+            '--max-attempts', type=int, default=None,
+            help="Drop grades that failed this many times (default: LTI_OUTBOX_MAX_ATTEMPTS setting or 5)"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            stats = deliver_outbox(batch_size=options['batch_size'], max_attempts=options['max_attempts'])
+        except ImproperlyConfigured as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(u"{}".format(stats))
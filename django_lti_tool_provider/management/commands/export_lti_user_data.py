@@ -0,0 +1,29 @@
+"""
+Streams LtiUserData records to newline-delimited JSON, see django_lti_tool_provider.transfer for the format.
+"""
+from django.core.management.base import BaseCommand
+
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.transfer import export_lti_user_data
+
+
+class Command(BaseCommand):
+    help = "Exports LtiUserData records as newline-delimited JSON, referencing users by username"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', '-o', default=None, help="Output file (default: standard output)")
+        parser.add_argument('--custom-key-prefix', default=None, help="Only export records with this custom key prefix")
+        parser.add_argument('--chunk-size', type=int, default=1000, help="Rows fetched per query")
+
+    def handle(self, *args, **options):
+        queryset = LtiUserData.objects.all()
+        if options['custom_key_prefix'] is not None:
+            queryset = queryset.filter(custom_key__startswith=options['custom_key_prefix'])
+
+        if options['output']:
+            with open(options['output'], 'w') as stream:
+                count = export_lti_user_data(stream, queryset, chunk_size=options['chunk_size'])
+        else:
+            count = export_lti_user_data(self.stdout, queryset, chunk_size=options['chunk_size'])
+
+        self.stderr.write(u"Exported {} LtiUserData records".format(count))
@@ -0,0 +1,36 @@
+"""
+Loads LtiUserData records from newline-delimited JSON, see django_lti_tool_provider.transfer for the format.
+"""
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lti_tool_provider.transfer import import_lti_user_data
+
+
+class Command(BaseCommand):
+    help = "Imports LtiUserData records from newline-delimited JSON, resolving users by username"
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help="Input file, or - for standard input")
+        parser.add_argument('--batch-size', type=int, default=1000, help="Records inserted per bulk insert")
+        parser.add_argument(
+            '--update', action='store_true', default=False,
+            help="Overwrite LTI parameters of records that already exist (default: skip them)"
+        )
+
+    def handle(self, *args, **options):
+        try:
+            if options['input'] == '-':
+                stats = self._import(sys.stdin, options)
+            else:
+                with open(options['input']) as stream:
+                    stats = self._import(stream, options)
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        self.stdout.write(u"Imported LtiUserData records - {}".format(stats))
+
+    @staticmethod
+    def _import(stream, options):
+        return import_lti_user_data(stream, batch_size=options['batch_size'], update_existing=options['update'])
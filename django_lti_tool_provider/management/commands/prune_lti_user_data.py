@@ -0,0 +1,37 @@
+"""
+Deletes (optionally archiving) LtiUserData records that have not been updated for the retention period.
+"""
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lti_tool_provider.retention import prune_lti_user_data, retention_cutoff
+
+
+class Command(BaseCommand):
+    help = "Deletes LtiUserData records not updated for a number of days, in small throttled batches"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help="Retention period in days (default: LTI_USER_DATA_RETENTION_DAYS setting)"
+        )
+        parser.add_argument('--batch-size', type=int, default=500, help="Records deleted per statement")
+        parser.add_argument('--sleep', type=float, default=0.1, help="Pause between batches, in seconds")
+        parser.add_argument('--archive', default=None, help="Append deleted records to this NDJSON file")
+        parser.add_argument('--dry-run', action='store_true', default=False, help="Only count stale records")
+
+    def handle(self, *args, **options):
+        try:
+            cutoff = retention_cutoff(options['days'])
+        except ValueError as exc:
+            raise CommandError(str(exc))
+
+        kwargs = dict(batch_size=options['batch_size'], sleep=options['sleep'], dry_run=options['dry_run'])
+        if options['archive'] and not options['dry_run']:
+            with open(options['archive'], 'a') as archive_stream:
+                count = prune_lti_user_data(cutoff, archive_stream=archive_stream, **kwargs)
+        else:
+            count = prune_lti_user_data(cutoff, **kwargs)
+
+        self.stdout.write(u"{} {} LtiUserData records last updated before {}".format(
+            "Found" if options['dry_run'] else "Deleted", count, cutoff.isoformat()
+        ))
@@ -0,0 +1,51 @@
+"""
+Recomputes grades of a course (or custom key prefix) with an app-supplied grade function and resends them, see
+django_lti_tool_provider.resend.
+"""
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lti_tool_provider.resend import resend_grades
+
+
+class Command(BaseCommand):
+    help = "Recomputes and resends LTI grades of all learners of a course, resumably"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--context-id', default=None, help="Resend grades of this course (LTI context_id)")
+        parser.add_argument(
+            '--custom-key-prefix', default=None, help="Resend grades of records with this custom key prefix"
+        )
+        parser.add_argument(
+            '--grade-function', default=None,
+            help="Dotted path of the grade function (default: LTI_RESEND_GRADE_FUNCTION setting)"
+        )
+        parser.add_argument('--batch-size', type=int, default=100, help="Records passed to the grade function at once")
+        parser.add_argument('--workers', type=int, default=4, help="Grades delivered concurrently")
+        parser.add_argument('--rate', type=float, default=None, help="Maximum grades delivered per second")
+        parser.add_argument(
+            '--checkpoint', default=None,
+            help="Progress file: an interrupted resend resumes from it, it is removed once the resend is done"
+        )
+
+    def handle(self, *args, **options):
+        if options['context_id'] is None and options['custom_key_prefix'] is None:
+            raise CommandError(u"--context-id or --custom-key-prefix is required")
+        grade_function = options['grade_function'] or getattr(settings, 'LTI_RESEND_GRADE_FUNCTION', None)
+        if not grade_function:
+            raise CommandError(u"--grade-function or LTI_RESEND_GRADE_FUNCTION setting is required")
+
+        try:
+            stats = resend_grades(
+                grade_function,
+                context_id=options['context_id'],
+                custom_key_prefix=options['custom_key_prefix'],
+                batch_size=options['batch_size'],
+                workers=options['workers'],
+                rate=options['rate'],
+                checkpoint_path=options['checkpoint'],
+                progress=lambda stats: self.stderr.write(u"{} (last LtiUserData {})".format(stats, stats.last_pk)),
+            )
+        except (ImportError, ValueError) as exc:
+            raise CommandError(str(exc))
+        self.stdout.write(u"{}".format(stats))
@@ -0,0 +1,51 @@
+"""
+Pre-provisions users and LtiUserData from LTI 1.3 course rosters (Names and Role Provisioning Services).
+"""
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management.base import BaseCommand, CommandError
+
+from django_lti_tool_provider.roster import iter_roster_sources, sync_roster
+
+
+class Command(BaseCommand):
+    help = "Syncs course rosters of LTI 1.3 platforms, creating users and LtiUserData ahead of their first launch"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url', default=None,
+            help="Memberships URL to sync (default: all memberships URLs found in stored launch parameters)"
+        )
+        parser.add_argument('--issuer', default=None, help="Platform issuer of --url")
+        parser.add_argument(
+            '--custom-key', default=None,
+            help="Custom key of the LtiUserData placeholders - the key launches of the resource they are meant for get "
+                 "(default: asks the hook manager's vary_by_key, without resource link parameters)"
+        )
+        parser.add_argument(
+            '--force', action='store_true', default=False, help="Fetch rosters even if they did not change"
+        )
+
+    def handle(self, *args, **options):
+        if options['url']:
+            if not options['issuer']:
+                raise CommandError(u"--issuer is required with --url")
+            sources = [(options['issuer'], options['url'], None)]
+        else:
+            sources = iter_roster_sources()
+
+        failed = 0
+        for issuer, memberships_url, context_id in sources:
+            try:
+                stats = sync_roster(
+                    issuer, memberships_url, context_id, force=options['force'], custom_key=options['custom_key']
+                )
+            except ImproperlyConfigured as exc:
+                raise CommandError(str(exc))
+            except Exception as exc:  # pylint: disable=broad-except
+                failed += 1
+                self.stderr.write(u"Failed to sync roster {}: {}".format(memberships_url, exc))
+                continue
+            self.stdout.write(u"{}: {}".format(memberships_url, stats))
+
+        if failed:
+            raise CommandError(u"Failed to sync {} rosters".format(failed))
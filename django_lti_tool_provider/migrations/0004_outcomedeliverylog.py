@@ -0,0 +1,45 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('django_lti_tool_provider', '0003_ltiuserdata_updated'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutcomeDeliveryLog',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('custom_key', models.CharField(default=b'', max_length=190)),
+                ('context_id', models.CharField(default=b'', max_length=255)),
+                ('outcome_service_host', models.CharField(default=b'', max_length=255)),
+                ('grade', models.FloatField()),
+                ('status', models.CharField(choices=[(b'success', b'Success'), (b'failure', b'Rejected by LMS'), (b'error', b'Delivery error')], max_length=16)),
+                ('latency_ms', models.PositiveIntegerField()),
+                ('description', models.CharField(default=b'', max_length=255)),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='outcomedeliverylog',
+            index=models.Index(fields=[b'context_id', b'created'], name=b'lti_delivery_context_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outcomedeliverylog',
+            index=models.Index(fields=[b'outcome_service_host', b'created'], name=b'lti_delivery_host_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='outcomedeliverylog',
+            index=models.Index(fields=[b'created'], name=b'lti_delivery_created_idx'),
+        ),
+    ]
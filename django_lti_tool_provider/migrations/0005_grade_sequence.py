@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_lti_tool_provider', '0004_outcomedeliverylog'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ltiuserdata',
+            name='delivered_grade_sequence',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='ltiuserdata',
+            name='grade_sequence',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AlterField(
+            model_name='outcomedeliverylog',
+            name='status',
+            field=models.CharField(choices=[(b'success', b'Success'), (b'failure', b'Rejected by LMS'), (b'error', b'Delivery error'), (b'stale', b'Dropped as superseded by a newer grade')], max_length=16),
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_lti_tool_provider', '0005_grade_sequence'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='PendingGrade',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('grade', models.FloatField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.CharField(default=b'', max_length=255)),
+                ('lti_user_data', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='django_lti_tool_provider.LtiUserData')),
+            ],
+        ),
+        migrations.AlterField(
+            model_name='outcomedeliverylog',
+            name='status',
+            field=models.CharField(choices=[(b'success', b'Success'), (b'failure', b'Rejected by LMS'), (b'error', b'Delivery error'), (b'stale', b'Dropped as superseded by a newer grade'), (b'queued', b'Queued in the outbox')], max_length=16),
+        ),
+    ]
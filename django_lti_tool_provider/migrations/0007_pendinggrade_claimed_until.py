@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_lti_tool_provider', '0006_pendinggrade'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='pendinggrade',
+            name='claimed_until',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_lti_tool_provider', '0007_pendinggrade_claimed_until'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='ltiuserdata',
+            name='delivery_lease_until',
+            field=models.DateTimeField(default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='pendinggrade',
+            name='sequence',
+            field=models.BigIntegerField(default=None, null=True),
+        ),
+    ]
@@ -1,12 +1,24 @@
 import logging
+import time
+from datetime import timedelta
 
-from django.db import models
+from django.db import models, router, transaction
+from django.db.models import (
+    Avg, Case, Count, ExpressionWrapper, F, FloatField, IntegerField, Max, Q, Sum, Value, When
+)
+from django.db.models.functions import Greatest
 from django.contrib.auth.models import User
+from django.utils import timezone
 from jsonfield import JSONField
+from six.moves.urllib.parse import urlparse
 
-from ims_lti_py.tool_provider import DjangoToolProvider
 from django.conf import settings
 
+from django_lti_tool_provider.backends import DeliveryOutcome, OutboxBackend, get_outcome_backend
+from django_lti_tool_provider.buffers import BulkInsertBuffer
+from django_lti_tool_provider.endpoints import endpoint_cache
+from django_lti_tool_provider.routers import is_record_pinned, pin_record_to_primary, read_database_alias
+
 
 _logger = logging.getLogger(__name__)
 
@@ -15,6 +27,31 @@ class WrongUserError(Exception):
     pass
 
 
+class LtiUserDataManager(models.Manager):
+    def for_read(self):
+        """ Queryset for pure reads - served by LTI_READ_DATABASE, if configured, see routers module """
+        return self.get_queryset().using(read_database_alias())
+
+    def get_for_grade(self, user_id, custom_key, fields=None):
+        """
+        Gets user's record for custom_key (with fields - values_list of them) to send a grade with. Reads it like
+        for_read, except from the primary database shortly after the record was stored (see routers module) or if
+        the read database doesn't have it yet.
+        """
+        queryset = self.get_queryset().filter(user_id=user_id, custom_key=custom_key)
+        if fields:
+            queryset = queryset.values_list(*fields)
+        primary = router.db_for_write(self.model)
+        queryset = queryset.using(primary if is_record_pinned(user_id, custom_key) else read_database_alias())
+        try:
+            return queryset.get()
+        except self.model.DoesNotExist:
+            if queryset.db == primary:
+                raise
+            # the read replica lags behind
+            return queryset.using(primary).get()
+
+
 class LtiUserData(models.Model):
     user = models.ForeignKey(
         User,
@@ -22,13 +59,38 @@ class LtiUserData(models.Model):
     )
     edx_lti_parameters = JSONField(default={})
     custom_key = models.CharField(max_length=190, null=False, default='')
+    updated = models.DateTimeField(auto_now=True, db_index=True)
+    # last allocated and last successfully delivered grade sequence numbers, see send_lti_grade
+    grade_sequence = models.BigIntegerField(default=0)
+    delivered_grade_sequence = models.BigIntegerField(default=0)
+    # set while an ordered grade delivery is in progress, so that deliveries of the record's grades don't overlap
+    delivery_lease_until = models.DateTimeField(null=True, default=None)
+
+    objects = LtiUserDataManager()
+
+    # set in edx_lti_parameters of records created by roster sync (see roster module) - replaced by the first launch
+    PLACEHOLDER_PARAMETER = 'lti_roster_placeholder'
+
+    DELIVERY_LEASE_POLL_INTERVAL = 0.05
 
     class Meta:
         app_label = "django_lti_tool_provider"
         unique_together = (("user", "custom_key"),)
 
+    @property
+    def is_placeholder(self):
+        """ Whether the record was created by roster sync, rather than by a launch """
+        return bool((self.edx_lti_parameters or {}).get(self.PLACEHOLDER_PARAMETER))
+
+    @property
+    def uses_ags(self):
+        """ Whether grades go to an LTI 1.3 platform's AGS line item rather than an LTI 1.1 outcome service """
+        return bool(((self.edx_lti_parameters or {}).get('ags_endpoint') or {}).get('lineitem'))
+
     @property
     def _required_params(self):
+        if self.uses_ags:
+            return ["iss", "user_id"]
         return ["lis_result_sourcedid", "lis_outcome_service_url"]
 
     def _validate_lti_grade_request(self, grade):
@@ -53,19 +115,123 @@ class LtiUserData(models.Model):
                 "Following required LTI parameters are not set: {parameters}".format(parameters=parameters_repr)
             )
 
-    def send_lti_grade(self, grade):
-        """ Instantiates DjangoToolProvider using stored lti parameters and sends grade """
+    def send_lti_grade(self, grade, sequence=None, backend=None):
+        """
+        Sends grade through the outcome backend (LTI_OUTCOME_BACKEND setting, see backends module): by default,
+        instantiates DjangoToolProvider using stored lti parameters and sends grade (or, for LTI 1.3 launches with
+        an AGS line item, publishes it as a score - see ags module).
+
+        If sequence (see next_grade_sequence) is given, delivery is ordered - the LMS ends up with the grade of the
+        highest sequence number delivered: deliveries of the record's grades take turns, holding a lease on the record
+        (for up to LTI_GRADE_DELIVERY_LEASE_SECONDS, 60 by default, in case the worker holding it dies) while the LMS
+        is contacted, and a grade is dropped (None is returned) if a grade with a higher sequence number was allocated
+        or delivered before its turn came. A delivery waits for the lease up to LTI_GRADE_DELIVERY_LEASE_WAIT seconds
+        (10 by default), and fails if it did not get it. A grade dropped in favour of a newer one stays undelivered if
+        delivery of the newer one then fails - send a new grade (or retry the newer one) then. Through OutboxBackend,
+        the grade is queued with its sequence number instead, and deliver_outbox delivers it the same way.
+        """
+        if sequence is None:
+            return self._post_grade(grade, backend)
+
+        backend = backend or get_outcome_backend()
+        # no instance hint - self might have been read from the replica
+        rows = LtiUserData.objects.using(router.db_for_write(LtiUserData)).filter(pk=self.pk)
+        if isinstance(backend, OutboxBackend):
+            # delivered (and recorded as delivered) by deliver_outbox
+            if self._is_stale(rows, grade, sequence):
+                return None
+            rows.update(grade_sequence=Greatest('grade_sequence', Value(sequence)))
+            return self._post_grade(grade, backend, sequence=sequence)
+
+        lease = self._take_delivery_lease(rows)
+        if lease is None:
+            description = u"delivery of another grade took too long"
+            OutcomeDeliveryLog.record(self, grade, OutcomeDeliveryLog.FAILURE, 0, description)
+            return DeliveryOutcome(False, description)
+        try:
+            if self._is_stale(rows, grade, sequence):
+                return None
+            outcome = self._post_grade(grade, backend)
+            if outcome.is_success():
+                # conditional - should the lease expire meanwhile, a newer grade delivered after it stays recorded
+                rows.filter(delivered_grade_sequence__lt=sequence).update(
+                    grade_sequence=Greatest('grade_sequence', Value(sequence)), delivered_grade_sequence=sequence
+                )
+                self.grade_sequence, self.delivered_grade_sequence = max(self.grade_sequence, sequence), sequence
+            return outcome
+        finally:
+            # conditional - a lease that expired meanwhile might have been taken by another delivery
+            rows.filter(delivery_lease_until=lease).update(delivery_lease_until=None)
+
+    def _take_delivery_lease(self, rows):
+        """ Takes the record's delivery lease (see send_lti_grade); returns its expiry, or None if it timed out """
+        lease_seconds = getattr(settings, 'LTI_GRADE_DELIVERY_LEASE_SECONDS', 60)
+        deadline = time.time() + getattr(settings, 'LTI_GRADE_DELIVERY_LEASE_WAIT', 10)
+        while True:
+            now = timezone.now()
+            lease = now + timedelta(seconds=lease_seconds)
+            taken = rows.filter(
+                Q(delivery_lease_until__isnull=True) | Q(delivery_lease_until__lte=now)
+            ).update(delivery_lease_until=lease)
+            if taken:
+                return lease
+            if time.time() >= deadline:
+                _logger.warning(u"Gave up waiting for delivery of another LTI grade for %s", self)
+                return None
+            time.sleep(self.DELIVERY_LEASE_POLL_INTERVAL)
+
+    def _is_stale(self, rows, grade, sequence):
+        latest, delivered = rows.values_list('grade_sequence', 'delivered_grade_sequence').get()
+        if sequence >= latest and sequence > delivered:
+            return False
+        _logger.info(
+            u"Dropping stale LTI grade %(grade)s for user %(user)s and key %(key)s: sequence %(sequence)s, "
+            u"latest %(latest)s, delivered %(delivered)s",
+            dict(grade=grade, user=self.user_id, key=self.custom_key, sequence=sequence, latest=latest,
+                 delivered=delivered)
+        )
+        OutcomeDeliveryLog.record(self, grade, OutcomeDeliveryLog.STALE, 0, u"sequence {}".format(sequence))
+        return True
+
+    def _post_grade(self, grade, backend=None, sequence=None):
         self._validate_lti_grade_request(grade)
-        provider = DjangoToolProvider(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, self.edx_lti_parameters)
-        outcome = provider.post_replace_result(grade)
+        backend = backend or get_outcome_backend()
+        started = time.time()
+        try:
+            if sequence is None:
+                outcome = backend.send_grade(self, grade)
+            else:
+                # only OutboxBackend takes the sequence number - see send_lti_grade
+                outcome = backend.send_grade(self, grade, sequence=sequence)
+        except Exception as exc:
+            OutcomeDeliveryLog.record(self, grade, OutcomeDeliveryLog.ERROR, time.time() - started, repr(exc))
+            raise
 
         _logger.info(
             u"LTI grade request was %(successful)s. Description is %(description)s",
             dict(successful="successful" if outcome.is_success() else "unsuccessful", description=outcome.description)
         )
+        status = outcome.log_status if isinstance(outcome, DeliveryOutcome) else None
+        if status is None:
+            status = OutcomeDeliveryLog.SUCCESS if outcome.is_success() else OutcomeDeliveryLog.FAILURE
+        OutcomeDeliveryLog.record(self, grade, status, time.time() - started, outcome.description)
 
         return outcome
 
+    def next_grade_sequence(self):
+        """
+        Allocates the next grade sequence number for this user and key. Allocate it when the grade is computed and
+        pass it to send_lti_grade (or as `sequence` with Signals.Grade.updated) - delivery then guarantees that the
+        grade allocated last is the one the LMS keeps.
+        """
+        # no instance hint - self might have been read from the replica
+        database = router.db_for_write(LtiUserData)
+        with transaction.atomic(using=database):
+            rows = LtiUserData.objects.using(database).filter(pk=self.pk)
+            rows.update(grade_sequence=F('grade_sequence') + 1)
+            self.grade_sequence = rows.values_list('grade_sequence', flat=True).get()
+        return self.grade_sequence
+
     @classmethod
     def get_or_create_by_parameters(cls, user, authentication_manager, lti_params, create=True):
         """
@@ -75,40 +241,190 @@ class LtiUserData(models.Model):
         This function also does a bit of sanity checking to make sure the current user_id matches
         the stored lti user_id, raising WrongUserError if not.
         """
-        custom_key = authentication_manager.vary_by_key(lti_params)
-
-        # implicitly tested by test_views
-        if custom_key is None:
-            custom_key = ''
+        custom_key = cls._custom_key(authentication_manager, lti_params)
 
         if create:
             lti_user_data, created = LtiUserData.objects.get_or_create(user=user, custom_key=custom_key)
         else:
             # Could omit it, but it would change the signature.
             created = False
-            lti_user_data = LtiUserData.objects.get(user=user, custom_key=custom_key)
+            lti_user_data = LtiUserData.objects.for_read().get(user=user, custom_key=custom_key)
+
+        cls._check_lti_user(lti_user_data, lti_params)
+        return lti_user_data, created
 
+    @classmethod
+    def get_for_launch(cls, user, authentication_manager, lti_params):
+        """
+        Returns user's LTI user data for the launched resource or, if there is none, any other LTI user data of the
+        user (None if user never launched anything) - in a single query. Tells a returning LTI user launching another
+        resource apart from a different person using the same session. Roster placeholders are not launches and are
+        left out.
+        """
+        custom_key = cls._custom_key(authentication_manager, lti_params)
+        launched_key_first = Case(
+            When(custom_key=custom_key, then=Value(0)), default=Value(1), output_field=IntegerField()
+        )
+        # matches the stored JSON text - the marker is the only place the parameter name appears
+        return LtiUserData.objects.for_read().filter(user=user).exclude(
+            edx_lti_parameters__contains=cls.PLACEHOLDER_PARAMETER
+        ).order_by(launched_key_first).first()
+
+    @staticmethod
+    def _custom_key(authentication_manager, lti_params):
+        custom_key = authentication_manager.vary_by_key(lti_params)
+        # implicitly tested by test_views
+        return custom_key if custom_key is not None else ''
+
+    @staticmethod
+    def _check_lti_user(lti_user_data, lti_params):
         if lti_user_data.edx_lti_parameters.get('user_id', lti_params['user_id']) != lti_params['user_id']:
-            # TODO: not covered by test
             message = u"LTI parameters for user found, but anonymous user id does not match."
             _logger.error(message)
             raise WrongUserError(message)
 
-        return lti_user_data, created
-
     @classmethod
-    def store_lti_parameters(cls, user, authentication_manager, lti_params):
+    def store_lti_parameters(cls, user, authentication_manager, lti_params, lti_user_data=None):
         """
-        Stores LTI parameters into the DB, creating or updating record as needed
+        Stores LTI parameters into the DB, creating or updating record as needed.
+
+        lti_user_data, if given, is user's record as already loaded (see get_for_launch) - if it is the one for the
+        launched resource, it is updated straight away, without looking it up again.
         """
-        lti_user_data, created = cls.get_or_create_by_parameters(user, authentication_manager, lti_params)
+        custom_key = cls._custom_key(authentication_manager, lti_params)
+        if lti_user_data is not None and lti_user_data.custom_key == custom_key:
+            cls._check_lti_user(lti_user_data, lti_params)
+            created = False
+        else:
+            lti_user_data, created = cls.get_or_create_by_parameters(user, authentication_manager, lti_params)
         lti_user_data.edx_lti_parameters = lti_params
         if not created:
             _logger.debug(u"Replaced LTI parameters for user %s", user.username)
-        lti_user_data.save()
+        # grade sequence numbers are maintained by concurrent grade workers - never overwrite them with stale values;
+        # lti_user_data might come from the read replica, so the primary is picked explicitly
+        lti_user_data.save(using=router.db_for_write(LtiUserData), update_fields=['edx_lti_parameters', 'updated'])
+        pin_record_to_primary(lti_user_data.user_id, lti_user_data.custom_key)
+        endpoint_cache.invalidate(lti_user_data.user_id, lti_user_data.custom_key)
         return lti_user_data
 
     def __unicode__(self):
         return u"{classname} for {user} and (vary_key: {custom_key})".format(
             classname=self.__class__.__name__, user=self.user, custom_key=self.custom_key
         )
+
+
+class OutcomeDeliveryLogQuerySet(models.QuerySet):
+    def since(self, when):
+        return self.filter(created__gte=when)
+
+    def stats_by_course(self):
+        """ Delivery count, success rate and latency per course (LTI context_id) """
+        return self._stats_by('context_id')
+
+    def stats_by_host(self):
+        """ Delivery count, success rate and latency per LMS outcome service (or AGS line item) host """
+        return self._stats_by('outcome_service_host')
+
+    def _stats_by(self, field):
+        succeeded = Case(When(status=OutcomeDeliveryLog.SUCCESS, then=Value(1)), default=Value(0),
+                         output_field=IntegerField())
+        return self.order_by(field).values(field).annotate(
+            total=Count('id'),
+            succeeded=Sum(succeeded),
+            avg_latency_ms=Avg('latency_ms'),
+            max_latency_ms=Max('latency_ms'),
+        ).annotate(
+            success_rate=ExpressionWrapper(F('succeeded') * 1.0 / F('total'), output_field=FloatField())
+        )
+
+
+class OutcomeDeliveryLog(models.Model):
+    """
+    One row per grade sent to an LMS outcome service. Rows are written in batches (see BulkInsertBuffer) when
+    LTI_DELIVERY_LOG setting is enabled.
+    """
+    SUCCESS, FAILURE, ERROR, STALE, QUEUED = 'success', 'failure', 'error', 'stale', 'queued'
+    STATUS_CHOICES = (
+        (SUCCESS, 'Success'), (FAILURE, 'Rejected by LMS'), (ERROR, 'Delivery error'),
+        (STALE, 'Dropped as superseded by a newer grade'), (QUEUED, 'Queued in the outbox'),
+    )
+
+    DESCRIPTION_LENGTH = 255
+
+    user = models.ForeignKey(
+        User,
+        on_delete=models.CASCADE,
+    )
+    custom_key = models.CharField(max_length=190, default='')
+    context_id = models.CharField(max_length=255, default='')
+    outcome_service_host = models.CharField(max_length=255, default='')
+    grade = models.FloatField()
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES)
+    latency_ms = models.PositiveIntegerField()
+    description = models.CharField(max_length=DESCRIPTION_LENGTH, default='')
+    created = models.DateTimeField(default=timezone.now)
+
+    objects = OutcomeDeliveryLogQuerySet.as_manager()
+
+    class Meta:
+        app_label = "django_lti_tool_provider"
+        indexes = [
+            models.Index(fields=['context_id', 'created'], name='lti_delivery_context_idx'),
+            models.Index(fields=['outcome_service_host', 'created'], name='lti_delivery_host_idx'),
+            models.Index(fields=['created'], name='lti_delivery_created_idx'),
+        ]
+
+    @classmethod
+    def record(cls, lti_user_data, grade, status, latency, description):
+        """ Buffers a log entry for a grade delivery attempt made with lti_user_data; latency is in seconds """
+        if not getattr(settings, 'LTI_DELIVERY_LOG', False):
+            return
+        parameters = lti_user_data.edx_lti_parameters or {}
+        delivery_log_buffer.add(cls(
+            user_id=lti_user_data.user_id,
+            custom_key=lti_user_data.custom_key,
+            context_id=parameters.get('context_id') or '',
+            outcome_service_host=urlparse(
+                parameters.get('lis_outcome_service_url') or (parameters.get('ags_endpoint') or {}).get('lineitem', '')
+            ).netloc,
+            grade=grade,
+            status=status,
+            latency_ms=int(latency * 1000),
+            description=u"{}".format(description or '')[:cls.DESCRIPTION_LENGTH],
+        ))
+
+    def __unicode__(self):
+        return u"{classname} for {user} and (vary_key: {custom_key}): {status}".format(
+            classname=self.__class__.__name__, user=self.user, custom_key=self.custom_key, status=self.status
+        )
+
+
+class PendingGrade(models.Model):
+    """ Grade queued by OutboxBackend, waiting for deliver_lti_outbox command - see backends module """
+    lti_user_data = models.ForeignKey(
+        LtiUserData,
+        on_delete=models.CASCADE,
+    )
+    grade = models.FloatField()
+    # grade sequence number (see LtiUserData.send_lti_grade), None if the grade was sent without one
+    sequence = models.BigIntegerField(null=True, default=None)
+    created = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.CharField(max_length=255, default='')
+    # set while a deliver_lti_outbox run is delivering the grade, so that concurrent runs skip it
+    claimed_until = models.DateTimeField(null=True, default=None)
+
+    class Meta:
+        app_label = "django_lti_tool_provider"
+
+    def __unicode__(self):
+        return u"{classname} {grade} for {lti_user_data}".format(
+            classname=self.__class__.__name__, grade=self.grade, lti_user_data=self.lti_user_data_id
+        )
+
+
+delivery_log_buffer = BulkInsertBuffer(  # pylint: disable=invalid-name
+    OutcomeDeliveryLog,
+    batch_size=getattr(settings, 'LTI_DELIVERY_LOG_BATCH_SIZE', 100),
+    flush_interval=getattr(settings, 'LTI_DELIVERY_LOG_FLUSH_INTERVAL', 5.0),
+)
@@ -0,0 +1,59 @@
+"""
+Launch pipeline: LTIView processes a launch as a sequence of stages (LTIView.LAUNCH_STAGES) sharing a LaunchContext.
+
+A stage is a view classmethod named `stage_<name>` taking the context; it returns None to let the launch continue,
+or a response to finish it. Subclasses reorder, drop or add stages by overriding LAUNCH_STAGES - a stage sees the
+launch only through the context, so e.g. a caching stage can be slotted between any two. Every stage is timed: the
+timings end up in context.timings and, as a list of (stage, seconds), in request.lti_launch_timings.
+"""
+import logging
+import time
+
+
+_logger = logging.getLogger(__name__)
+
+
+class LaunchContext(object):
+    """ State of a launch passed from stage to stage """
+    def __init__(self, request, lti_parameters=None, lti_user_data=None):
+        self.request = request
+        # validated launch parameters; None until validate stage succeeds
+        self.lti_parameters = lti_parameters
+        # exc_info of a validation failure tolerated for an authenticated user (see LTIView.stage_validate)
+        self.validation_error = None
+        # user's LtiUserData - as found when matching the user, then as stored
+        self.lti_user_data = lti_user_data
+        self.timings = []
+        self._finish_callbacks = []
+
+    def on_finish(self, callback):
+        """ Registers callback(response) to run when the launch finishes - response is None if a stage raised """
+        self._finish_callbacks.append(callback)
+
+    def finish(self, response):
+        for callback in self._finish_callbacks:
+            callback(response)
+
+
+def run_stages(view_class, context, stages):
+    """ Runs stages (names) of view_class in order until one returns a response, and returns it """
+    response = None
+    try:
+        for stage in stages:
+            started = time.time()
+            try:
+                response = getattr(view_class, 'stage_' + stage)(context)
+            finally:
+                context.timings.append((stage, time.time() - started))
+            if response is not None:
+                break
+    finally:
+        context.request.lti_launch_timings = context.timings
+        _logger.debug(u"LTI launch stages: %s", u", ".join(
+            u"{} {:.1f}ms".format(stage, seconds * 1000) for stage, seconds in context.timings
+        ))
+        context.finish(response)
+
+    if response is None:
+        raise RuntimeError(u"Launch stages {} finished without a response".format(", ".join(stages)))
+    return response
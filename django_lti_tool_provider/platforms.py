@@ -0,0 +1,33 @@
+"""
+LTI 1.3 platform configuration, shared by launches (lti13 module), score publishing (ags module) and roster sync.
+Free of view and model imports, so that grade delivery can use it without importing the launch views, and of
+PyJWT - importing the models must not load the LTI 1.3 crypto stack (see protocol module for the LTI 1.1 one).
+
+Platforms are configured in LTI13_PLATFORMS setting, keyed by issuer:
+
+    LTI13_PLATFORMS = {
+        'https://lms.example.com': {
+            'client_id': 'tool client id issued by the platform',
+            'auth_login_url': 'https://lms.example.com/oidc/auth',
+            'jwks_url': 'https://lms.example.com/.well-known/jwks.json',
+            'deployment_ids': ['1'],  # optional - any deployment is accepted if omitted
+            'auth_token_url': 'https://lms.example.com/oauth2/token',  # for AGS score publishing
+        },
+    }
+"""
+from django.conf import settings
+
+
+class Lti13LaunchError(Exception):
+    """ LTI 1.3 login or launch request failed validation """
+    def __init__(self, message):
+        super(Lti13LaunchError, self).__init__(message)
+        self.message = message
+
+
+def get_platform(issuer):
+    """ Returns LTI13_PLATFORMS configuration for issuer """
+    platform = getattr(settings, 'LTI13_PLATFORMS', {}).get(issuer)
+    if platform is None:
+        raise Lti13LaunchError(u"Unknown LTI 1.3 platform {}".format(issuer))
+    return platform
@@ -0,0 +1,31 @@
+"""
+Entry points into the LTI 1.1 protocol stack (ims_lti_py, and through it oauth2, httplib2 and lxml).
+
+The stack is imported on first use - when a launch is validated or a grade is sent - rather than when models or
+views are imported, so management commands, workers and anything else that only touches the models do not pay
+for loading it.
+"""
+
+
+class InvalidLtiRequest(Exception):
+    """ LTI 1.1 launch failed OAuth validation """
+    def __init__(self, message):
+        super(InvalidLtiRequest, self).__init__(message)
+        self.message = message
+
+
+def tool_provider(consumer_key, consumer_secret, params):
+    """ Returns ims_lti_py DjangoToolProvider for params """
+    from ims_lti_py.tool_provider import DjangoToolProvider
+    return DjangoToolProvider(consumer_key, consumer_secret, params)
+
+
+def validate_launch(consumer_key, consumer_secret, request):
+    """ Validates OAuth signature of an LTI launch request and returns its parameters; raises InvalidLtiRequest """
+    import oauth2
+    provider = tool_provider(consumer_key, consumer_secret, request.POST)
+    try:
+        provider.valid_request(request)
+    except oauth2.Error as e:
+        raise InvalidLtiRequest(e.message)
+    return provider.to_params()
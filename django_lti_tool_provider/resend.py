@@ -0,0 +1,194 @@
+"""
+Bulk recompute-and-resend of grades, e.g. for a whole course after a grading rule change (see resend_lti_grades
+command).
+
+Matching LtiUserData records are streamed in primary key order, a batch at a time. Each batch is handed to an
+app-supplied grade function, which returns a grade (or None to skip the record) for each record of the batch:
+
+    def recompute_grades(lti_user_data_batch):
+        return [compute_grade(lti_user_data.user, lti_user_data.custom_key) for lti_user_data in lti_user_data_batch]
+
+Grades of a batch are delivered concurrently by a pool of worker threads, through the configured outcome backend
+(see backends module), at no more than the given rate. After each batch the primary key of its last record is
+written to the checkpoint file, if any - an interrupted resend picks up from there.
+
+Each grade gets a sequence number as soon as the grade function returns it, so it is delivered in order with grades
+sent meanwhile by the app (see LtiUserData.send_lti_grade) - one superseded by a newer grade is skipped. Records
+created by roster sync (see roster module) have no outcome service yet and are left out.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from django.utils.module_loading import import_string
+import six
+
+from django_lti_tool_provider.executor import BackgroundExecutor
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.transfer import iter_in_chunks
+
+
+_logger = logging.getLogger(__name__)
+
+
+class ResendStats(object):
+    def __init__(self):
+        self.processed = 0
+        self.sent = 0
+        self.skipped = 0
+        self.failed = 0
+        self.last_pk = 0
+
+    def __repr__(self):
+        return u"processed: {}, sent: {}, skipped: {}, failed: {}".format(
+            self.processed, self.sent, self.skipped, self.failed
+        )
+
+
+class RateLimiter(object):
+    """ Lets at most `rate` callers per second through acquire() (no limit if rate is falsy); thread-safe """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            wait = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if wait > 0:
+            time.sleep(wait)
+
+
+class Checkpoint(object):
+    """ Progress of a resend, kept in a JSON file; the filters it was made with must match to resume it """
+    def __init__(self, path, filters):
+        self.path = path
+        self.filters = filters
+
+    def load(self):
+        """ Returns primary key to resume after (0 if there is no checkpoint); raises ValueError on mismatch """
+        if not self.path or not os.path.exists(self.path):
+            return 0
+        with open(self.path) as stream:
+            state = json.load(stream)
+        if state.get('filters') != self.filters:
+            raise ValueError(u"Checkpoint {} was made for {}, not {}".format(
+                self.path, state.get('filters'), self.filters
+            ))
+        return state['last_pk']
+
+    def save(self, last_pk):
+        if not self.path:
+            return
+        temporary_path = self.path + '.tmp'
+        with open(temporary_path, 'w') as stream:
+            json.dump({'filters': self.filters, 'last_pk': last_pk}, stream)
+        # atomic - an interruption can't leave a truncated checkpoint behind
+        os.rename(temporary_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+def iter_lti_user_data(context_id=None, custom_key_prefix=None, after_pk=0, chunk_size=1000):
+    """
+    Yields LtiUserData records (with users) of the course context_id and/or custom key prefix, by primary key. Roster
+    placeholders are left out.
+    """
+    # matches the stored JSON text - the marker is the only place the parameter name appears
+    queryset = LtiUserData.objects.filter(pk__gt=after_pk).exclude(
+        edx_lti_parameters__contains=LtiUserData.PLACEHOLDER_PARAMETER
+    ).select_related('user')
+    if custom_key_prefix is not None:
+        queryset = queryset.filter(custom_key__startswith=custom_key_prefix)
+    if context_id is not None and _is_plain(context_id):
+        # cheap pre-filter on the stored JSON text; records are matched exactly below
+        queryset = queryset.filter(edx_lti_parameters__contains=context_id)
+
+    for lti_user_data in iter_in_chunks(queryset, chunk_size):
+        if context_id is None or (lti_user_data.edx_lti_parameters or {}).get('context_id') == context_id:
+            yield lti_user_data
+
+
+def _is_plain(value):
+    # JSON-encoded as is, so it can be searched for in stored parameters
+    return all(32 <= ord(char) < 127 and char not in '"\\' for char in value)
+
+
+def _batches(iterable, size):
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def resend_grades(grade_function, context_id=None, custom_key_prefix=None, batch_size=100, workers=4, rate=None,
+                  checkpoint_path=None, progress=None, backend=None):
+    """
+    Recomputes grades of matching LtiUserData records with grade_function (a callable or its dotted path) and
+    sends them - see module docstring. Resumes from checkpoint_path if it exists, and removes it once done.
+    progress, if given, is called with ResendStats after each batch. Returns ResendStats.
+    """
+    if isinstance(grade_function, six.string_types):
+        grade_function = import_string(grade_function)
+    checkpoint = Checkpoint(checkpoint_path, {'context_id': context_id, 'custom_key_prefix': custom_key_prefix})
+    stats = ResendStats()
+    stats.last_pk = checkpoint.load()
+    if stats.last_pk:
+        _logger.info(u"Resuming grade resend after LtiUserData %s", stats.last_pk)
+
+    limiter = RateLimiter(rate)
+    executor = BackgroundExecutor(workers=workers, name='lti-resend')
+    try:
+        records = iter_lti_user_data(context_id, custom_key_prefix, after_pk=stats.last_pk)
+        for batch in _batches(records, batch_size):
+            grades = list(grade_function(batch))
+            if len(grades) != len(batch):
+                raise ValueError(u"Grade function returned {} grades for {} records".format(len(grades), len(batch)))
+            graded = []
+            for lti_user_data, grade in zip(batch, grades):
+                if grade is None:
+                    stats.skipped += 1
+                else:
+                    graded.append((lti_user_data, grade, lti_user_data.next_grade_sequence()))
+            tasks = [
+                (lti_user_data, executor.submit(_send_grade, lti_user_data, grade, sequence, limiter, backend))
+                for lti_user_data, grade, sequence in graded
+            ]
+
+            for lti_user_data, task in tasks:
+                if task.exception() is None and task.result() is None:
+                    # superseded by a grade the app sent meanwhile
+                    stats.skipped += 1
+                elif task.exception() is None and task.result().is_success():
+                    stats.sent += 1
+                else:
+                    stats.failed += 1
+                    _logger.warning(u"Failed to resend LTI grade for %s", lti_user_data)
+
+            stats.processed += len(batch)
+            stats.last_pk = batch[-1].pk
+            checkpoint.save(stats.last_pk)
+            if progress is not None:
+                progress(stats)
+    finally:
+        executor.shutdown(wait=True)
+
+    checkpoint.clear()
+    return stats
+
+
+def _send_grade(lti_user_data, grade, sequence, limiter, backend):
+    limiter.acquire()
+    return lti_user_data.send_lti_grade(grade, sequence=sequence, backend=backend)
@@ -0,0 +1,78 @@
+"""
+Batched pruning of LtiUserData records not updated (i.e. not launched) for a while.
+"""
+import logging
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.transfer import RECORD_FIELDS, serialize_record
+
+
+_logger = logging.getLogger(__name__)
+
+
+def retention_cutoff(days=None):
+    """ Returns the time before which LtiUserData is stale, from days or LTI_USER_DATA_RETENTION_DAYS setting """
+    days = days if days is not None else getattr(settings, 'LTI_USER_DATA_RETENTION_DAYS', None)
+    if days is None:
+        raise ValueError(u"Retention period is not specified and LTI_USER_DATA_RETENTION_DAYS is not set")
+    return timezone.now() - timedelta(days=days)
+
+
+def prune_lti_user_data(cutoff, batch_size=500, sleep=0.1, archive_stream=None, dry_run=False):
+    """
+    Deletes LtiUserData records last updated before cutoff, batch_size rows per (short) transaction, pausing for
+    `sleep` seconds between batches so that locks on the live table are short and other writers get a chance to run.
+    If archive_stream is given, deleted records are written to it first, in the export_lti_user_data format.
+
+    Returns number of deleted (with dry_run - matching) records.
+    """
+    stale = LtiUserData.objects.filter(updated__lt=cutoff).order_by('pk')
+    if dry_run:
+        return stale.count()
+
+    deleted = 0
+    last_pk = 0
+    while True:
+        pks = list(stale.filter(pk__gt=last_pk).values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            break
+
+        count = _delete_batch(pks, cutoff, archive_stream)
+        deleted += count
+        last_pk = pks[-1]
+        _logger.debug(u"Pruned %d stale LtiUserData records, %d so far", count, deleted)
+
+        if len(pks) < batch_size:
+            break
+        if sleep:
+            time.sleep(sleep)
+
+    return deleted
+
+
+def _delete_batch(pks, cutoff, archive_stream):
+    """ Deletes (and archives) records of pks still stale at cutoff - records launched since they were selected stay """
+    database = router.db_for_write(LtiUserData)
+    with transaction.atomic(using=database):
+        batch = LtiUserData.objects.using(database).filter(pk__in=pks, updated__lt=cutoff)
+        if not connections[database].features.has_select_for_update:
+            # e.g. SQLite - take the write lock upfront, so no launch can update the batch until it is deleted
+            batch.update(updated=F('updated'))
+        records = list(batch.select_for_update().order_by('pk').values_list('pk', *RECORD_FIELDS))
+        if not records:
+            return 0
+
+        if archive_stream is not None:
+            for fields in records:
+                archive_stream.write(serialize_record(*fields[1:]))
+        count, _ = LtiUserData.objects.using(database).filter(
+            pk__in=[fields[0] for fields in records], updated__lt=cutoff
+        ).delete()
+        return count
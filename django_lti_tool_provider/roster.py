@@ -0,0 +1,322 @@
+"""
+Roster (course membership) sync from LTI 1.3 Names and Role Provisioning Services (NRPS), so that users and their
+LtiUserData exist before their first launch.
+
+The memberships URL comes from launch parameters (`names_role_service` - see lti13 module). Memberships are
+fetched page by page, following `Link: <...>; rel="next"` headers, and stored a page at a time: users are created
+(or updated) and LtiUserData placeholders inserted in bulk, so memory use does not depend on the roster size. The
+ETag and next link of each page are kept in the Django cache, by page URL, for ETAG_CACHE_TIMEOUT: a re-sync fetches
+every page conditionally and stores only pages that changed, so re-syncing an unchanged roster costs one request
+per page answered with 304 Not Modified.
+
+Only users the sync creates, and users already linked to the member by an LtiUserData record of the same platform
+(issuer and LTI user_id), are updated and get placeholders. Any other user who happens to have the member's
+username is left alone - the roster is not a login, and must not take over a local account.
+"""
+from collections import namedtuple
+import hashlib
+import json
+import logging
+import re
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
+import six
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import Request, urlopen
+
+from django_lti_tool_provider.ags import token_cache
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.transfer import iter_in_chunks
+from django_lti_tool_provider.views import LTIView
+
+
+_logger = logging.getLogger(__name__)
+
+NRPS_SCOPE = 'https://purl.imsglobal.org/spec/lti-nrps/scope/contextmembership.readonly'
+MEMBERSHIP_CONTENT_TYPE = 'application/vnd.ims.lti-nrps.v2.membershipcontainer+json'
+ACTIVE = 'Active'
+
+ETAG_CACHE_TIMEOUT = 24 * 3600
+
+_NEXT_LINK_RE = re.compile(r'<([^>]+)>\s*;\s*rel="?next"?')
+
+# NRPS member field -> LTI 1.1 parameter name, as in lti13.CLAIM_TO_PARAMETER
+MEMBER_TO_PARAMETER = (
+    ('user_id', 'user_id'),
+    ('lis_person_sourcedid', 'lis_person_sourcedid'),
+    ('email', 'lis_person_contact_email_primary'),
+    ('name', 'lis_person_name_full'),
+    ('given_name', 'lis_person_name_given'),
+    ('family_name', 'lis_person_name_family'),
+    ('roles', 'roles'),
+)
+
+
+class RosterSyncError(Exception):
+    pass
+
+
+class RosterPage(namedtuple('RosterPage', ('url', 'members', 'context', 'etag', 'next_url'))):
+    """ A fetched page of a roster; members and context are None if it did not change since it was last fetched """
+    __slots__ = ()
+
+
+class SyncStats(object):
+    def __init__(self):
+        self.unchanged = False
+        self.pages = 0
+        self.unchanged_pages = 0
+        self.members = 0
+        self.skipped = 0
+        self.conflicts = 0
+        self.users_created = 0
+        self.users_updated = 0
+        self.lti_user_data_created = 0
+
+    def __repr__(self):
+        if self.unchanged:
+            return u"roster unchanged"
+        return (
+            u"pages: {}, unchanged pages: {}, members: {}, skipped inactive: {}, skipped username conflicts: {}, "
+            u"users created: {}, users updated: {}, LtiUserData created: {}"
+        ).format(
+            self.pages, self.unchanged_pages, self.members, self.skipped, self.conflicts, self.users_created,
+            self.users_updated, self.lti_user_data_created
+        )
+
+
+def roster_source(lti_parameters):
+    """ Returns (issuer, memberships URL, context id) from launch parameters, or None if the launch has no roster """
+    memberships_url = (lti_parameters.get('names_role_service') or {}).get('context_memberships_url')
+    if not memberships_url or not lti_parameters.get('iss'):
+        return None
+    return lti_parameters['iss'], memberships_url, lti_parameters.get('context_id')
+
+
+def iter_roster_sources(queryset=None, chunk_size=1000):
+    """ Yields distinct roster_source()s of stored LtiUserData records (all records by default) """
+    queryset = queryset if queryset is not None else LtiUserData.objects.all()
+    seen = set()
+    for _, lti_parameters in iter_in_chunks(queryset.values_list('pk', 'edx_lti_parameters'), chunk_size):
+        if isinstance(lti_parameters, six.string_types):
+            # depending on jsonfield version, values_list returns stored JSON undecoded
+            lti_parameters = json.loads(lti_parameters)
+        source = roster_source(lti_parameters or {})
+        if source is not None and source[1] not in seen:
+            seen.add(source[1])
+            yield source
+
+
+def _page_cache_key(page_url):
+    return 'lti_roster_page:' + hashlib.md5(page_url.encode('utf-8')).hexdigest()
+
+
+class _CachedPages(object):
+    """ known_pages of iter_membership_pages, looked up in the Django cache page by page """
+    @staticmethod
+    def get(page_url):
+        return cache.get(_page_cache_key(page_url))
+
+
+def _next_link(headers):
+    next_link = _NEXT_LINK_RE.search(headers.get('Link') or '')
+    return next_link.group(1) if next_link else None
+
+
+def _fetch_page(url, token, etag=None, timeout=5):
+    """ Returns (document, etag, next link) of the page at url; document is None if it still matches etag """
+    headers = {'Authorization': 'Bearer ' + token, 'Accept': MEMBERSHIP_CONTENT_TYPE}
+    if etag:
+        headers['If-None-Match'] = etag
+    try:
+        response = urlopen(Request(url, headers=headers), timeout=timeout)
+    except HTTPError as e:
+        if e.code == 304:
+            return None, e.info().get('ETag') or etag, _next_link(e.info())
+        raise RosterSyncError(u"Failed to fetch memberships from {}: HTTP {}".format(url, e.code))
+    except IOError as e:
+        raise RosterSyncError(u"Failed to fetch memberships from {}: {!r}".format(url, e))
+
+    try:
+        document = json.loads(response.read().decode('utf-8'))
+        return document, response.info().get('ETag'), _next_link(response.info())
+    finally:
+        response.close()
+
+
+def iter_membership_pages(issuer, memberships_url, known_pages=None, tokens=None):
+    """
+    Yields a RosterPage for each page of the roster at memberships_url. known_pages maps page URLs to
+    (etag, next link) of an earlier fetch: such pages are fetched conditionally, and one answered with 304 Not
+    Modified is yielded without members - its next link is taken from known_pages unless the 304 carries one.
+    """
+    tokens = tokens if tokens is not None else token_cache
+    token = tokens.get_token(issuer, (NRPS_SCOPE,))
+    timeout = getattr(settings, 'LTI13_AGS_TIMEOUT', 5)
+    known_pages = known_pages if known_pages is not None else {}
+
+    url = memberships_url
+    while url:
+        known_etag, known_next_url = known_pages.get(url) or (None, None)
+        document, etag, next_url = _fetch_page(url, token, known_etag, timeout)
+        if document is None:
+            next_url = next_url or known_next_url
+            yield RosterPage(url, None, None, etag, next_url)
+        else:
+            yield RosterPage(url, document.get('members', []), document.get('context') or {}, etag, next_url)
+        url = next_url
+
+
+def member_parameters(member, issuer, context_id):
+    """ Flattens an NRPS member into LTI 1.1 parameter names, as launch parameters are stored """
+    parameters = {'iss': issuer}
+    if context_id:
+        parameters['context_id'] = context_id
+    for field, name in MEMBER_TO_PARAMETER:
+        if member.get(field) is not None:
+            parameters[name] = member[field]
+    return parameters
+
+
+def sync_roster(issuer, memberships_url, context_id=None, authentication_manager=None, force=False, tokens=None,
+                custom_key=None):
+    """
+    Fetches the roster and stores it, a page at a time. Users are identified by
+    authentication_manager.roster_username (LTIView's registered manager by default); users missing from the
+    database are created with unusable passwords, changed names and emails of linked users are updated (see module
+    docstring). Members get an LtiUserData placeholder for custom_key unless they already have a record for that
+    key - records of actual launches are never overwritten. Inactive members are skipped.
+
+    custom_key should be the key launches of the resource the placeholders are meant for get. If it is not given,
+    authentication_manager.vary_by_key is asked, with member parameters - which carry context_id but no
+    resource_link_id or custom parameters, so unless the key only depends on the course this is usually '', and
+    the placeholders match launches only if the application does not vary LtiUserData by key at all.
+
+    Unless force is set, pages that did not change since the last sync (by their ETags) are not stored again, and
+    the roster is reported unchanged if none did. Returns SyncStats.
+    """
+    authentication_manager = authentication_manager or LTIView.authentication_manager
+    if authentication_manager is None:
+        raise ImproperlyConfigured(u"AuthenticationManager is not set")
+
+    stats = SyncStats()
+    known_pages = {} if force else _CachedPages()
+    for page in iter_membership_pages(issuer, memberships_url, known_pages, tokens=tokens):
+        if page.members is None:
+            stats.unchanged_pages += 1
+        else:
+            stats.pages += 1
+            _store_members(
+                page.members, issuer, context_id or page.context.get('id'), authentication_manager, custom_key, stats
+            )
+        # cached once the page is stored - a sync failing halfway fetches the rest in full next time
+        if page.etag:
+            cache.set(_page_cache_key(page.url), (page.etag, page.next_url), ETAG_CACHE_TIMEOUT)
+
+    if stats.pages == 0:
+        stats.unchanged = True
+        _logger.info(u"Roster %s is unchanged", memberships_url)
+        return stats
+
+    _logger.info(u"Synced roster %s: %s", memberships_url, stats)
+    return stats
+
+
+def _store_members(members, issuer, context_id, authentication_manager, custom_key, stats):
+    by_username = {}
+    for member in members:
+        stats.members += 1
+        if member.get('status', ACTIVE) != ACTIVE or not member.get('user_id'):
+            stats.skipped += 1
+            continue
+        parameters = member_parameters(member, issuer, context_id)
+        by_username[authentication_manager.roster_username(parameters)] = parameters
+
+    if not by_username:
+        return
+
+    with transaction.atomic():
+        users = _upsert_users(by_username, issuer, stats)
+
+        placeholders = {}
+        for username, user in users.items():
+            parameters = by_username[username]
+            key = custom_key if custom_key is not None else authentication_manager.vary_by_key(parameters)
+            placeholders[(user.pk, key or '')] = dict(parameters, **{LtiUserData.PLACEHOLDER_PARAMETER: True})
+        existing = set(LtiUserData.objects.filter(
+            user_id__in=set(user_id for user_id, _ in placeholders)
+        ).values_list('user_id', 'custom_key'))
+        new_records = [
+            LtiUserData(user_id=user_id, custom_key=record_key, edx_lti_parameters=record_parameters)
+            for (user_id, record_key), record_parameters in placeholders.items()
+            if (user_id, record_key) not in existing
+        ]
+        LtiUserData.objects.bulk_create(new_records)
+        stats.lti_user_data_created += len(new_records)
+
+
+def _user_fields(parameters):
+    return {
+        'email': parameters.get('lis_person_contact_email_primary') or '',
+        'first_name': (parameters.get('lis_person_name_given') or '')[:30],
+        'last_name': (parameters.get('lis_person_name_family') or '')[:30],
+    }
+
+
+def _upsert_users(by_username, issuer, stats):
+    """ Creates missing users and updates linked ones; returns both by username - other users are skipped """
+    existing = {user.username: user for user in User.objects.filter(username__in=list(by_username))}
+    linked = _linked_user_ids(existing, by_username, issuer)
+
+    users = {}
+    for username, user in existing.items():
+        if user.pk not in linked:
+            stats.conflicts += 1
+            _logger.warning(
+                u"Skipping roster member %s of %s: user %s exists, but is not linked to them by an LTI launch",
+                by_username[username]['user_id'], issuer, username
+            )
+            continue
+        users[username] = user
+        fields = {
+            name: value for name, value in _user_fields(by_username[username]).items()
+            if value and getattr(user, name) != value
+        }
+        if fields:
+            User.objects.filter(pk=user.pk).update(**fields)
+            stats.users_updated += 1
+
+    new_users = []
+    for username in set(by_username) - set(existing):
+        user = User(username=username, **_user_fields(by_username[username]))
+        user.set_unusable_password()
+        new_users.append(user)
+    if new_users:
+        User.objects.bulk_create(new_users)
+        stats.users_created += len(new_users)
+        # bulk_create does not set primary keys on every database backend
+        created = User.objects.filter(username__in=[new_user.username for new_user in new_users])
+        users.update({user.username: user for user in created})
+
+    return users
+
+
+def _linked_user_ids(users, by_username, issuer):
+    """ Primary keys of users having an LtiUserData record of issuer's LTI user their username maps to """
+    lti_user_ids = {user.pk: by_username[username]['user_id'] for username, user in users.items()}
+    if not lti_user_ids:
+        return set()
+    records = LtiUserData.objects.filter(user_id__in=list(lti_user_ids)).values_list('user_id', 'edx_lti_parameters')
+    linked = set()
+    for user_id, parameters in records.iterator():
+        if isinstance(parameters, six.string_types):
+            # depending on jsonfield version, values_list returns stored JSON undecoded
+            parameters = json.loads(parameters)
+        parameters = parameters or {}
+        if parameters.get('iss') == issuer and parameters.get('user_id') == lti_user_ids[user_id]:
+            linked.add(user_id)
+    return linked
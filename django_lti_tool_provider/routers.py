@@ -0,0 +1,97 @@
+"""
+Read replica support for LtiUserData.
+
+When LTI_READ_DATABASE setting names a database alias, launch-time and grading-time reads of LtiUserData
+(`LtiUserData.objects.for_read()`) go to that database. Once a thread saves an instance of this app's models it is
+pinned to the primary database for LTI_READ_DATABASE_PIN_SECONDS (5 by default) or until the next request
+starts, so it always reads its own writes even if the replica lags behind. Note that deletes and queryset-level
+writes (update(), bulk_create()) do not pin - call pin_to_primary() after them if needed.
+
+That pin does not help a grade sent by another thread or process (a background worker, the next request) right after
+a launch, so grade lookups (LtiUserData.objects.get_for_grade) also read a record from the primary for the same time
+after store_lti_parameters saved it (pin_record_to_primary, kept in the LTI_READ_DATABASE_PIN_CACHE cache - `default`
+by default, it must be shared by all processes), and fall back to the primary if the replica doesn't have the record.
+
+LtiReplicaRouter applies the same policy to all other reads of this app's models; enable it with
+
+    DATABASE_ROUTERS = ['django_lti_tool_provider.routers.LtiReplicaRouter']
+"""
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.signals import request_started
+from django.dispatch import receiver
+
+
+APP_LABEL = 'django_lti_tool_provider'
+
+_state = threading.local()
+
+
+def pin_to_primary():
+    """ Sends this thread's reads to the primary database for a while, e.g. after it wrote LtiUserData """
+    _state.pinned_until = time.time() + _pin_seconds()
+
+
+def unpin():
+    _state.pinned_until = None
+
+
+def is_pinned():
+    pinned_until = getattr(_state, 'pinned_until', None)
+    return pinned_until is not None and time.time() < pinned_until
+
+
+def _pin_seconds():
+    return getattr(settings, 'LTI_READ_DATABASE_PIN_SECONDS', 5)
+
+
+def _record_pin_key(user_id, custom_key):
+    digest = hashlib.sha1(u'{}\n{}'.format(user_id, custom_key).encode('utf-8')).hexdigest()
+    return 'lti_record_pin:' + digest
+
+
+def pin_record_to_primary(user_id, custom_key):
+    """ Sends grade lookups of user's LtiUserData for custom_key to the primary database for a while, everywhere """
+    if getattr(settings, 'LTI_READ_DATABASE', None) is None:
+        return
+    caches[getattr(settings, 'LTI_READ_DATABASE_PIN_CACHE', 'default')].set(
+        _record_pin_key(user_id, custom_key), True, _pin_seconds()
+    )
+
+
+def is_record_pinned(user_id, custom_key):
+    if getattr(settings, 'LTI_READ_DATABASE', None) is None:
+        return False
+    cache = caches[getattr(settings, 'LTI_READ_DATABASE_PIN_CACHE', 'default')]
+    return bool(cache.get(_record_pin_key(user_id, custom_key)))
+
+
+def read_database_alias():
+    """ Returns database alias reads should use, or None to leave it to the regular routing """
+    read_database = getattr(settings, 'LTI_READ_DATABASE', None)
+    if read_database is None or is_pinned():
+        return None
+    return read_database
+
+
+@receiver(request_started, dispatch_uid="django_lti_unpin_on_request_started")
+def unpin_on_request_started(sender, **kwargs):  # pylint: disable=unused-argument
+    # threads are reused between requests - a pin set while serving the previous one should not leak into this one
+    unpin()
+
+
+def pin_on_save(sender, **kwargs):  # pylint: disable=unused-argument
+    """ post_save receiver, connected for this app's models in LTIToolProviderConfig.ready """
+    pin_to_primary()
+
+
+class LtiReplicaRouter(object):
+    """ Routes reads of this app's models to LTI_READ_DATABASE, respecting read-your-writes pinning """
+    def db_for_read(self, model, **hints):  # pylint: disable=unused-argument
+        if model._meta.app_label == APP_LABEL:
+            return read_database_alias()
+        return None
@@ -1,7 +1,12 @@
 import logging
+from contextlib import contextmanager
 
+from django.conf import settings
+from django.db import transaction
 from django.dispatch import Signal, receiver
 
+from django_lti_tool_provider.endpoints import endpoint_cache
+from django_lti_tool_provider.executor import get_executor
 from django_lti_tool_provider.models import LtiUserData
 
 
@@ -10,7 +15,10 @@ _logger = logging.getLogger(__name__)
 
 class Signals(object):
     class Grade(object):
-        updated = Signal(providing_args=["user", "new_grade"])
+        updated = Signal(providing_args=["user", "grade", "custom_key", "sequence", "background"])
+        # sent once a grade delivery completes, successfully or not
+        delivered = Signal(providing_args=["user", "grade", "custom_key", "sequence", "outcome"])
+        failed = Signal(providing_args=["user", "grade", "custom_key", "sequence", "outcome", "exception"])
 
     class LTI(object):
         received = Signal(providing_args=["user", "lti_data"])
@@ -18,18 +26,81 @@ class Signals(object):
 
 @receiver(Signals.Grade.updated, dispatch_uid="django_lti_grade_updated")
 def grade_updated_handler(sender, **kwargs):  # pylint: disable=unused-argument
+    """
+    Sends the grade and returns the LMS outcome or, if `background` is passed (or LTI_GRADE_IN_BACKGROUND setting is
+    enabled), a handle for the delivery running in background - see submit_grade.
+    """
     user = kwargs.get('user', None)
     grade = kwargs.get('grade', None)
     custom_key = kwargs.get('custom_key', None)
-    _send_grade(user, grade, custom_key)
+    sequence = kwargs.get('sequence', None)
+    if kwargs.get('background', getattr(settings, 'LTI_GRADE_IN_BACKGROUND', False)):
+        return submit_grade(user, grade, custom_key, sequence)
+    return _send_grade(user, grade, custom_key, sequence)
 
 
-def _send_grade(user, grade, custom_key):
+def submit_grade(user, grade, custom_key=None, sequence=None):
+    """
+    Hands grade over to the background executor and returns a Task handle right away: the caller can wait for it
+    (`handle.result(timeout)` returns the LMS outcome or raises), poll it (`handle.done()`) or ignore it -
+    Signals.Grade.delivered or Signals.Grade.failed is sent when delivery completes.
+
+    LtiUserData lookup and sequence number allocation are done synchronously, so grades are delivered in submission
+    order and a missing LtiUserData raises LtiUserData.DoesNotExist immediately; only the LMS I/O is deferred.
+    """
+    with _logged_grade_errors(user, custom_key):
+        lti_user_data, sequence = _prepare_grade(user, custom_key, sequence)
+    return get_executor().submit(_deliver_grade, lti_user_data, user, grade, custom_key, sequence)
+
+
+def _send_grade(user, grade, custom_key, sequence=None):
+    """
+    Sends grade for user and custom_key. Unless the sender passed a sequence number allocated when the grade was
+    computed (see LtiUserData.next_grade_sequence), one is allocated now - grades are then delivered in the order
+    of this call, and a grade superseded by a newer one before it is sent is dropped.
+    """
+    with _logged_grade_errors(user, custom_key):
+        lti_user_data, sequence = _prepare_grade(user, custom_key, sequence)
+    return _deliver_grade(lti_user_data, user, grade, custom_key, sequence)
+
+
+def _prepare_grade(user, custom_key, sequence):
+    if user is None:
+        raise ValueError(u"User is not specified")
+    if endpoint_cache.enabled:
+        lti_user_data = endpoint_cache.get(user.pk, custom_key).to_lti_user_data()
+    else:
+        lti_user_data = LtiUserData.objects.get_for_grade(user.pk, custom_key)
+    if sequence is None:
+        sequence = lti_user_data.next_grade_sequence()
+    return lti_user_data, sequence
+
+
+def _deliver_grade(lti_user_data, user, grade, custom_key, sequence):
+    """ Sends grade and the matching completion signal. Returns LMS outcome, or None if grade was superseded """
+    signal_kwargs = dict(user=user, grade=grade, custom_key=custom_key, sequence=sequence)
+    try:
+        with _logged_grade_errors(user, custom_key):
+            outcome = lti_user_data.send_lti_grade(grade, sequence=sequence)
+    except Exception as exc:
+        # the cached endpoint might be outdated
+        endpoint_cache.invalidate(lti_user_data.user_id, lti_user_data.custom_key)
+        _send_robust(Signals.Grade.failed, LtiUserData, outcome=None, exception=exc, **signal_kwargs)
+        raise
+
+    if outcome is not None:
+        if outcome.is_success():
+            _send_robust(Signals.Grade.delivered, LtiUserData, outcome=outcome, **signal_kwargs)
+        else:
+            endpoint_cache.invalidate(lti_user_data.user_id, lti_user_data.custom_key)
+            _send_robust(Signals.Grade.failed, LtiUserData, outcome=outcome, exception=None, **signal_kwargs)
+    return outcome
+
+
+@contextmanager
+def _logged_grade_errors(user, custom_key):
     try:
-        if user is None:
-            raise ValueError(u"User is not specified")
-        lti_user_data = LtiUserData.objects.get(user=user, custom_key=custom_key)
-        lti_user_data.send_lti_grade(grade)
+        yield
     except LtiUserData.DoesNotExist:
         _logger.info(
             u"No LTI parameters for user %(user)s and key %(key)s stored - probably never sent an LTI request",
@@ -42,3 +113,47 @@ def _send_grade(user, grade, custom_key):
             dict(user=user, key=custom_key)
         )
         raise
+
+
+def send_lti_received(sender, user, lti_data):
+    """
+    Sends Signals.LTI.received. By default receivers run synchronously, before the launch response is returned.
+
+    With LTI_RECEIVED_SIGNAL_ON_COMMIT setting enabled the signal is sent only after the current transaction commits
+    (and not at all if it rolls back); with LTI_RECEIVED_SIGNAL_IN_BACKGROUND enabled receivers run on a background
+    executor thread, so their cost does not add to launch latency. In both deferred modes a failing receiver is
+    logged and does not prevent other receivers from running.
+    """
+    on_commit = getattr(settings, 'LTI_RECEIVED_SIGNAL_ON_COMMIT', False)
+    in_background = getattr(settings, 'LTI_RECEIVED_SIGNAL_IN_BACKGROUND', False)
+
+    if not (on_commit or in_background):
+        return Signals.LTI.received.send(sender, user=user, lti_data=lti_data)
+
+    def _dispatch():
+        if in_background:
+            get_executor().submit(_send_lti_received_robust, sender, user, lti_data)
+        else:
+            _send_lti_received_robust(sender, user, lti_data)
+
+    if on_commit:
+        transaction.on_commit(_dispatch)
+    else:
+        _dispatch()
+    return None
+
+
+def _send_lti_received_robust(sender, user, lti_data):
+    return _send_robust(Signals.LTI.received, sender, user=user, lti_data=lti_data)
+
+
+def _send_robust(signal, sender, **kwargs):
+    """ Sends signal, logging (rather than propagating) receiver errors """
+    responses = signal.send_robust(sender, **kwargs)
+    for receiver_func, response in responses:
+        if isinstance(response, Exception):
+            _logger.error(
+                u"Signal receiver %(receiver)s failed for user %(user)s: %(error)r",
+                dict(receiver=receiver_func, user=kwargs.get('user'), error=response)
+            )
+    return responses
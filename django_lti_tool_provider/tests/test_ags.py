@@ -0,0 +1,194 @@
+import threading
+from unittest import skipIf
+
+from django.contrib.auth.models import User
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from six.moves.urllib.parse import parse_qs
+
+from django_lti_tool_provider.ags import AccessTokenCache, AgsError, Score, publish_scores, token_cache
+from django_lti_tool_provider.executor import BackgroundExecutor
+from django_lti_tool_provider.lti13 import jwt
+from django_lti_tool_provider.models import LtiUserData, OutcomeDeliveryLog, delivery_log_buffer
+from django_lti_tool_provider.tests.test_lti13 import CLIENT_ID, ISSUER, generate_key
+from django_lti_tool_provider.tests.utils import StubPlatformServer
+
+if jwt is not None:
+    from cryptography.hazmat.primitives import serialization
+
+
+class AgsTestMixin(object):
+    @classmethod
+    def setUpClass(cls):
+        super(AgsTestMixin, cls).setUpClass()
+        cls.tool_key = generate_key()
+        cls.tool_key_pem = cls.tool_key.private_bytes(
+            serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8, serialization.NoEncryption()
+        )
+
+    def start_platform(self, **kwargs):
+        self.platform = StubPlatformServer(**kwargs).start()
+        self.addCleanup(self.platform.stop)
+
+        platforms = {ISSUER: {'client_id': CLIENT_ID, 'auth_token_url': self.platform.token_url}}
+        settings_override = override_settings(
+            LTI13_PLATFORMS=platforms, LTI13_TOOL_PRIVATE_KEY=self.tool_key_pem, LTI13_TOOL_KEY_ID='tool-key'
+        )
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def lineitem(self, number):
+        return self.platform.url_for('/lineitems/{}'.format(number))
+
+
+@skipIf(jwt is None, "PyJWT is not installed")
+class AccessTokenCacheTests(AgsTestMixin, SimpleTestCase):
+    def setUp(self):
+        self.start_platform()
+        self.executor = BackgroundExecutor(workers=1)
+        self.addCleanup(self.executor.shutdown)
+        self.tokens = AccessTokenCache(refresh_margin=60, min_validity=5, executor=self.executor)
+
+    def test_token_is_requested_once(self):
+        for _ in range(5):
+            self.assertEqual(self.tokens.get_token(ISSUER), 'token-1')
+        self.assertEqual(len(self.platform.tokens), 1)
+
+    def test_concurrent_requests_share_token(self):
+        tokens = []
+        threads = [threading.Thread(target=lambda: tokens.append(self.tokens.get_token(ISSUER))) for _ in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(tokens, ['token-1'] * 10)
+        self.assertEqual(len(self.platform.tokens), 1)
+
+    def test_token_is_refreshed_in_background_before_expiry(self):
+        self.platform.stop()
+        self.start_platform(token_lifetime=30)
+        self.tokens.get_token(ISSUER)
+
+        self.assertEqual(self.tokens.get_token(ISSUER), 'token-1')
+        self.executor.shutdown(wait=True)
+
+        self.assertEqual(self.tokens.get_token(ISSUER), 'token-2')
+
+    def test_expiring_token_is_not_used(self):
+        self.platform.stop()
+        self.start_platform(token_lifetime=3)
+
+        self.assertEqual(self.tokens.get_token(ISSUER), 'token-1')
+        self.assertEqual(self.tokens.get_token(ISSUER), 'token-2')
+
+    def test_client_assertion(self):
+        self.tokens.get_token(ISSUER)
+
+        _, _, body = self.platform.received[0]
+        request = {name: values[0] for name, values in parse_qs(body).items()}
+        self.assertEqual(request['grant_type'], 'client_credentials')
+        self.assertEqual(request['scope'], 'https://purl.imsglobal.org/spec/lti-ags/scope/score')
+        self.assertEqual(jwt.get_unverified_header(request['client_assertion'])['kid'], 'tool-key')
+        claims = jwt.decode(
+            request['client_assertion'], self.tool_key.public_key(), algorithms=['RS256'],
+            audience=self.platform.token_url
+        )
+        self.assertEqual(claims['iss'], CLIENT_ID)
+        self.assertEqual(claims['sub'], CLIENT_ID)
+
+    def test_platform_failure(self):
+        self.platform.fail = True
+        with self.assertRaises(AgsError):
+            self.tokens.get_token(ISSUER)
+
+
+@skipIf(jwt is None, "PyJWT is not installed")
+class PublishScoresTests(AgsTestMixin, SimpleTestCase):
+    def setUp(self):
+        self.start_platform()
+        self.tokens = AccessTokenCache()
+
+    def test_scores_are_batched_per_line_item(self):
+        scores = [Score(ISSUER, self.lineitem(index % 2), 'user-{}'.format(index), 0.5) for index in range(6)]
+
+        results = publish_scores(scores, self.tokens)
+
+        self.assertTrue(all(result.is_success() for result in results))
+        self.assertEqual(len(self.platform.scores), 6)
+        self.assertEqual(len(self.platform.tokens), 1)
+        # token request, then a single keep-alive connection for all score posts
+        self.assertEqual(self.platform.connections, 2)
+
+        path, document = self.platform.scores[0]
+        self.assertEqual(path, '/lineitems/0/scores')
+        self.assertEqual(document['userId'], 'user-0')
+        self.assertEqual(document['scoreGiven'], 0.5)
+        self.assertEqual(document['scoreMaximum'], 1.0)
+        self.assertEqual(document['gradingProgress'], 'FullyGraded')
+
+    def test_only_latest_score_of_user_is_posted(self):
+        scores = [Score(ISSUER, self.lineitem(1), 'user-1', grade) for grade in (0.1, 0.2, 0.3)]
+
+        results = publish_scores(scores, self.tokens)
+
+        self.assertEqual([document['scoreGiven'] for _, document in self.platform.scores], [0.3])
+        self.assertTrue(all(result.is_success() for result in results))
+
+    def test_line_item_with_query(self):
+        publish_scores([Score(ISSUER, self.lineitem(1) + '?type_id=1', 'user-1', 1)], self.tokens)
+        self.assertEqual(self.platform.scores[0][0], '/lineitems/1/scores?type_id=1')
+
+    def test_rejected_token_is_replaced(self):
+        publish_scores([Score(ISSUER, self.lineitem(1), 'user-1', 1)], self.tokens)
+        # token-1 is revoked
+        self.platform.tokens.append('token-issued-elsewhere')
+
+        result, = publish_scores([Score(ISSUER, self.lineitem(1), 'user-1', 1)], self.tokens)
+
+        self.assertTrue(result.is_success())
+        self.assertEqual(len(self.platform.scores), 2)
+        self.assertEqual(self.platform.tokens[-1], 'token-3')
+
+    def test_platform_failure(self):
+        self.platform.fail = True
+
+        result, = publish_scores([Score(ISSUER, self.lineitem(1), 'user-1', 1)], self.tokens)
+
+        self.assertFalse(result.is_success())
+        self.assertIsNone(result.status)
+
+
+@skipIf(jwt is None, "PyJWT is not installed")
+@override_settings(LTI_DELIVERY_LOG=True)
+class AgsGradeTests(AgsTestMixin, TestCase):
+    def setUp(self):
+        self.start_platform()
+        self.addCleanup(token_cache.clear)
+        user = User.objects.create(username='student')
+        self.lti_user_data = LtiUserData.objects.create(user=user, edx_lti_parameters={
+            'iss': ISSUER,
+            'user_id': 'lti-user-1',
+            'context_id': 'course-1',
+            'ags_endpoint': {'lineitem': self.lineitem(7)},
+        })
+
+    def test_send_lti_grade_publishes_score(self):
+        self.assertTrue(self.lti_user_data.uses_ags)
+
+        outcome = self.lti_user_data.send_lti_grade(0.75)
+        delivery_log_buffer.flush()
+
+        self.assertTrue(outcome.is_success())
+        path, document = self.platform.scores[0]
+        self.assertEqual(path, '/lineitems/7/scores')
+        self.assertEqual(document['userId'], 'lti-user-1')
+        self.assertEqual(document['scoreGiven'], 0.75)
+        log = OutcomeDeliveryLog.objects.get()
+        self.assertEqual(log.status, OutcomeDeliveryLog.SUCCESS)
+        self.assertEqual(log.outcome_service_host, '{}:{}'.format(*self.platform._server.server_address))
+
+    def test_grade_out_of_range(self):
+        with self.assertRaises(ValueError):
+            self.lti_user_data.send_lti_grade(1.5)
+        self.assertEqual(self.platform.scores, [])
@@ -0,0 +1,238 @@
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from django.db.models.query import QuerySet
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils import timezone
+from mock import Mock, patch
+from six import StringIO
+
+from django_lti_tool_provider.backends import (
+    DeliveryOutcome, HttpBackend, InMemoryBackend, OutboxBackend, deliver_outbox, get_outcome_backend
+)
+from django_lti_tool_provider.models import LtiUserData, OutcomeDeliveryLog, PendingGrade, delivery_log_buffer
+from django_lti_tool_provider.signals import Signals
+
+
+MEMORY_BACKEND = 'django_lti_tool_provider.backends.InMemoryBackend'
+OUTBOX_BACKEND = 'django_lti_tool_provider.backends.OutboxBackend'
+
+LTI_PARAMETERS = {
+    'lis_result_sourcedid': 'sourcedid',
+    'lis_outcome_service_url': 'https://lms.example.com/outcome',
+}
+
+
+class BackendTestMixin(object):
+    fixtures = ['test_lti_db.yaml']
+
+    def setUp(self):
+        super(BackendTestMixin, self).setUp()
+        self.user = User.objects.get(username='test1')
+        self.lti_user_data = LtiUserData.objects.create(user=self.user, edx_lti_parameters=LTI_PARAMETERS)
+        InMemoryBackend.clear()
+        self.addCleanup(InMemoryBackend.clear)
+
+
+@patch('django_lti_tool_provider.backends.tool_provider')
+class OutcomeBackendTest(BackendTestMixin, TestCase):
+    def test_http_backend_is_default(self, _):
+        self.assertIsInstance(get_outcome_backend(), HttpBackend)
+
+    def test_backend_is_selected_by_setting(self, _):
+        with override_settings(LTI_OUTCOME_BACKEND=MEMORY_BACKEND):
+            self.assertIsInstance(get_outcome_backend(), InMemoryBackend)
+            self.assertIs(get_outcome_backend(), get_outcome_backend())
+
+    @override_settings(LTI_OUTCOME_BACKEND=MEMORY_BACKEND)
+    def test_in_memory_backend_records_grades(self, tool_provider_constructor_mock):
+        outcome = self.lti_user_data.send_lti_grade(0.5)
+
+        self.assertTrue(outcome.is_success())
+        self.assertEqual(InMemoryBackend.outbox, [(self.lti_user_data, 0.5)])
+        tool_provider_constructor_mock.assert_not_called()
+
+    @override_settings(LTI_OUTCOME_BACKEND=MEMORY_BACKEND)
+    def test_grades_are_validated_before_backend(self, _):
+        with self.assertRaises(ValueError):
+            self.lti_user_data.send_lti_grade(2)
+
+        self.assertEqual(InMemoryBackend.outbox, [])
+
+    @override_settings(LTI_OUTCOME_BACKEND=MEMORY_BACKEND)
+    def test_ordered_grades_go_through_backend(self, _):
+        sequence = self.lti_user_data.next_grade_sequence()
+
+        self.lti_user_data.send_lti_grade(0.7, sequence=sequence)
+
+        self.assertEqual(InMemoryBackend.outbox, [(self.lti_user_data, 0.7)])
+        self.assertEqual(LtiUserData.objects.get(pk=self.lti_user_data.pk).delivered_grade_sequence, sequence)
+
+    @override_settings(LTI_OUTCOME_BACKEND=MEMORY_BACKEND)
+    def test_grade_updated_signal_goes_through_backend(self, _):
+        Signals.Grade.updated.send(__name__, user=self.user, grade=0.25, custom_key='')
+
+        self.assertEqual(InMemoryBackend.outbox, [(self.lti_user_data, 0.25)])
+
+    @override_settings(LTI_OUTCOME_BACKEND='django_lti_tool_provider.backends.NullBackend')
+    def test_null_backend_discards_grades(self, tool_provider_constructor_mock):
+        self.assertTrue(self.lti_user_data.send_lti_grade(0.5).is_success())
+        tool_provider_constructor_mock.assert_not_called()
+
+    def test_backend_argument_overrides_setting(self, _):
+        backend = Mock()
+        backend.send_grade.return_value = DeliveryOutcome(True, "sent")
+
+        self.lti_user_data.send_lti_grade(0.5, backend=backend)
+
+        backend.send_grade.assert_called_once_with(self.lti_user_data, 0.5)
+
+
+@override_settings(LTI_OUTCOME_BACKEND=OUTBOX_BACKEND, LTI_OUTBOX_DELIVERY_BACKEND=MEMORY_BACKEND)
+class OutboxTest(BackendTestMixin, TestCase):
+    def setUp(self):
+        super(OutboxTest, self).setUp()
+        self.other_lti_user_data = LtiUserData.objects.create(
+            user=User.objects.get(username='test2'), edx_lti_parameters=LTI_PARAMETERS
+        )
+
+    def test_grades_are_queued(self):
+        self.lti_user_data.send_lti_grade(0.5)
+
+        pending_grade = PendingGrade.objects.get()
+        self.assertEqual((pending_grade.lti_user_data, pending_grade.grade), (self.lti_user_data, 0.5))
+
+    @override_settings(LTI_DELIVERY_LOG=True)
+    def test_queued_grades_are_logged_as_queued(self):
+        self.addCleanup(delivery_log_buffer.flush)
+
+        self.lti_user_data.send_lti_grade(0.5)
+        delivery_log_buffer.flush()
+
+        self.assertEqual(OutcomeDeliveryLog.objects.get().status, OutcomeDeliveryLog.QUEUED)
+
+    def test_latest_grade_per_user_is_delivered(self):
+        for grade in (0.1, 0.2, 0.3):
+            self.lti_user_data.send_lti_grade(grade)
+        self.other_lti_user_data.send_lti_grade(0.9)
+
+        stats = deliver_outbox(batch_size=2)
+
+        self.assertEqual((stats.delivered, stats.superseded, stats.failed), (2, 2, 0))
+        self.assertEqual(
+            sorted(InMemoryBackend.outbox, key=lambda item: item[1]),
+            [(self.lti_user_data, 0.3), (self.other_lti_user_data, 0.9)]
+        )
+        self.assertFalse(PendingGrade.objects.exists())
+
+    def test_queued_grade_is_not_recorded_as_delivered(self):
+        sequence = self.lti_user_data.next_grade_sequence()
+
+        self.lti_user_data.send_lti_grade(0.5, sequence=sequence)
+
+        self.assertEqual(PendingGrade.objects.get().sequence, sequence)
+        self.assertEqual(LtiUserData.objects.get(pk=self.lti_user_data.pk).delivered_grade_sequence, 0)
+
+    def test_grade_with_highest_sequence_is_delivered(self):
+        older, newer = self.lti_user_data.next_grade_sequence(), self.lti_user_data.next_grade_sequence()
+        self.lti_user_data.send_lti_grade(0.9, sequence=newer)
+        # the older grade was computed first, but queued last
+        OutboxBackend().send_grade(self.lti_user_data, 0.4, sequence=older)
+
+        stats = deliver_outbox()
+
+        self.assertEqual((stats.delivered, stats.superseded), (1, 1))
+        self.assertEqual(InMemoryBackend.outbox, [(self.lti_user_data, 0.9)])
+        self.assertEqual(LtiUserData.objects.get(pk=self.lti_user_data.pk).delivered_grade_sequence, newer)
+
+    def test_grade_older_than_delivered_one_is_superseded(self):
+        self.lti_user_data.send_lti_grade(0.4, sequence=self.lti_user_data.next_grade_sequence())
+        # delivered meanwhile, e.g. by a worker configured with another backend
+        newer = self.lti_user_data.next_grade_sequence()
+        LtiUserData.objects.filter(pk=self.lti_user_data.pk).update(delivered_grade_sequence=newer)
+
+        stats = deliver_outbox()
+
+        self.assertEqual((stats.delivered, stats.superseded), (0, 1))
+        self.assertEqual(InMemoryBackend.outbox, [])
+        self.assertFalse(PendingGrade.objects.exists())
+
+    def test_failed_grades_stay_queued(self):
+        backend = Mock()
+        backend.send_grade.return_value = DeliveryOutcome(False, "rejected")
+        self.lti_user_data.send_lti_grade(0.5)
+
+        stats = deliver_outbox(backend=backend)
+
+        self.assertEqual(stats.failed, 1)
+        pending_grade = PendingGrade.objects.get()
+        self.assertEqual((pending_grade.attempts, pending_grade.last_error), (1, "rejected"))
+
+    def test_grades_are_dropped_after_max_attempts(self):
+        backend = Mock()
+        backend.send_grade.side_effect = IOError("connection refused")
+        self.lti_user_data.send_lti_grade(0.5)
+
+        deliver_outbox(backend=backend, max_attempts=2)
+        stats = deliver_outbox(backend=backend, max_attempts=2)
+
+        self.assertEqual(stats.dropped, 1)
+        self.assertFalse(PendingGrade.objects.exists())
+
+    def test_grade_claimed_by_another_run_is_skipped(self):
+        self.lti_user_data.send_lti_grade(0.5)
+        PendingGrade.objects.update(claimed_until=timezone.now() + timedelta(minutes=1))
+
+        stats = deliver_outbox()
+
+        self.assertEqual((stats.delivered, stats.skipped), (0, 1))
+        self.assertEqual(InMemoryBackend.outbox, [])
+        self.assertTrue(PendingGrade.objects.exists())
+
+    def test_expired_claim_is_taken_over(self):
+        self.lti_user_data.send_lti_grade(0.5)
+        PendingGrade.objects.update(claimed_until=timezone.now() - timedelta(minutes=1))
+
+        stats = deliver_outbox()
+
+        self.assertEqual(stats.delivered, 1)
+        self.assertEqual(InMemoryBackend.outbox, [(self.lti_user_data, 0.5)])
+
+    def test_failed_grade_claim_is_released(self):
+        backend = Mock()
+        backend.send_grade.return_value = DeliveryOutcome(False, "rejected")
+        self.lti_user_data.send_lti_grade(0.5)
+
+        deliver_outbox(backend=backend)
+
+        self.assertIsNone(PendingGrade.objects.get().claimed_until)
+
+    def test_missing_lti_user_data_does_not_abort_the_run(self):
+        self.lti_user_data.send_lti_grade(0.5)
+        self.other_lti_user_data.send_lti_grade(0.9)
+        # as if the record was not there yet on the database LtiUserData is read from
+        in_bulk = QuerySet.in_bulk
+        with patch.object(QuerySet, 'in_bulk', lambda queryset, ids: {
+            pk: record for pk, record in in_bulk(queryset, ids).items() if pk != self.lti_user_data.pk
+        }):
+            stats = deliver_outbox()
+
+        self.assertEqual((stats.delivered, stats.skipped), (1, 1))
+        self.assertEqual(InMemoryBackend.outbox, [(self.other_lti_user_data, 0.9)])
+        self.assertEqual(PendingGrade.objects.get().lti_user_data, self.lti_user_data)
+
+    def test_outbox_is_not_delivered_to_outbox(self):
+        with self.assertRaises(ImproperlyConfigured):
+            deliver_outbox(backend=OutboxBackend())
+
+    def test_deliver_lti_outbox_command(self):
+        self.lti_user_data.send_lti_grade(0.5)
+        out = StringIO()
+
+        call_command('deliver_lti_outbox', stdout=out)
+
+        self.assertIn('delivered: 1', out.getvalue())
+        self.assertEqual(InMemoryBackend.outbox, [(self.lti_user_data, 0.5)])
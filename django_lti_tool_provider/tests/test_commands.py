@@ -0,0 +1,235 @@
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext, override_settings
+from django.utils import timezone
+from mock import patch
+from six import StringIO
+
+from django_lti_tool_provider import retention
+from django_lti_tool_provider.models import LtiUserData
+
+
+TABLE = LtiUserData._meta.db_table
+
+
+class LtiUserDataTransferCommandsTest(TestCase):
+    fixtures = ['test_lti_db.yaml']
+
+    def setUp(self):
+        self.user1 = User.objects.get(username='test1')
+        self.user2 = User.objects.get(username='test2')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.tmp_dir)
+
+    def _path(self, name='lti_user_data.ndjson'):
+        return os.path.join(self.tmp_dir, name)
+
+    def _write_records(self, *records):
+        path = self._path()
+        with open(path, 'w') as stream:
+            for record in records:
+                stream.write((record if isinstance(record, str) else json.dumps(record)) + '\n')
+        return path
+
+    def _export(self, **options):
+        out = StringIO()
+        call_command('export_lti_user_data', stdout=out, stderr=StringIO(), **options)
+        return [json.loads(line) for line in out.getvalue().splitlines()]
+
+    def _import(self, path, **options):
+        out = StringIO()
+        call_command('import_lti_user_data', path, stdout=out, **options)
+        return out.getvalue()
+
+    def test_export_writes_one_record_per_line(self):
+        LtiUserData.objects.create(user=self.user1, custom_key='', edx_lti_parameters={'user_id': 'a'})
+        LtiUserData.objects.create(user=self.user2, custom_key='key', edx_lti_parameters={'user_id': 'b'})
+
+        records = self._export()
+
+        self.assertEqual(records, [
+            {'username': 'test1', 'custom_key': '', 'edx_lti_parameters': {'user_id': 'a'}},
+            {'username': 'test2', 'custom_key': 'key', 'edx_lti_parameters': {'user_id': 'b'}},
+        ])
+
+    def test_export_fetches_rows_in_chunks(self):
+        for index in range(5):
+            LtiUserData.objects.create(user=self.user1, custom_key=str(index))
+
+        with self.assertNumQueries(3):
+            records = self._export(chunk_size=2)
+
+        self.assertEqual([record['custom_key'] for record in records], ['0', '1', '2', '3', '4'])
+
+    def test_export_filters_by_custom_key_prefix(self):
+        LtiUserData.objects.create(user=self.user1, custom_key='course-1:a')
+        LtiUserData.objects.create(user=self.user1, custom_key='course-2:a')
+
+        records = self._export(custom_key_prefix='course-1')
+
+        self.assertEqual([record['custom_key'] for record in records], ['course-1:a'])
+
+    def test_export_import_round_trip(self):
+        for index in range(7):
+            LtiUserData.objects.create(
+                user=self.user1 if index % 2 else self.user2, custom_key=str(index),
+                edx_lti_parameters={'lis_result_sourcedid': 'sourcedid-{}'.format(index)}
+            )
+        path = self._path()
+        call_command('export_lti_user_data', output=path, stderr=StringIO())
+        expected = sorted(LtiUserData.objects.values_list('user__username', 'custom_key', 'edx_lti_parameters'))
+        LtiUserData.objects.all().delete()
+
+        self._import(path, batch_size=3)
+
+        actual = sorted(LtiUserData.objects.values_list('user__username', 'custom_key', 'edx_lti_parameters'))
+        self.assertEqual(actual, expected)
+
+    def test_import_uses_constant_number_of_queries_per_batch(self):
+        path = self._write_records(*[
+            {'username': 'test1', 'custom_key': str(index), 'edx_lti_parameters': {}} for index in range(10)
+        ])
+
+        # per batch: resolve users, find existing records, bulk insert (plus savepoint handling)
+        with self.assertNumQueries(2 * 5):
+            self._import(path, batch_size=5)
+
+        self.assertEqual(LtiUserData.objects.filter(user=self.user1).count(), 10)
+
+    def test_import_skips_unknown_users(self):
+        path = self._write_records(
+            {'username': 'test1', 'custom_key': 'a', 'edx_lti_parameters': {}},
+            {'username': 'nobody', 'custom_key': 'a', 'edx_lti_parameters': {}},
+        )
+
+        output = self._import(path)
+
+        self.assertIn('skipped with unknown user: 1', output)
+        self.assertEqual(list(LtiUserData.objects.values_list('user__username', flat=True)), ['test1'])
+
+    def test_import_keeps_existing_records_unless_update_requested(self):
+        LtiUserData.objects.create(user=self.user1, custom_key='a', edx_lti_parameters={'user_id': 'old'})
+        path = self._write_records({'username': 'test1', 'custom_key': 'a', 'edx_lti_parameters': {'user_id': 'new'}})
+
+        self._import(path)
+        self.assertEqual(LtiUserData.objects.get(user=self.user1, custom_key='a').edx_lti_parameters['user_id'], 'old')
+
+        self._import(path, update=True)
+        self.assertEqual(LtiUserData.objects.get(user=self.user1, custom_key='a').edx_lti_parameters['user_id'], 'new')
+
+    def test_import_rejects_malformed_records(self):
+        path = self._write_records({'username': 'test1'}, 'not json')
+
+        with self.assertRaises(CommandError):
+            self._import(path)
+
+
+class PruneLtiUserDataCommandTest(TestCase):
+    fixtures = ['test_lti_db.yaml']
+
+    TOTAL_ROWS = 5000
+    STALE_ROWS = 3000
+
+    def setUp(self):
+        self.user = User.objects.get(username='test1')
+        LtiUserData.objects.bulk_create([
+            LtiUserData(user=self.user, custom_key=str(index), edx_lti_parameters={'index': index})
+            for index in range(self.TOTAL_ROWS)
+        ])
+        # interleave stale and fresh records, so batches can't just delete a contiguous primary key range
+        stale_pks = LtiUserData.objects.order_by('?').values_list('pk', flat=True)[:self.STALE_ROWS]
+        LtiUserData.objects.filter(pk__in=list(stale_pks)).update(updated=timezone.now() - timedelta(days=100))
+
+    def _prune(self, **options):
+        out = StringIO()
+        with patch('django_lti_tool_provider.retention.time.sleep') as patched_sleep:
+            call_command('prune_lti_user_data', stdout=out, **options)
+        return out.getvalue(), patched_sleep
+
+    def test_prune_deletes_stale_records_in_throttled_batches(self):
+        output, patched_sleep = self._prune(days=30, batch_size=200, sleep=0.5)
+
+        self.assertIn("Deleted {} LtiUserData records".format(self.STALE_ROWS), output)
+        self.assertEqual(LtiUserData.objects.count(), self.TOTAL_ROWS - self.STALE_ROWS)
+        self.assertFalse(LtiUserData.objects.filter(updated__lt=timezone.now() - timedelta(days=30)).exists())
+        # 15 full batches, pausing between them
+        self.assertEqual(patched_sleep.call_count, self.STALE_ROWS // 200)
+        patched_sleep.assert_called_with(0.5)
+
+    def test_prune_uses_bounded_statements(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._prune(days=30, batch_size=1000, sleep=0)
+
+        # no statement lists more than a batch of primary keys, yet all stale records are deleted
+        id_lists = [
+            [int(pk) for pk in match.split(',')]
+            for query in queries for match in re.findall(r'"id" IN \(([\d, ]+)\)', query['sql'])
+        ]
+        self.assertTrue(id_lists)
+        self.assertLessEqual(max(len(pks) for pks in id_lists), 1000)
+        deleted_pks = set(
+            pk for query in queries if query['sql'].startswith('DELETE FROM "{}"'.format(TABLE))
+            for match in re.findall(r'"id" IN \(([\d, ]+)\)', query['sql']) for pk in match.split(',')
+        )
+        self.assertEqual(len(deleted_pks), self.STALE_ROWS)
+
+    def test_record_launched_during_pruning_is_kept_and_not_archived(self):
+        archive = StringIO()
+        relaunched = LtiUserData.objects.filter(updated__lt=timezone.now() - timedelta(days=30)).earliest('pk')
+        delete_batch = retention._delete_batch
+
+        def relaunch_then_delete_batch(*args):
+            # the record is launched after its batch was selected
+            relaunched.save()
+            return delete_batch(*args)
+
+        with patch('django_lti_tool_provider.retention._delete_batch', side_effect=relaunch_then_delete_batch):
+            deleted = retention.prune_lti_user_data(
+                timezone.now() - timedelta(days=30), batch_size=1000, sleep=0, archive_stream=archive
+            )
+
+        self.assertEqual(deleted, self.STALE_ROWS - 1)
+        self.assertTrue(LtiUserData.objects.filter(pk=relaunched.pk).exists())
+        archived_keys = [json.loads(line)['custom_key'] for line in archive.getvalue().splitlines()]
+        self.assertEqual(len(archived_keys), self.STALE_ROWS - 1)
+        self.assertNotIn(relaunched.custom_key, archived_keys)
+
+    def test_dry_run_only_counts(self):
+        output, _ = self._prune(days=30, dry_run=True)
+
+        self.assertIn("Found {} LtiUserData records".format(self.STALE_ROWS), output)
+        self.assertEqual(LtiUserData.objects.count(), self.TOTAL_ROWS)
+
+    def test_prune_archives_deleted_records(self):
+        tmp_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmp_dir)
+        archive = os.path.join(tmp_dir, 'archive.ndjson')
+
+        self._prune(days=30, batch_size=700, archive=archive)
+
+        with open(archive) as stream:
+            records = [json.loads(line) for line in stream]
+        self.assertEqual(len(records), self.STALE_ROWS)
+        remaining_keys = set(LtiUserData.objects.values_list('custom_key', flat=True))
+        self.assertFalse(remaining_keys & set(record['custom_key'] for record in records))
+
+    @override_settings(LTI_USER_DATA_RETENTION_DAYS=365)
+    def test_retention_period_defaults_to_setting(self):
+        output, _ = self._prune()
+
+        self.assertIn("Deleted 0 LtiUserData records", output)
+        self.assertEqual(LtiUserData.objects.count(), self.TOTAL_ROWS)
+
+    def test_missing_retention_period_is_an_error(self):
+        with self.assertRaises(CommandError):
+            self._prune()
@@ -0,0 +1,138 @@
+import threading
+
+from django.contrib.auth import SESSION_KEY, authenticate, login
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client, TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from django_lti_tool_provider.dedupe import NOT_CLAIMED, LaunchOutcome, LaunchRegistry, launch_registry
+from django_lti_tool_provider.tests.test_views import LtiRequestsTestBase
+
+
+class LaunchRegistryTest(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.registry = LaunchRegistry(wait=1, poll_interval=0.01)
+        self.key = LaunchRegistry.launch_key('nonce', 'user')
+
+    def test_first_claim_wins(self):
+        self.assertIsNone(self.registry.claim(self.key))
+
+    def test_duplicate_waits_for_outcome(self):
+        self.registry.claim(self.key)
+        outcome = LaunchOutcome(1, None, '/home')
+        timer = threading.Timer(0.05, self.registry.complete, (self.key, outcome))
+        timer.start()
+        self.addCleanup(timer.join)
+
+        self.assertEqual(self.registry.claim(self.key).location, '/home')
+
+    def test_released_key_can_be_claimed_again(self):
+        self.registry.claim(self.key)
+        self.registry.release(self.key)
+
+        self.assertIsNone(self.registry.claim(self.key))
+
+    def test_duplicate_gives_up_waiting(self):
+        self.registry.wait = 0.05
+        self.registry.claim(self.key)
+
+        self.assertEqual(self.registry.claim(self.key), NOT_CLAIMED)
+
+    def test_claim_does_not_spin_on_cache_refusing_add(self):
+        # e.g. a dummy cache, or the key evicted between add() and get() every time
+        self.registry.wait = 60
+        with patch.object(LaunchRegistry, 'cache') as registry_cache:
+            registry_cache.add.return_value = False
+            registry_cache.get.return_value = None
+
+            self.assertEqual(self.registry.claim(self.key), NOT_CLAIMED)
+
+        self.assertEqual(registry_cache.add.call_count, LaunchRegistry.MAX_MISSES)
+
+
+@patch('django_lti_tool_provider.views.send_lti_received')
+class LaunchDedupeTest(LtiRequestsTestBase):
+    def setUp(self):
+        super(LaunchDedupeTest, self).setUp()
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.hook_manager.authentication_hook.side_effect = self._login
+        self.hook_manager.authenticated_redirect_to.return_value = '/course'
+        self.hook_manager.anonymous_redirect_to.return_value = '/login'
+
+    @staticmethod
+    def _login(request, username=None, **kwargs):
+        if not User.objects.filter(username=username).exists():
+            User.objects.create_user(username=username, password='password')
+        login(request, authenticate(request, username=username, password='password'))
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    def test_duplicate_launch_reuses_outcome(self, send_lti_received):
+        payload = self.get_correct_lti_payload()
+        second_client = Client()
+
+        self.send_lti_request(payload)
+        response = self.send_lti_request(payload, client=second_client)
+
+        self._verify_redirected_to(response, '/course')
+        self.assertEqual(self.hook_manager.authentication_hook.call_count, 1)
+        self.assertEqual(send_lti_received.call_count, 1)
+        user = User.objects.get(username=self._data['lis_person_sourcedid'])
+        self.assertEqual(second_client.session[SESSION_KEY], str(user.pk))
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    def test_forged_copy_of_launch_is_rejected(self, send_lti_received):
+        payload = self.get_correct_lti_payload()
+        forged_client = Client()
+        # same nonce, signature and user_id as the original, other parameters changed
+        forged_payload = payload.replace('LTI-101', 'LTI-666')
+        self.assertNotEqual(forged_payload, payload)
+
+        self.send_lti_request(payload)
+        response = self.send_lti_request(forged_payload, client=forged_client)
+
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn(SESSION_KEY, forged_client.session)
+        self.assertEqual(send_lti_received.call_count, 1)
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    def test_launch_not_owning_its_key_leaves_it_alone(self, send_lti_received):
+        with patch.object(launch_registry, 'claim', return_value=NOT_CLAIMED), \
+                patch.object(launch_registry, 'complete') as complete, \
+                patch.object(launch_registry, 'release') as release:
+            response = self.send_lti_request(self.get_correct_lti_payload())
+
+        self._verify_redirected_to(response, '/course')
+        self.assertEqual(send_lti_received.call_count, 1)
+        complete.assert_not_called()
+        release.assert_not_called()
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    def test_different_launches_are_not_deduplicated(self, send_lti_received):
+        self.send_lti_request(self.get_correct_lti_payload())
+        self.send_lti_request(self.get_correct_lti_payload(), client=Client())
+
+        self.assertEqual(send_lti_received.call_count, 2)
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    def test_anonymous_launch_is_not_recorded(self, _):
+        self.hook_manager.authentication_hook.side_effect = None
+        payload = self.get_correct_lti_payload()
+
+        self.send_lti_request(payload)
+        response = self.send_lti_request(payload, client=Client())
+
+        self._verify_redirected_to(response, '/login')
+        self.assertEqual(self.hook_manager.anonymous_redirect_to.call_count, 2)
+
+    def test_dedupe_is_disabled_by_default(self, send_lti_received):
+        payload = self.get_correct_lti_payload()
+
+        self.send_lti_request(payload)
+        self.send_lti_request(payload, client=Client())
+
+        self.assertEqual(send_lti_received.call_count, 2)
@@ -0,0 +1,157 @@
+from django.contrib.auth.models import User
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+
+from django_lti_tool_provider import AbstractApplicationHookManager
+from django_lti_tool_provider.backends import InMemoryBackend
+from django_lti_tool_provider.endpoints import EndpointCache, endpoint_cache
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.signals import Signals
+
+
+OUTCOME_URL = 'https://lms.example.com/outcome'
+
+
+class EndpointCacheTest(TestCase):
+    def setUp(self):
+        self.cache = EndpointCache(max_size=2)
+        self.users = [User.objects.create(username='learner{}'.format(index)) for index in range(3)]
+        for index, user in enumerate(self.users):
+            LtiUserData.objects.create(user=user, custom_key='key', edx_lti_parameters={
+                'lis_result_sourcedid': 'sourcedid-{}'.format(index),
+                'lis_outcome_service_url': OUTCOME_URL + '?course=1',
+                'context_id': 'course-1',
+                'lis_person_name_full': 'Learner {}'.format(index),
+                'roles': 'Learner',
+            })
+
+    def test_endpoint_holds_delivery_fields(self):
+        endpoint = self.cache.get(self.users[0].pk, 'key')
+
+        self.assertEqual(endpoint.parameters(), {
+            'lis_result_sourcedid': 'sourcedid-0',
+            'lis_outcome_service_url': OUTCOME_URL + '?course=1',
+            'context_id': 'course-1',
+        })
+        lti_user_data = endpoint.to_lti_user_data()
+        self.assertEqual(lti_user_data.pk, LtiUserData.objects.get(user=self.users[0]).pk)
+        self.assertEqual((lti_user_data.user_id, lti_user_data.custom_key), (self.users[0].pk, 'key'))
+
+    def test_cached_endpoint_needs_no_query(self):
+        self.cache.get(self.users[0].pk, 'key')
+
+        with self.assertNumQueries(0):
+            self.cache.get(self.users[0].pk, 'key')
+
+    def test_shared_strings_are_interned(self):
+        first, second = self.cache.get(self.users[0].pk, 'key'), self.cache.get(self.users[1].pk, 'key')
+
+        self.assertIs(first.outcome_url, second.outcome_url)
+        self.assertIs(first.context_id, second.context_id)
+
+    def test_least_recently_used_endpoint_is_evicted(self):
+        self.cache.get(self.users[0].pk, 'key')
+        self.cache.get(self.users[1].pk, 'key')
+        self.cache.get(self.users[0].pk, 'key')
+        self.cache.get(self.users[2].pk, 'key')
+
+        self.assertEqual(len(self.cache), 2)
+        with self.assertNumQueries(0):
+            self.cache.get(self.users[0].pk, 'key')
+        with self.assertNumQueries(1):
+            self.cache.get(self.users[1].pk, 'key')
+
+    def test_expired_endpoint_is_reloaded(self):
+        self.cache.ttl = 0
+        self.cache.get(self.users[0].pk, 'key')
+
+        with self.assertNumQueries(1):
+            self.cache.get(self.users[0].pk, 'key')
+
+    def test_endpoint_invalidated_while_loading_is_not_cached(self):
+        user_id = self.users[0].pk
+        load = self.cache._load  # pylint: disable=protected-access
+
+        def _load_racing_with_invalidation(*args):
+            endpoint = load(*args)
+            self.cache.invalidate(user_id, 'key')
+            return endpoint
+
+        with patch.object(self.cache, '_load', side_effect=_load_racing_with_invalidation):
+            self.cache.get(user_id, 'key')
+
+        self.assertEqual(len(self.cache), 0)
+        with self.assertNumQueries(1):
+            self.cache.get(user_id, 'key')
+
+    def test_invalidating_other_endpoint_does_not_prevent_caching(self):
+        self.cache.invalidate(self.users[1].pk, 'key')
+        self.cache.get(self.users[0].pk, 'key')
+
+        with self.assertNumQueries(0):
+            self.cache.get(self.users[0].pk, 'key')
+
+    def test_missing_record(self):
+        with self.assertRaises(LtiUserData.DoesNotExist):
+            self.cache.get(self.users[0].pk, 'other key')
+
+    def test_ags_endpoint(self):
+        LtiUserData.objects.filter(user=self.users[0]).update(edx_lti_parameters={
+            'iss': 'https://platform.example.com', 'user_id': 'sub-0',
+            'ags_endpoint': {'lineitem': 'https://platform.example.com/lineitems/1', 'scope': []},
+        })
+
+        lti_user_data = self.cache.get(self.users[0].pk, 'key').to_lti_user_data()
+
+        self.assertTrue(lti_user_data.uses_ags)
+        self.assertEqual(lti_user_data.edx_lti_parameters['user_id'], 'sub-0')
+
+
+@override_settings(LTI_OUTCOME_BACKEND='django_lti_tool_provider.backends.InMemoryBackend')
+class GradeDeliveryWithEndpointCacheTest(TestCase):
+    def setUp(self):
+        self.user = User.objects.create(username='learner')
+        self.lti_user_data = LtiUserData.objects.create(user=self.user, custom_key='key', edx_lti_parameters={
+            'user_id': 'lti-user', 'lis_result_sourcedid': 'sourcedid', 'lis_outcome_service_url': OUTCOME_URL,
+        })
+        for name, value in (('max_size', 10), ('ttl', 300)):
+            patcher = patch.object(endpoint_cache, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.addCleanup(endpoint_cache.clear)
+        InMemoryBackend.clear()
+        self.addCleanup(InMemoryBackend.clear)
+
+    def _send_grade(self, grade):
+        Signals.Grade.updated.send(__name__, user=self.user, grade=grade, custom_key='key')
+
+    def test_grades_are_delivered_from_cached_endpoint(self):
+        self._send_grade(0.5)
+        self._send_grade(0.75)
+
+        self.assertEqual([grade for _, grade in InMemoryBackend.outbox], [0.5, 0.75])
+        lti_user_data = InMemoryBackend.outbox[-1][0]
+        self.assertEqual(lti_user_data.pk, self.lti_user_data.pk)
+        self.assertEqual(LtiUserData.objects.get(pk=self.lti_user_data.pk).delivered_grade_sequence, 2)
+
+    def test_store_lti_parameters_invalidates_endpoint(self):
+        self._send_grade(0.5)
+        hook_manager = Mock(spec=AbstractApplicationHookManager)
+        hook_manager.vary_by_key.return_value = 'key'
+        LtiUserData.store_lti_parameters(self.user, hook_manager, {
+            'user_id': 'lti-user', 'lis_result_sourcedid': 'new sourcedid', 'lis_outcome_service_url': OUTCOME_URL,
+        })
+
+        self._send_grade(0.75)
+
+        self.assertEqual(InMemoryBackend.outbox[-1][0].edx_lti_parameters['lis_result_sourcedid'], 'new sourcedid')
+
+    def test_failed_delivery_invalidates_endpoint(self):
+        endpoint_cache.get(self.user.pk, 'key')
+
+        with patch.object(InMemoryBackend, 'send_grade', side_effect=IOError("connection refused")):
+            with self.assertRaises(IOError):
+                self._send_grade(0.5)
+
+        self.assertEqual(len(endpoint_cache), 0)
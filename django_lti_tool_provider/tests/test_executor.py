@@ -0,0 +1,61 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from django_lti_tool_provider.executor import BackgroundExecutor
+
+
+class BackgroundExecutorTests(SimpleTestCase):
+    def setUp(self):
+        self.executor = BackgroundExecutor(workers=1)
+        self.addCleanup(self.executor.shutdown)
+
+    def test_submit_returns_handle_with_result(self):
+        task = self.executor.submit(lambda x, y=0: x + y, 40, y=2)
+        self.assertEqual(task.result(timeout=5), 42)
+        self.assertTrue(task.done())
+        self.assertIsNone(task.exception())
+
+    def test_task_exception_is_captured_and_reraised(self):
+        def fail():
+            raise ZeroDivisionError()
+
+        task = self.executor.submit(fail)
+        self.assertIsInstance(task.exception(timeout=5), ZeroDivisionError)
+        with self.assertRaises(ZeroDivisionError):
+            task.result()
+
+    def test_submit_does_not_wait_for_task(self):
+        release = threading.Event()
+        task = self.executor.submit(release.wait)
+
+        self.assertFalse(task.wait(timeout=0.05))
+        self.assertFalse(task.done())
+        with self.assertRaises(RuntimeError):
+            task.result(timeout=0.01)
+
+        release.set()
+        self.assertTrue(task.wait(timeout=5))
+
+    def test_single_worker_runs_tasks_in_submission_order(self):
+        calls = []
+        tasks = [self.executor.submit(calls.append, index) for index in range(20)]
+        for task in tasks:
+            task.wait(timeout=5)
+        self.assertEqual(calls, list(range(20)))
+
+    def test_shutdown_completes_submitted_tasks(self):
+        calls = []
+        for index in range(5):
+            self.executor.submit(calls.append, index)
+        self.executor.shutdown(wait=True)
+        self.assertEqual(calls, list(range(5)))
+
+    def test_initializer_runs_in_each_worker_thread(self):
+        threads = []
+        executor = BackgroundExecutor(workers=2, initializer=lambda: threads.append(threading.current_thread()))
+        executor.submit(lambda: None).wait(5)
+        executor.shutdown()
+
+        self.assertEqual(len(set(threads)), 2)
+        self.assertNotIn(threading.current_thread(), threads)
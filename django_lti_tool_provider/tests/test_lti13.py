@@ -0,0 +1,317 @@
+import json
+import time
+from unittest import skipIf
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, authenticate, login
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import Client, SimpleTestCase, TestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+from six.moves.urllib.parse import parse_qs, urlparse
+
+from django_lti_tool_provider import AbstractApplicationHookManager
+from django_lti_tool_provider.executor import BackgroundExecutor
+from django_lti_tool_provider.lti13 import (
+    LTI_CLAIM, JwksCache, Lti13LaunchError, Lti13LaunchView, claims_to_parameters, jwt, jwks_cache
+)
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.tests.utils import StubPlatformServer
+
+if jwt is not None:
+    from cryptography.hazmat.backends import default_backend
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    from jwt.algorithms import RSAAlgorithm
+
+
+ISSUER = 'https://platform.example.com'
+CLIENT_ID = 'tool-client-id'
+
+
+def generate_key():
+    return rsa.generate_private_key(public_exponent=65537, key_size=2048, backend=default_backend())
+
+
+def public_jwk(private_key, kid):
+    jwk = json.loads(RSAAlgorithm.to_jwk(private_key.public_key()))
+    jwk.update({'kid': kid, 'use': 'sig', 'alg': 'RS256'})
+    return jwk
+
+
+def launch_claims(nonce='nonce', **overrides):
+    now = int(time.time())
+    claims = {
+        'iss': ISSUER,
+        'aud': CLIENT_ID,
+        'sub': 'lti-user-1',
+        'iat': now,
+        'exp': now + 300,
+        'nonce': nonce,
+        'email': 'student@example.com',
+        LTI_CLAIM + 'version': '1.3.0',
+        LTI_CLAIM + 'message_type': 'LtiResourceLinkRequest',
+        LTI_CLAIM + 'deployment_id': 'deployment-1',
+        LTI_CLAIM + 'roles': ['http://purl.imsglobal.org/vocab/lis/v2/membership#Learner'],
+        LTI_CLAIM + 'resource_link': {'id': 'resource-1', 'title': 'Quiz'},
+        LTI_CLAIM + 'context': {'id': 'course-1'},
+        LTI_CLAIM + 'lis': {'person_sourcedid': 'student'},
+        LTI_CLAIM + 'custom': {'level': 'hard'},
+    }
+    claims.update(overrides)
+    return claims
+
+
+def sign(claims, private_key, kid):
+    return jwt.encode(claims, private_key, algorithm='RS256', headers={'kid': kid})
+
+
+@skipIf(jwt is None, "PyJWT is not installed")
+class JwksCacheTests(SimpleTestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(JwksCacheTests, cls).setUpClass()
+        cls.key, cls.rotated_key = generate_key(), generate_key()
+
+    def setUp(self):
+        self.platform = StubPlatformServer(jwks={'keys': [public_jwk(self.key, 'k1')]}).start()
+        self.addCleanup(self.platform.stop)
+        self.executor = BackgroundExecutor(workers=1)
+        self.addCleanup(self.executor.shutdown)
+        self.cache = JwksCache(max_age=3600, min_refresh_interval=10, executor=self.executor)
+
+    def test_keys_are_fetched_once(self):
+        for _ in range(5):
+            key = self.cache.get_key(self.platform.jwks_url, 'k1')
+
+        self.assertEqual(key.public_numbers(), self.key.public_key().public_numbers())
+        self.assertEqual(len(self.platform.received), 1)
+
+    def test_unknown_key_id_refetches_key_set(self):
+        self.cache.min_refresh_interval = 0
+        self.cache.get_key(self.platform.jwks_url, 'k1')
+        self.platform.jwks = {'keys': [public_jwk(self.key, 'k1'), public_jwk(self.rotated_key, 'k2')]}
+
+        key = self.cache.get_key(self.platform.jwks_url, 'k2')
+
+        self.assertEqual(key.public_numbers(), self.rotated_key.public_key().public_numbers())
+        self.assertEqual(len(self.platform.received), 2)
+
+    def test_unknown_key_id_refetches_are_rate_limited(self):
+        self.cache.get_key(self.platform.jwks_url, 'k1')
+        for _ in range(3):
+            with self.assertRaises(Lti13LaunchError):
+                self.cache.get_key(self.platform.jwks_url, 'made-up')
+
+        self.assertEqual(len(self.platform.received), 1)
+
+    def test_stale_key_set_is_served_and_refreshed_in_background(self):
+        self.cache.max_age = 0
+        self.cache.get_key(self.platform.jwks_url, 'k1')
+        self.platform.jwks = {'keys': [public_jwk(self.rotated_key, 'k2')]}
+
+        key = self.cache.get_key(self.platform.jwks_url, 'k1')
+        self.executor.shutdown(wait=True)
+
+        self.assertEqual(key.public_numbers(), self.key.public_key().public_numbers())
+        self.assertEqual(len(self.platform.received), 2)
+        self.cache.max_age = 3600
+        self.assertIsNotNone(self.cache.get_key(self.platform.jwks_url, 'k2'))
+        with self.assertRaises(Lti13LaunchError):
+            self.cache.get_key(self.platform.jwks_url, 'k1')
+
+    def test_failed_refresh_keeps_cached_keys(self):
+        self.cache.get_key(self.platform.jwks_url, 'k1')
+        self.platform.fail = True
+
+        self.assertFalse(self.cache.refresh(self.platform.jwks_url))
+        self.assertIsNotNone(self.cache.get_key(self.platform.jwks_url, 'k1'))
+
+    def test_unreachable_platform(self):
+        self.platform.fail = True
+        with self.assertRaises(Lti13LaunchError):
+            self.cache.get_key(self.platform.jwks_url, 'k1')
+
+
+@skipIf(jwt is None, "PyJWT is not installed")
+class ClaimsToParametersTests(SimpleTestCase):
+    def test_claims_are_flattened_to_lti_parameters(self):
+        parameters = claims_to_parameters(launch_claims())
+
+        self.assertEqual(parameters['user_id'], 'lti-user-1')
+        self.assertEqual(parameters['client_id'], CLIENT_ID)
+        self.assertEqual(parameters['iss'], ISSUER)
+        self.assertEqual(parameters['resource_link_id'], 'resource-1')
+        self.assertEqual(parameters['resource_link_title'], 'Quiz')
+        self.assertEqual(parameters['context_id'], 'course-1')
+        self.assertEqual(parameters['lis_person_sourcedid'], 'student')
+        self.assertEqual(parameters['lis_person_contact_email_primary'], 'student@example.com')
+        self.assertEqual(parameters['custom_level'], 'hard')
+        self.assertEqual(parameters['lti_version'], '1.3.0')
+        self.assertNotIn('context_title', parameters)
+
+
+@skipIf(jwt is None, "PyJWT is not installed")
+class Lti13LaunchTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(Lti13LaunchTests, cls).setUpClass()
+        cls.key = generate_key()
+
+    def setUp(self):
+        self.platform = StubPlatformServer(jwks={'keys': [public_jwk(self.key, 'k1')]}).start()
+        self.addCleanup(self.platform.stop)
+        self.addCleanup(jwks_cache.clear)
+
+        platforms = {ISSUER: {
+            'client_id': CLIENT_ID,
+            'auth_login_url': 'https://platform.example.com/auth',
+            'jwks_url': self.platform.jwks_url,
+            'deployment_ids': ['deployment-1'],
+        }}
+        settings_override = override_settings(LTI13_PLATFORMS=platforms)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+        self.client = Client()
+        self.hook_manager = Mock(spec=AbstractApplicationHookManager)
+        self.hook_manager.vary_by_key = Mock(return_value=None)
+        self.hook_manager.optional_lti_parameters = Mock(return_value={})
+        self.hook_manager.authentication_hook.side_effect = self._authenticate
+        self.hook_manager.authenticated_redirect_to.return_value = '/home'
+        Lti13LaunchView.register_authentication_manager(self.hook_manager)
+
+    def _authenticate(self, request, user_id=None, username=None, email=None, **kwargs):
+        User.objects.create_user(username, email=email, password='1234')
+        login(request, authenticate(request, username=username, password='1234'))
+
+    def _login(self):
+        response = self.client.get('/lti13/login/', {
+            'iss': ISSUER, 'login_hint': 'hint', 'target_link_uri': 'http://testserver/lti13/launch/'
+        })
+        self.assertEqual(response.status_code, 302)
+        redirect = urlparse(response.url)
+        self.assertEqual(redirect.netloc, 'platform.example.com')
+        query = {name: values[0] for name, values in parse_qs(redirect.query).items()}
+        self.assertEqual(query['client_id'], CLIENT_ID)
+        self.assertEqual(query['redirect_uri'], 'http://testserver/lti13/launch/')
+        self.assertEqual(query['response_mode'], 'form_post')
+        return query['state'], query['nonce']
+
+    def _launch(self, id_token, state):
+        return self.client.post('/lti13/launch/', {'id_token': id_token, 'state': state})
+
+    @patch('django_lti_tool_provider.signals.Signals.LTI.received.send')
+    def test_launch(self, patched_send_lti_received):
+        state, nonce = self._login()
+
+        response = self._launch(sign(launch_claims(nonce), self.key, 'k1'), state)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '/home')
+        _, hook_data = self.hook_manager.authentication_hook.call_args
+        self.assertEqual(hook_data['user_id'], 'lti-user-1')
+        self.assertEqual(hook_data['username'], 'student')
+        self.assertEqual(hook_data['email'], 'student@example.com')
+
+        lti_user_data = LtiUserData.objects.get(user__username='student')
+        self.assertEqual(lti_user_data.edx_lti_parameters['user_id'], 'lti-user-1')
+        self.assertEqual(lti_user_data.edx_lti_parameters['resource_link_id'], 'resource-1')
+        self.assertTrue(patched_send_lti_received.called)
+
+    @patch('django_lti_tool_provider.signals.Signals.LTI.received.send')
+    def test_returning_launch_needs_no_key_fetch(self, _):
+        for _ in range(3):
+            state, nonce = self._login()
+            response = self._launch(sign(launch_claims(nonce), self.key, 'k1'), state)
+            self.assertEqual(response.status_code, 302)
+
+        self.assertEqual(self.hook_manager.authentication_hook.call_count, 1)
+        self.assertEqual(len(self.platform.received), 1)
+
+    def test_launch_signed_with_unknown_key_is_rejected(self):
+        state, nonce = self._login()
+        response = self._launch(sign(launch_claims(nonce), generate_key(), 'k1'), state)
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(self.hook_manager.authentication_hook.called)
+
+    def test_launch_for_other_client_is_rejected(self):
+        state, nonce = self._login()
+        response = self._launch(sign(launch_claims(nonce, aud='other-tool'), self.key, 'k1'), state)
+        self.assertEqual(response.status_code, 400)
+
+    def test_launch_from_unknown_deployment_is_rejected(self):
+        state, nonce = self._login()
+        claims = launch_claims(nonce, **{LTI_CLAIM + 'deployment_id': 'deployment-2'})
+        response = self._launch(sign(claims, self.key, 'k1'), state)
+        self.assertEqual(response.status_code, 400)
+
+    def test_launch_with_wrong_nonce_is_rejected(self):
+        state, _ = self._login()
+        response = self._launch(sign(launch_claims('other nonce'), self.key, 'k1'), state)
+        self.assertEqual(response.status_code, 400)
+
+    @patch('django_lti_tool_provider.signals.Signals.LTI.received.send')
+    def test_launch_cannot_be_replayed(self, _):
+        state, nonce = self._login()
+        id_token = sign(launch_claims(nonce), self.key, 'k1')
+        self.assertEqual(self._launch(id_token, state).status_code, 302)
+
+        self.client = Client()
+        self.assertEqual(self._launch(id_token, state).status_code, 400)
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    @patch('django_lti_tool_provider.signals.Signals.LTI.received.send')
+    def test_double_submitted_launch_reuses_outcome(self, patched_send_lti_received):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        state, nonce = self._login()
+        id_token = sign(launch_claims(nonce), self.key, 'k1')
+        self.assertEqual(self._launch(id_token, state).status_code, 302)
+
+        # the copy's id_token is verified, but its nonce was spent by the original
+        response = self._launch(id_token, state)
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(response.url, '/home')
+        self.assertEqual(self.hook_manager.authentication_hook.call_count, 1)
+        self.assertEqual(patched_send_lti_received.call_count, 1)
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    @patch('django_lti_tool_provider.signals.Signals.LTI.received.send')
+    def test_concurrent_copy_of_launch_reuses_outcome(self, patched_send_lti_received):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        state, nonce = self._login()
+        id_token = sign(launch_claims(nonce), self.key, 'k1')
+        # sent before the original's response cycled the session - with the session cookie of the login
+        copy_client = Client()
+        copy_client.cookies[settings.SESSION_COOKIE_NAME] = self.client.cookies[settings.SESSION_COOKIE_NAME].value
+        self.assertEqual(self._launch(id_token, state).status_code, 302)
+
+        response = copy_client.post('/lti13/launch/', {'id_token': id_token, 'state': state})
+
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.hook_manager.authentication_hook.call_count, 1)
+        self.assertEqual(patched_send_lti_received.call_count, 1)
+
+    @override_settings(LTI_LAUNCH_DEDUPE=True)
+    @patch('django_lti_tool_provider.signals.Signals.LTI.received.send')
+    def test_copy_of_launch_from_other_session_is_rejected(self, _):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        state, nonce = self._login()
+        id_token = sign(launch_claims(nonce), self.key, 'k1')
+        self.assertEqual(self._launch(id_token, state).status_code, 302)
+
+        other_client = Client()
+        response = other_client.post('/lti13/launch/', {'id_token': id_token, 'state': state})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertNotIn(SESSION_KEY, other_client.session)
+
+    def test_login_from_unknown_platform_is_rejected(self):
+        response = self.client.get('/lti13/login/', {
+            'iss': 'https://unknown.example.com', 'login_hint': 'hint', 'target_link_uri': 'http://testserver/'
+        })
+        self.assertEqual(response.status_code, 400)
@@ -1,16 +1,24 @@
+from datetime import timedelta
+
 import ddt
 from django.contrib.auth.models import User
+from django.core.signals import request_finished
 from django.db import transaction, IntegrityError
 
 from django.test import TestCase
 from django.test.utils import override_settings
-from mock import patch
+from django.utils import timezone
+from mock import Mock, patch
+
+from django_lti_tool_provider import AbstractApplicationHookManager
 
-from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.buffers import BulkInsertBuffer
+from django_lti_tool_provider.models import LtiUserData, OutcomeDeliveryLog, delivery_log_buffer
+from django_lti_tool_provider.tests.utils import StubLmsServer
 
 
 @ddt.ddt
-@patch('django_lti_tool_provider.models.DjangoToolProvider')
+@patch('django_lti_tool_provider.backends.tool_provider')
 class LtiUserDataTest(TestCase):
     minimal_valid_lti_parameters = {
         'lis_result_sourcedid': 'result-sourced-id',
@@ -66,6 +74,16 @@ class LtiUserDataDatabaseTest(TestCase):
         self.user1 = User.objects.get(username='test1')
         self.user2 = User.objects.get(username='test2')
 
+    def test_store_lti_parameters_bumps_updated_timestamp(self):
+        hook_manager = Mock(spec=AbstractApplicationHookManager)
+        hook_manager.vary_by_key.return_value = None
+        lti_user_data = LtiUserData.store_lti_parameters(self.user1, hook_manager, {'user_id': 'abc'})
+        LtiUserData.objects.filter(pk=lti_user_data.pk).update(updated=timezone.now() - timedelta(days=10))
+
+        LtiUserData.store_lti_parameters(self.user1, hook_manager, {'user_id': 'abc'})
+
+        self.assertGreater(LtiUserData.objects.get(pk=lti_user_data.pk).updated, timezone.now() - timedelta(days=1))
+
     def test_user_and_custom_key_uniqueness(self):
         LtiUserData.objects.create(user=self.user1)  # works
         LtiUserData.objects.create(user=self.user2)  # works
@@ -86,4 +104,320 @@ class LtiUserDataDatabaseTest(TestCase):
             LtiUserData.objects.create(user=self.user2)  # unique key exception
 
         with self.assertRaises(IntegrityError), transaction.atomic():
-            LtiUserData.objects.create(user=self.user2, custom_key="456")  # unique key exception
\ No newline at end of file
+            LtiUserData.objects.create(user=self.user2, custom_key="456")  # unique key exception
+
+
+class LtiUserDataStubLmsTest(TestCase):
+    def _make_model(self, outcome_service_url):
+        return LtiUserData(edx_lti_parameters={
+            'lis_result_sourcedid': 'result-sourced-id',
+            'lis_outcome_service_url': outcome_service_url,
+        })
+
+    def test_send_lti_grade_posts_replace_result_to_outcome_service(self):
+        with StubLmsServer() as lms:
+            outcome = self._make_model(lms.url).send_lti_grade(0.75)
+
+        self.assertTrue(outcome.is_success())
+        self.assertEqual(len(lms.received), 1)
+        path, body = lms.received[0]
+        self.assertEqual(path, '/outcome')
+        self.assertIn('replaceResultRequest', body)
+        self.assertIn('<textString>0.75</textString>', body)
+
+    def test_send_lti_grade_reports_lms_failure(self):
+        with StubLmsServer(fail=True) as lms:
+            outcome = self._make_model(lms.url).send_lti_grade(0.5)
+
+        self.assertFalse(outcome.is_success())
+
+
+@override_settings(LTI_DELIVERY_LOG=True)
+@patch('django_lti_tool_provider.backends.tool_provider')
+class OutcomeDeliveryLogTest(TestCase):
+    fixtures = ['test_lti_db.yaml']
+
+    def setUp(self):
+        self.user = User.objects.get(username='test1')
+        self.lti_user_data = LtiUserData.objects.create(user=self.user, custom_key='key', edx_lti_parameters={
+            'lis_result_sourcedid': 'sourcedid',
+            'lis_outcome_service_url': 'https://lms.example.com/outcome',
+            'context_id': 'course-v1:X+Y+Z',
+        })
+        self.addCleanup(setattr, delivery_log_buffer, 'batch_size', delivery_log_buffer.batch_size)
+        self.addCleanup(setattr, delivery_log_buffer, 'flush_interval', delivery_log_buffer.flush_interval)
+        delivery_log_buffer.batch_size, delivery_log_buffer.flush_interval = 100, 3600
+        self.addCleanup(delivery_log_buffer.flush)
+
+    @staticmethod
+    def _set_outcome(tool_provider_constructor_mock, success, description='description'):
+        outcome = tool_provider_constructor_mock.return_value.post_replace_result.return_value
+        outcome.is_success.return_value = success
+        outcome.description = description
+
+    def test_send_lti_grade_buffers_log_entry(self, tool_provider_constructor_mock):
+        self._set_outcome(tool_provider_constructor_mock, True, 'Score stored')
+
+        self.lti_user_data.send_lti_grade(0.5)
+
+        self.assertFalse(OutcomeDeliveryLog.objects.exists())
+        delivery_log_buffer.flush()
+        entry = OutcomeDeliveryLog.objects.get()
+        self.assertEqual(entry.user, self.user)
+        self.assertEqual(entry.custom_key, 'key')
+        self.assertEqual(entry.context_id, 'course-v1:X+Y+Z')
+        self.assertEqual(entry.outcome_service_host, 'lms.example.com')
+        self.assertEqual(entry.grade, 0.5)
+        self.assertEqual(entry.status, OutcomeDeliveryLog.SUCCESS)
+        self.assertEqual(entry.description, 'Score stored')
+
+    def test_send_lti_grade_logs_rejected_grade(self, tool_provider_constructor_mock):
+        self._set_outcome(tool_provider_constructor_mock, False)
+
+        self.lti_user_data.send_lti_grade(0.5)
+        delivery_log_buffer.flush()
+
+        self.assertEqual(OutcomeDeliveryLog.objects.get().status, OutcomeDeliveryLog.FAILURE)
+
+    def test_send_lti_grade_logs_delivery_error(self, tool_provider_constructor_mock):
+        tool_provider_constructor_mock.return_value.post_replace_result.side_effect = IOError("connection refused")
+
+        with self.assertRaises(IOError):
+            self.lti_user_data.send_lti_grade(0.5)
+        delivery_log_buffer.flush()
+
+        entry = OutcomeDeliveryLog.objects.get()
+        self.assertEqual(entry.status, OutcomeDeliveryLog.ERROR)
+        self.assertIn("connection refused", entry.description)
+
+    @override_settings(LTI_DELIVERY_LOG=False)
+    def test_log_is_disabled_by_setting(self, tool_provider_constructor_mock):
+        self._set_outcome(tool_provider_constructor_mock, True)
+
+        self.lti_user_data.send_lti_grade(0.5)
+
+        self.assertEqual(len(delivery_log_buffer), 0)
+
+    def test_entries_are_inserted_in_batches(self, tool_provider_constructor_mock):
+        self._set_outcome(tool_provider_constructor_mock, True)
+        delivery_log_buffer.batch_size = 5
+
+        with self.assertNumQueries(0):
+            for _ in range(4):
+                self.lti_user_data.send_lti_grade(1)
+        # the test runs in a transaction - the full batch is inserted once it commits
+        with self.assertNumQueries(0), patch('django_lti_tool_provider.buffers.transaction.on_commit') as on_commit:
+            self.lti_user_data.send_lti_grade(1)
+        self.assertEqual(len(delivery_log_buffer), 5)
+
+        # a single INSERT, in a savepoint
+        with self.assertNumQueries(3):
+            on_commit.call_args[0][0]()
+
+        self.assertEqual(OutcomeDeliveryLog.objects.count(), 5)
+        self.assertEqual(len(delivery_log_buffer), 0)
+
+    def test_deferred_batch_stays_buffered_on_rollback(self, tool_provider_constructor_mock):
+        self._set_outcome(tool_provider_constructor_mock, True)
+        delivery_log_buffer.batch_size = 2
+
+        try:
+            with transaction.atomic():
+                self.lti_user_data.send_lti_grade(1)
+                self.lti_user_data.send_lti_grade(1)
+                raise RuntimeError()
+        except RuntimeError:
+            pass
+
+        self.assertEqual(len(delivery_log_buffer), 2)
+        self.assertFalse(OutcomeDeliveryLog.objects.exists())
+
+    def test_buffer_is_flushed_at_the_end_of_request(self, tool_provider_constructor_mock):
+        self._set_outcome(tool_provider_constructor_mock, True)
+        self.lti_user_data.send_lti_grade(1)
+
+        request_finished.send(sender=self.__class__)
+
+        self.assertEqual(OutcomeDeliveryLog.objects.count(), 1)
+
+    def test_failed_flush_is_logged_and_dropped(self, _):
+        delivery_log_buffer.add(OutcomeDeliveryLog(user_id=None, grade=1, status=OutcomeDeliveryLog.SUCCESS))
+
+        with patch('django_lti_tool_provider.buffers._logger.exception') as patched_log_exception:
+            self.assertEqual(delivery_log_buffer.flush(), 0)
+
+        patched_log_exception.assert_called_once()
+        self.assertEqual(len(delivery_log_buffer), 0)
+
+    def test_stats_by_course_and_host(self, _):
+        def entry(context_id, host, status, latency_ms):
+            return OutcomeDeliveryLog(
+                user=self.user, context_id=context_id, outcome_service_host=host, grade=1, status=status,
+                latency_ms=latency_ms
+            )
+
+        OutcomeDeliveryLog.objects.bulk_create([
+            entry('course-1', 'lms-a', OutcomeDeliveryLog.SUCCESS, 100),
+            entry('course-1', 'lms-a', OutcomeDeliveryLog.FAILURE, 300),
+            entry('course-1', 'lms-b', OutcomeDeliveryLog.SUCCESS, 200),
+            entry('course-2', 'lms-b', OutcomeDeliveryLog.ERROR, 1000),
+        ])
+
+        by_course = {row['context_id']: row for row in OutcomeDeliveryLog.objects.stats_by_course()}
+        self.assertEqual(by_course['course-1']['total'], 3)
+        self.assertEqual(by_course['course-1']['succeeded'], 2)
+        self.assertAlmostEqual(by_course['course-1']['success_rate'], 2 / 3.0)
+        self.assertEqual(by_course['course-1']['avg_latency_ms'], 200)
+        self.assertEqual(by_course['course-2']['success_rate'], 0)
+        self.assertEqual(by_course['course-2']['max_latency_ms'], 1000)
+
+        by_host = {row['outcome_service_host']: row for row in OutcomeDeliveryLog.objects.stats_by_host()}
+        self.assertEqual(by_host['lms-a']['success_rate'], 0.5)
+        self.assertEqual(by_host['lms-b']['total'], 2)
+
+        since = OutcomeDeliveryLog.objects.since(timezone.now() + timedelta(minutes=1)).stats_by_host()
+        self.assertEqual(list(since), [])
+
+
+class BulkInsertBufferRoutingTest(TestCase):
+    multi_db = True
+
+    def test_batch_is_inserted_in_a_savepoint_on_the_write_database(self):
+        user = User.objects.db_manager('replica').create(username='routed')
+        buffer = BulkInsertBuffer(OutcomeDeliveryLog)
+        buffer.add(OutcomeDeliveryLog(user=user, grade=1, status=OutcomeDeliveryLog.SUCCESS, latency_ms=1))
+
+        with patch('django_lti_tool_provider.buffers.router.db_for_write', return_value='replica'), \
+                self.assertNumQueries(0), self.assertNumQueries(3, using='replica'):
+            self.assertEqual(buffer.flush(), 1)
+
+        self.assertEqual(OutcomeDeliveryLog.objects.using('replica').count(), 1)
+
+
+@patch('django_lti_tool_provider.backends.tool_provider')
+class OrderedGradeDeliveryTest(TestCase):
+    fixtures = ['test_lti_db.yaml']
+
+    def setUp(self):
+        self.lti_user_data = LtiUserData.objects.create(
+            user=User.objects.get(username='test1'), custom_key='key',
+            edx_lti_parameters={'lis_result_sourcedid': 'sourcedid', 'lis_outcome_service_url': 'http://lms/outcome'}
+        )
+
+    def _worker_copy(self):
+        """ Same record, as loaded by another grade worker """
+        return LtiUserData.objects.get(pk=self.lti_user_data.pk)
+
+    @staticmethod
+    def _sent_grades(tool_provider_constructor_mock):
+        return [call[0][0] for call in tool_provider_constructor_mock.return_value.post_replace_result.call_args_list]
+
+    def test_next_grade_sequence_is_monotonic_across_instances(self, _):
+        sequences = [self.lti_user_data.next_grade_sequence(), self._worker_copy().next_grade_sequence(),
+                     self.lti_user_data.next_grade_sequence()]
+
+        self.assertEqual(sequences, [1, 2, 3])
+        self.assertEqual(self._worker_copy().grade_sequence, 3)
+
+    def test_grade_with_latest_sequence_is_delivered(self, tool_provider_constructor_mock):
+        sequence = self.lti_user_data.next_grade_sequence()
+
+        outcome = self.lti_user_data.send_lti_grade(0.3, sequence=sequence)
+
+        self.assertIsNotNone(outcome)
+        self.assertEqual(self._sent_grades(tool_provider_constructor_mock), [0.3])
+        self.assertEqual(self._worker_copy().delivered_grade_sequence, sequence)
+
+    def test_older_grade_arriving_late_is_dropped(self, tool_provider_constructor_mock):
+        worker_a, worker_b = self.lti_user_data, self._worker_copy()
+        older = worker_a.next_grade_sequence()
+        newer = worker_b.next_grade_sequence()
+
+        worker_b.send_lti_grade(0.9, sequence=newer)
+        self.assertIsNone(worker_a.send_lti_grade(0.4, sequence=older))
+
+        self.assertEqual(self._sent_grades(tool_provider_constructor_mock), [0.9])
+
+    @override_settings(LTI_GRADE_DELIVERY_LEASE_WAIT=0)
+    def test_grade_is_not_posted_while_another_one_is_being_delivered(self, tool_provider_constructor_mock):
+        worker_a, worker_b = self.lti_user_data, self._worker_copy()
+        older = worker_a.next_grade_sequence()
+        newer_outcomes = []
+
+        def newer_grade_sent_meanwhile(grade):
+            if grade == 0.4:
+                newer_outcomes.append(worker_b.send_lti_grade(0.9, sequence=worker_b.next_grade_sequence()))
+            return Mock(is_success=Mock(return_value=True), description='')
+
+        tool_provider_constructor_mock.return_value.post_replace_result.side_effect = newer_grade_sent_meanwhile
+        worker_a.send_lti_grade(0.4, sequence=older)
+
+        self.assertFalse(newer_outcomes[0].is_success())
+        self.assertEqual(self._sent_grades(tool_provider_constructor_mock), [0.4])
+        stored = self._worker_copy()
+        self.assertEqual((stored.grade_sequence, stored.delivered_grade_sequence), (2, 1))
+        self.assertIsNone(stored.delivery_lease_until)
+
+    def test_superseded_grade_is_dropped_before_newer_one_is_sent(self, tool_provider_constructor_mock):
+        older = self.lti_user_data.next_grade_sequence()
+        newer = self._worker_copy().next_grade_sequence()
+
+        self.assertIsNone(self.lti_user_data.send_lti_grade(0.4, sequence=older))
+        self.lti_user_data.send_lti_grade(0.9, sequence=newer)
+
+        self.assertEqual(self._sent_grades(tool_provider_constructor_mock), [0.9])
+
+    def test_expired_delivery_lease_is_taken_over(self, tool_provider_constructor_mock):
+        # left behind by a worker that died while delivering
+        LtiUserData.objects.filter(pk=self.lti_user_data.pk).update(
+            delivery_lease_until=timezone.now() - timedelta(seconds=1)
+        )
+
+        outcome = self.lti_user_data.send_lti_grade(0.5, sequence=self.lti_user_data.next_grade_sequence())
+
+        self.assertTrue(outcome.is_success())
+        self.assertEqual(self._sent_grades(tool_provider_constructor_mock), [0.5])
+
+    def test_delivery_lease_is_released_when_posting_fails(self, tool_provider_constructor_mock):
+        tool_provider_constructor_mock.return_value.post_replace_result.side_effect = IOError('connection refused')
+
+        with self.assertRaises(IOError):
+            self.lti_user_data.send_lti_grade(0.5, sequence=self.lti_user_data.next_grade_sequence())
+
+        self.assertIsNone(self._worker_copy().delivery_lease_until)
+
+    def test_redelivery_of_same_sequence_is_dropped(self, tool_provider_constructor_mock):
+        sequence = self.lti_user_data.next_grade_sequence()
+        self.lti_user_data.send_lti_grade(0.5, sequence=sequence)
+
+        self.assertIsNone(self._worker_copy().send_lti_grade(0.5, sequence=sequence))
+        self.assertEqual(self._sent_grades(tool_provider_constructor_mock), [0.5])
+
+    def test_failed_delivery_can_be_retried(self, tool_provider_constructor_mock):
+        outcome = tool_provider_constructor_mock.return_value.post_replace_result.return_value
+        outcome.is_success.return_value = False
+        sequence = self.lti_user_data.next_grade_sequence()
+        self.lti_user_data.send_lti_grade(0.5, sequence=sequence)
+        self.assertEqual(self._worker_copy().delivered_grade_sequence, 0)
+
+        outcome.is_success.return_value = True
+        self.lti_user_data.send_lti_grade(0.5, sequence=sequence)
+        self.assertEqual(self._worker_copy().delivered_grade_sequence, sequence)
+
+    def test_sender_supplied_sequence_advances_counter(self, tool_provider_constructor_mock):
+        self.lti_user_data.send_lti_grade(0.5, sequence=1000)
+
+        self.assertEqual(self._worker_copy().grade_sequence, 1000)
+        self.assertIsNone(self.lti_user_data.send_lti_grade(0.1, sequence=999))
+        self.assertEqual(self._sent_grades(tool_provider_constructor_mock), [0.5])
+
+    def test_storing_lti_parameters_keeps_sequence_allocated_meanwhile(self, _):
+        hook_manager = Mock(spec=AbstractApplicationHookManager)
+        hook_manager.vary_by_key.return_value = 'key'
+        stale_copy = self._worker_copy()
+        self.lti_user_data.next_grade_sequence()
+
+        with patch.object(LtiUserData, 'get_or_create_by_parameters', return_value=(stale_copy, False)):
+            LtiUserData.store_lti_parameters(stale_copy.user, hook_manager, {'user_id': 'abc'})
+
+        self.assertEqual(self._worker_copy().grade_sequence, 1)
@@ -0,0 +1,51 @@
+from django.http import HttpResponse
+from django.test import RequestFactory
+from mock import patch
+
+from django_lti_tool_provider.pipeline import LaunchContext, run_stages
+from django_lti_tool_provider.tests.test_views import LtiRequestsTestBase
+from django_lti_tool_provider.views import LTIView
+
+
+class LaunchPipelineTest(LtiRequestsTestBase):
+    def setUp(self):
+        super(LaunchPipelineTest, self).setUp()
+        self.hook_manager.anonymous_redirect_to.return_value = '/login'
+
+    def test_stages_are_timed(self):
+        self.send_lti_request(self.get_correct_lti_payload())
+
+        request = self.hook_manager.anonymous_redirect_to.call_args[0][0]
+        self.assertEqual([stage for stage, _ in request.lti_launch_timings], list(LTIView.LAUNCH_STAGES))
+        self.assertTrue(all(seconds >= 0 for _, seconds in request.lti_launch_timings))
+
+    def test_stage_response_finishes_launch(self):
+        self.send_lti_request(self.get_incorrect_lti_payload())
+
+        self.hook_manager.authentication_hook.assert_not_called()
+
+    def test_stages_are_configurable(self):
+        def stage_cached(context):  # pylint: disable=unused-argument
+            return HttpResponse("cached launch")
+
+        with patch.object(LTIView, 'stage_cached', staticmethod(stage_cached), create=True), \
+                patch.object(LTIView, 'LAUNCH_STAGES', ('validate', 'cached', 'authenticate', 'redirect')):
+            response = self.send_lti_request(self.get_correct_lti_payload())
+
+        self.assertEqual(response.content, b"cached launch")
+        self.hook_manager.authentication_hook.assert_not_called()
+
+    def test_finish_callbacks_see_response(self):
+        context = LaunchContext(RequestFactory().get('/lti/'))
+        responses = []
+        context.on_finish(responses.append)
+
+        with patch.object(LTIView, 'stage_done', staticmethod(lambda context: HttpResponse()), create=True):
+            response = run_stages(LTIView, context, ('done',))
+
+        self.assertEqual(responses, [response])
+
+    def test_launch_without_response_is_an_error(self):
+        with patch.object(LTIView, 'stage_noop', staticmethod(lambda context: None), create=True):
+            with self.assertRaises(RuntimeError):
+                run_stages(LTIView, LaunchContext(RequestFactory().get('/lti/')), ('noop',))
@@ -0,0 +1,36 @@
+import json
+import os
+import subprocess
+import sys
+
+from django.test import SimpleTestCase
+
+import django_lti_tool_provider
+
+
+IMPORT_MODELS_SCRIPT = r"""
+import json
+import sys
+from django.conf import settings
+settings.configure(
+    INSTALLED_APPS=['django.contrib.auth', 'django.contrib.contenttypes', 'django_lti_tool_provider'],
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3'}},
+)
+import django
+django.setup()
+import django_lti_tool_provider.models
+import django_lti_tool_provider.views
+heavy_modules = ('ims_lti_py', 'oauth2', 'httplib2', 'lxml', 'jwt', 'cryptography')
+print(json.dumps([name for name in heavy_modules if name in sys.modules]))
+"""
+
+
+class LazyProtocolImportTests(SimpleTestCase):
+    def test_models_and_views_do_not_import_protocol_stack(self):
+        package_root = os.path.dirname(os.path.dirname(os.path.abspath(django_lti_tool_provider.__file__)))
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join([package_root] + sys.path)
+
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_MODELS_SCRIPT], env=env)
+
+        self.assertEqual(json.loads(output.decode('utf-8').strip().splitlines()[-1]), [])
@@ -0,0 +1,162 @@
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import SimpleTestCase, TransactionTestCase
+from django.test.utils import override_settings
+from mock import Mock, patch
+from six import StringIO
+
+from django_lti_tool_provider.backends import DeliveryOutcome, InMemoryBackend
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.executor import BackgroundExecutor
+from django_lti_tool_provider.resend import RateLimiter, resend_grades
+from django_lti_tool_provider.tests.utils import share_test_database_connection
+
+
+def half_grades(lti_user_data_batch):
+    return [0.5 for _ in lti_user_data_batch]
+
+
+@override_settings(LTI_OUTCOME_BACKEND='django_lti_tool_provider.backends.InMemoryBackend')
+class ResendGradesTest(TransactionTestCase):
+    def setUp(self):
+        InMemoryBackend.clear()
+        self.addCleanup(InMemoryBackend.clear)
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.checkpoint_path = os.path.join(self.directory, 'checkpoint.json')
+        # resend workers write to the database (ordered delivery takes a lease on the record) - one worker, as they
+        # share the connection
+        initializer = share_test_database_connection()
+        patcher = patch('django_lti_tool_provider.resend.BackgroundExecutor', lambda name, **kwargs: BackgroundExecutor(
+            workers=1, name=name, initializer=initializer
+        ))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.records = [self._lti_user_data(index, 'course-1') for index in range(5)]
+        self.other_course = self._lti_user_data(5, 'course-2')
+
+    @staticmethod
+    def _lti_user_data(index, context_id, custom_key=''):
+        user = User.objects.create(username='learner{}'.format(index))
+        return LtiUserData.objects.create(user=user, custom_key=custom_key, edx_lti_parameters={
+            'lis_result_sourcedid': 'sourcedid-{}'.format(index),
+            'lis_outcome_service_url': 'https://lms.example.com/outcome',
+            'context_id': context_id,
+        })
+
+    def _sent(self):
+        return sorted((lti_user_data.pk, grade) for lti_user_data, grade in InMemoryBackend.outbox)
+
+    def test_grades_of_the_course_are_resent_in_batches(self):
+        grade_function = Mock(side_effect=half_grades)
+
+        stats = resend_grades(grade_function, context_id='course-1', batch_size=2)
+
+        self.assertEqual(grade_function.call_count, 3)
+        self.assertEqual(self._sent(), [(record.pk, 0.5) for record in self.records])
+        self.assertEqual((stats.processed, stats.sent, stats.failed), (5, 5, 0))
+
+    def test_custom_key_prefix(self):
+        selected = self._lti_user_data(6, 'course-3', custom_key='block-v1:A+B+C@problem')
+
+        resend_grades(half_grades, custom_key_prefix='block-v1:A+B+C@')
+
+        self.assertEqual(self._sent(), [(selected.pk, 0.5)])
+
+    def test_none_grades_are_skipped(self):
+        stats = resend_grades(lambda batch: [None] * len(batch), context_id='course-1')
+
+        self.assertEqual(stats.skipped, 5)
+        self.assertEqual(InMemoryBackend.outbox, [])
+
+    def test_grades_superseded_meanwhile_are_skipped(self):
+        allocate = LtiUserData.next_grade_sequence
+
+        def allocated_then_superseded(lti_user_data):
+            sequence = allocate(lti_user_data)
+            # the app sent a newer grade before the resend got to send this one
+            LtiUserData.objects.get(pk=lti_user_data.pk).send_lti_grade(0.9, sequence=sequence + 1)
+            return sequence
+
+        with patch.object(LtiUserData, 'next_grade_sequence', allocated_then_superseded):
+            stats = resend_grades(half_grades, context_id='course-1')
+
+        self.assertEqual((stats.sent, stats.skipped, stats.failed), (0, 5, 0))
+        self.assertEqual(self._sent(), [(record.pk, 0.9) for record in self.records])
+
+    def test_roster_placeholders_are_left_out(self):
+        placeholder = self._lti_user_data(6, 'course-1')
+        placeholder.edx_lti_parameters[LtiUserData.PLACEHOLDER_PARAMETER] = True
+        placeholder.save()
+
+        stats = resend_grades(half_grades, context_id='course-1')
+
+        self.assertEqual(stats.processed, 5)
+        self.assertNotIn(placeholder.pk, [pk for pk, _ in self._sent()])
+
+    def test_failed_grades_are_counted(self):
+        backend = Mock()
+        backend.send_grade.return_value = DeliveryOutcome(False, "rejected")
+
+        stats = resend_grades(half_grades, context_id='course-1', backend=backend)
+
+        self.assertEqual((stats.sent, stats.failed), (0, 5))
+
+    def test_interrupted_resend_resumes_from_checkpoint(self):
+        def failing_on_second_batch(batch):
+            if batch[0].pk != self.records[0].pk:
+                raise KeyboardInterrupt()
+            return half_grades(batch)
+
+        with self.assertRaises(KeyboardInterrupt):
+            resend_grades(failing_on_second_batch, context_id='course-1', batch_size=2,
+                          checkpoint_path=self.checkpoint_path)
+        with open(self.checkpoint_path) as stream:
+            self.assertEqual(json.load(stream)['last_pk'], self.records[1].pk)
+        InMemoryBackend.clear()
+
+        stats = resend_grades(half_grades, context_id='course-1', batch_size=2, checkpoint_path=self.checkpoint_path)
+
+        self.assertEqual(self._sent(), [(record.pk, 0.5) for record in self.records[2:]])
+        self.assertEqual(stats.processed, 3)
+        self.assertFalse(os.path.exists(self.checkpoint_path))
+
+    def test_checkpoint_of_another_resend_is_rejected(self):
+        with open(self.checkpoint_path, 'w') as stream:
+            json.dump({'filters': {'context_id': 'course-2', 'custom_key_prefix': None}, 'last_pk': 1}, stream)
+
+        with self.assertRaises(ValueError):
+            resend_grades(half_grades, context_id='course-1', checkpoint_path=self.checkpoint_path)
+
+    def test_command(self):
+        out = StringIO()
+
+        call_command(
+            'resend_lti_grades', context_id='course-2', stdout=out, stderr=StringIO(),
+            grade_function='django_lti_tool_provider.tests.test_resend.half_grades'
+        )
+
+        self.assertIn('sent: 1', out.getvalue())
+        self.assertEqual(self._sent(), [(self.other_course.pk, 0.5)])
+
+    def test_command_requires_filter(self):
+        with self.assertRaises(CommandError):
+            call_command('resend_lti_grades', grade_function='django_lti_tool_provider.tests.test_resend.half_grades')
+
+
+class RateLimiterTest(SimpleTestCase):
+    def test_rate_is_limited(self):
+        limiter = RateLimiter(rate=50)
+
+        started = time.time()
+        for _ in range(6):
+            limiter.acquire()
+
+        self.assertGreaterEqual(time.time() - started, 0.09)
@@ -0,0 +1,265 @@
+from unittest import skipIf
+
+import ddt
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from mock import Mock, patch
+from six import StringIO
+
+from django_lti_tool_provider import AbstractApplicationHookManager
+from django_lti_tool_provider.ags import AccessTokenCache, token_cache
+from django_lti_tool_provider.lti13 import jwt
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.roster import iter_membership_pages, iter_roster_sources, sync_roster
+from django_lti_tool_provider.tests.test_ags import AgsTestMixin
+from django_lti_tool_provider.tests.test_lti13 import ISSUER
+from django_lti_tool_provider.views import LTIView
+
+
+def member(index, **overrides):
+    result = {
+        'user_id': 'lti-user-{}'.format(index),
+        'lis_person_sourcedid': 'student{}'.format(index),
+        'email': 'student{}@example.com'.format(index),
+        'given_name': 'Student',
+        'family_name': str(index),
+        'roles': ['http://purl.imsglobal.org/vocab/lis/v2/membership#Learner'],
+        'status': 'Active',
+    }
+    result.update(overrides)
+    return result
+
+
+@ddt.ddt
+@skipIf(jwt is None, "PyJWT is not installed")
+class RosterSyncTests(AgsTestMixin, TestCase):
+    def setUp(self):
+        self.start_platform(members=[member(index) for index in range(25)], page_size=10)
+        self.tokens = AccessTokenCache()
+        cache.clear()
+        self.addCleanup(cache.clear)
+
+        self.hook_manager = Mock(spec=AbstractApplicationHookManager)
+        self.hook_manager.roster_username.side_effect = lambda lti_data: lti_data['lis_person_sourcedid']
+        self.hook_manager.vary_by_key.return_value = None
+
+    def _sync(self, **kwargs):
+        return sync_roster(
+            ISSUER, self.platform.memberships_url, authentication_manager=self.hook_manager, tokens=self.tokens,
+            **kwargs
+        )
+
+    def _membership_requests(self):
+        return [path for method, path, _ in self.platform.received if path.startswith('/memberships')]
+
+    def test_sync_creates_users_and_lti_user_data(self):
+        stats = self._sync()
+
+        self.assertEqual((stats.pages, stats.members, stats.users_created), (3, 25, 25))
+        self.assertEqual(stats.lti_user_data_created, 25)
+        user = User.objects.get(username='student7')
+        self.assertEqual(user.email, 'student7@example.com')
+        self.assertFalse(user.has_usable_password())
+        lti_user_data = LtiUserData.objects.get(user=user, custom_key='')
+        self.assertEqual(lti_user_data.edx_lti_parameters['user_id'], 'lti-user-7')
+        self.assertEqual(lti_user_data.edx_lti_parameters['context_id'], 'course-1')
+        self.assertEqual(lti_user_data.edx_lti_parameters['iss'], ISSUER)
+
+    def test_pages_are_stored_in_bulk(self):
+        with CaptureQueriesContext(connection) as queries:
+            self._sync()
+
+        # a bulk insert of users and one of LtiUserData per page
+        inserts = [query['sql'] for query in queries if query['sql'].startswith('INSERT')]
+        self.assertEqual(len(inserts), 6)
+
+    def test_pages_are_fetched_lazily(self):
+        pages = iter_membership_pages(ISSUER, self.platform.memberships_url, tokens=self.tokens)
+
+        page = next(pages)
+
+        self.assertEqual(len(page.members), 10)
+        self.assertEqual(page.context['id'], 'course-1')
+        self.assertEqual(len(self._membership_requests()), 1)
+        self.assertEqual(sum(len(page.members) for page in pages), 15)
+
+    def test_unchanged_roster_is_not_stored_again(self):
+        self._sync()
+
+        with CaptureQueriesContext(connection) as queries:
+            stats = self._sync()
+
+        self.assertTrue(stats.unchanged)
+        self.assertEqual(stats.unchanged_pages, 3)
+        self.assertEqual(len(queries), 0)
+        self.assertEqual(len(self._membership_requests()), 6)
+
+    def test_change_on_a_later_page_is_synced(self):
+        self._sync()
+        self.platform.members = self.platform.members[:22] + [member(22, email='new@example.com')] + \
+            self.platform.members[23:]
+
+        stats = self._sync()
+
+        self.assertFalse(stats.unchanged)
+        self.assertEqual((stats.pages, stats.unchanged_pages, stats.users_updated), (1, 2, 1))
+        self.assertEqual(User.objects.get(username='student22').email, 'new@example.com')
+
+    def test_page_added_after_an_unchanged_full_page_is_synced(self):
+        self.platform.members = self.platform.members[:20]
+        self._sync()
+        self.platform.members = self.platform.members + [member(20)]
+
+        stats = self._sync()
+
+        self.assertEqual((stats.pages, stats.unchanged_pages, stats.users_created), (1, 2, 1))
+
+    def test_force_fetches_unchanged_roster(self):
+        self._sync()
+
+        stats = self._sync(force=True)
+
+        self.assertEqual((stats.pages, stats.users_created, stats.lti_user_data_created), (3, 0, 0))
+
+    def test_changed_roster_updates_users(self):
+        self._sync()
+        self.platform.members = [member(0, email='new@example.com')] + self.platform.members[1:] + [member(25)]
+
+        stats = self._sync()
+
+        self.assertEqual((stats.users_created, stats.users_updated), (1, 1))
+        self.assertEqual(User.objects.get(username='student0').email, 'new@example.com')
+        self.assertEqual(LtiUserData.objects.count(), 26)
+
+    def test_launch_parameters_are_not_overwritten(self):
+        user = User.objects.create(username='student3')
+        launch_parameters = {'user_id': 'lti-user-3', 'lis_outcome_service_url': 'http://lms/outcome'}
+        LtiUserData.objects.create(user=user, edx_lti_parameters=launch_parameters)
+
+        self._sync()
+
+        self.assertEqual(LtiUserData.objects.get(user=user).edx_lti_parameters, launch_parameters)
+
+    def test_user_linked_by_launch_is_updated(self):
+        user = User.objects.create(username='student3', email='old@example.com')
+        LtiUserData.objects.create(user=user, custom_key='resource', edx_lti_parameters={
+            'iss': ISSUER, 'user_id': 'lti-user-3',
+        })
+
+        stats = self._sync()
+
+        self.assertEqual((stats.users_updated, stats.conflicts), (1, 0))
+        self.assertEqual(User.objects.get(username='student3').email, 'student3@example.com')
+        self.assertTrue(LtiUserData.objects.filter(user=user, custom_key='').exists())
+
+    @ddt.data(
+        None,
+        {'iss': ISSUER, 'user_id': 'someone else'},
+        {'iss': 'https://other-platform.example.com', 'user_id': 'lti-user-3'},
+    )
+    def test_unlinked_user_with_same_username_is_left_alone(self, lti_parameters):
+        user = User.objects.create(username='student3', email='admin@example.com')
+        if lti_parameters is not None:
+            LtiUserData.objects.create(user=user, custom_key='resource', edx_lti_parameters=lti_parameters)
+
+        with patch('django_lti_tool_provider.roster._logger.warning') as patched_warning:
+            stats = self._sync()
+
+        self.assertEqual((stats.conflicts, stats.users_updated, stats.users_created), (1, 0, 24))
+        patched_warning.assert_called_once()
+        self.assertEqual(User.objects.get(username='student3').email, 'admin@example.com')
+        self.assertFalse(LtiUserData.objects.filter(user=user, custom_key='').exists())
+
+    def test_inactive_members_are_skipped(self):
+        self.platform.members = [member(1), member(2, status='Inactive'), member(3, status='Deleted')]
+
+        stats = self._sync()
+
+        self.assertEqual((stats.members, stats.skipped, stats.users_created), (3, 2, 1))
+        self.assertFalse(User.objects.filter(username='student2').exists())
+
+    def test_custom_key_of_placeholders(self):
+        self.hook_manager.vary_by_key.side_effect = lambda lti_data: lti_data['context_id']
+
+        self._sync()
+
+        self.assertEqual(LtiUserData.objects.filter(custom_key='course-1').count(), 25)
+
+    def test_placeholders_get_default_custom_key_without_resource_link(self):
+        # member parameters carry no resource link - a key derived from it comes out empty
+        self.hook_manager.vary_by_key.side_effect = lambda lti_data: lti_data.get('resource_link_id')
+
+        self._sync()
+
+        self.assertEqual(LtiUserData.objects.filter(custom_key='').count(), 25)
+
+    def test_explicit_custom_key_of_placeholders(self):
+        self._sync(custom_key='block-v1:A+B+C@problem')
+
+        self.hook_manager.vary_by_key.assert_not_called()
+        self.assertEqual(LtiUserData.objects.filter(custom_key='block-v1:A+B+C@problem').count(), 25)
+
+    def test_placeholders_are_marked(self):
+        self._sync()
+
+        lti_user_data = LtiUserData.objects.get(user__username='student7')
+        self.assertTrue(lti_user_data.is_placeholder)
+        lti_user_data.edx_lti_parameters = {'iss': ISSUER, 'user_id': 'lti-user-7'}
+        self.assertFalse(lti_user_data.is_placeholder)
+
+    def test_default_roster_username(self):
+        hook_manager = Mock(spec=AbstractApplicationHookManager)
+        self.assertEqual(
+            AbstractApplicationHookManager.roster_username(hook_manager, {'user_id': 'u', 'lis_person_sourcedid': 's'}),
+            's'
+        )
+        self.assertEqual(AbstractApplicationHookManager.roster_username(hook_manager, {'user_id': 'u'}), 'u')
+
+    def test_roster_sources_from_launch_parameters(self):
+        nrps = {'context_memberships_url': self.platform.memberships_url}
+        for index in range(3):
+            user = User.objects.create(username='launched{}'.format(index))
+            LtiUserData.objects.create(user=user, edx_lti_parameters={
+                'iss': ISSUER, 'context_id': 'course-1', 'names_role_service': nrps
+            })
+        LtiUserData.objects.create(user=User.objects.create(username='lti11'), edx_lti_parameters={'user_id': '1'})
+
+        self.assertEqual(
+            list(iter_roster_sources()), [(ISSUER, self.platform.memberships_url, 'course-1')]
+        )
+
+
+@skipIf(jwt is None, "PyJWT is not installed")
+class SyncLtiRosterCommandTest(AgsTestMixin, TestCase):
+    def setUp(self):
+        self.start_platform(members=[member(index) for index in range(3)])
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.addCleanup(token_cache.clear)
+        self.addCleanup(setattr, LTIView, 'authentication_manager', LTIView.authentication_manager)
+        LTIView.authentication_manager = Mock(spec=AbstractApplicationHookManager)
+        LTIView.authentication_manager.roster_username.side_effect = lambda lti_data: lti_data['user_id']
+        LTIView.authentication_manager.vary_by_key.return_value = None
+
+    def test_syncs_rosters_of_stored_launches(self):
+        LtiUserData.objects.create(user=User.objects.create(username='teacher'), edx_lti_parameters={
+            'iss': ISSUER, 'names_role_service': {'context_memberships_url': self.platform.memberships_url}
+        })
+        out = StringIO()
+
+        call_command('sync_lti_roster', stdout=out)
+
+        self.assertIn('users created: 3', out.getvalue())
+        self.assertEqual(User.objects.filter(username__startswith='lti-user-').count(), 3)
+
+    def test_custom_key_option(self):
+        call_command(
+            'sync_lti_roster', url=self.platform.memberships_url, issuer=ISSUER, custom_key='resource',
+            stdout=StringIO()
+        )
+
+        self.assertEqual(LtiUserData.objects.filter(custom_key='resource').count(), 3)
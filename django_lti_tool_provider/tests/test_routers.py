@@ -0,0 +1,140 @@
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.signals import request_started
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import ANY, Mock, patch
+
+from django_lti_tool_provider import AbstractApplicationHookManager
+from django_lti_tool_provider.endpoints import EndpointCache
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.routers import LtiReplicaRouter, is_pinned, pin_to_primary, read_database_alias, unpin
+from django_lti_tool_provider.signals import _send_grade
+
+
+@override_settings(LTI_READ_DATABASE='replica', LTI_READ_DATABASE_PIN_SECONDS=5)
+class ReadReplicaRoutingTest(TestCase):
+    multi_db = True
+    fixtures = ['test_lti_db.yaml']
+
+    def setUp(self):
+        unpin()
+        self.addCleanup(unpin)
+        cache.clear()
+        self.addCleanup(cache.clear)
+        self.user = User.objects.get(username='test1')
+        self.hook_manager = Mock(spec=AbstractApplicationHookManager)
+        self.hook_manager.vary_by_key.return_value = 'key'
+
+    def _create_on(self, database, user_id):
+        return LtiUserData.objects.using(database).create(
+            user=self.user, custom_key='key', edx_lti_parameters={
+                'user_id': user_id, 'lis_result_sourcedid': database, 'lis_outcome_service_url': 'http://lms',
+            }
+        )
+
+    def test_reads_go_to_primary_when_replica_is_not_configured(self):
+        with override_settings(LTI_READ_DATABASE=None):
+            self.assertIsNone(read_database_alias())
+
+    def test_launch_time_lookup_reads_replica(self):
+        self._create_on('replica', 'lti-user')
+        unpin()
+
+        lti_user_data, created = LtiUserData.get_or_create_by_parameters(
+            self.user, self.hook_manager, {'user_id': 'lti-user'}, create=False
+        )
+
+        self.assertFalse(created)
+        self.assertEqual(lti_user_data._state.db, 'replica')
+        self.assertFalse(LtiUserData.objects.using('default').exists())
+
+    def test_send_grade_lookup_reads_replica(self):
+        self._create_on('default', 'lti-user')
+        self._create_on('replica', 'lti-user')
+        unpin()
+
+        with patch('django_lti_tool_provider.models.LtiUserData.send_lti_grade', autospec=True) as send_lti_grade:
+            _send_grade(self.user, 0.5, 'key')
+
+        lti_user_data = send_lti_grade.call_args[0][0]
+        self.assertEqual(lti_user_data.edx_lti_parameters['lis_result_sourcedid'], 'replica')
+
+    def _sent_sourcedid(self):
+        with patch('django_lti_tool_provider.models.LtiUserData.send_lti_grade', autospec=True) as send_lti_grade:
+            _send_grade(self.user, 0.5, 'key')
+        return send_lti_grade.call_args[0][0].edx_lti_parameters['lis_result_sourcedid']
+
+    def test_grade_lookup_falls_back_to_primary(self):
+        # replica lags behind: it does not have the record yet
+        self._create_on('default', 'lti-user')
+        unpin()
+
+        self.assertEqual(self._sent_sourcedid(), 'default')
+
+    def test_grade_lookup_reads_primary_after_record_was_stored_elsewhere(self):
+        self._create_on('replica', 'lti-user')
+        LtiUserData.store_lti_parameters(self.user, self.hook_manager, {
+            'user_id': 'lti-user', 'lis_result_sourcedid': 'new launch', 'lis_outcome_service_url': 'http://lms',
+        })
+        # the grade is sent by another thread (or process), which is not pinned
+        unpin()
+
+        self.assertEqual(self._sent_sourcedid(), 'new launch')
+        self.assertEqual(EndpointCache(max_size=1).get(self.user.pk, 'key').sourcedid, 'new launch')
+
+    def test_grade_lookup_reads_replica_once_record_pin_expires(self):
+        self._create_on('default', 'lti-user')
+        self._create_on('replica', 'lti-user')
+        with patch('django_lti_tool_provider.routers.caches') as patched_caches:
+            LtiUserData.store_lti_parameters(self.user, self.hook_manager, {'user_id': 'lti-user'})
+            patched_caches.__getitem__.return_value.set.assert_called_once_with(ANY, True, 5)
+        unpin()
+
+        self.assertEqual(self._sent_sourcedid(), 'replica')
+
+    def test_reads_after_own_write_go_to_primary(self):
+        # replica lags behind: it does not have the record the primary just got
+        LtiUserData.store_lti_parameters(self.user, self.hook_manager, {'user_id': 'lti-user'})
+
+        self.assertTrue(is_pinned())
+        lti_user_data, _ = LtiUserData.get_or_create_by_parameters(
+            self.user, self.hook_manager, {'user_id': 'lti-user'}, create=False
+        )
+        self.assertEqual(lti_user_data._state.db, 'default')
+
+    def test_pin_expires(self):
+        with patch('django_lti_tool_provider.routers.time.time', return_value=1000):
+            pin_to_primary()
+            self.assertIsNone(read_database_alias())
+        with patch('django_lti_tool_provider.routers.time.time', return_value=1006):
+            self.assertEqual(read_database_alias(), 'replica')
+
+    def test_pin_is_cleared_when_next_request_starts(self):
+        pin_to_primary()
+
+        request_started.send(sender=self.__class__)
+
+        self.assertEqual(read_database_alias(), 'replica')
+
+    def test_router_routes_only_lti_models(self):
+        router = LtiReplicaRouter()
+
+        self.assertEqual(router.db_for_read(LtiUserData), 'replica')
+        self.assertIsNone(router.db_for_read(User))
+
+    def test_only_lti_model_writes_pin(self):
+        self.user.save()
+        self.assertFalse(is_pinned())
+
+        self._create_on("default", "lti-user")
+        self.assertTrue(is_pinned())
+        self.assertIsNone(LtiReplicaRouter().db_for_read(LtiUserData))
+
+    @override_settings(DATABASE_ROUTERS=['django_lti_tool_provider.routers.LtiReplicaRouter'])
+    def test_router_routes_queryset_reads(self):
+        self._create_on('replica', 'lti-user')
+        unpin()  # the test wrote the replica directly; a real replica gets its data via replication
+
+        self.assertEqual(LtiUserData.objects.filter(user=self.user).count(), 1)
+        self.assertEqual(LtiUserData.objects.get(user=self.user).edx_lti_parameters['lis_result_sourcedid'], 'replica')
@@ -1,11 +1,19 @@
+import threading
+
 import ddt
 from django.contrib.auth.models import User
+from django.db import transaction
 
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
+from django.test.utils import override_settings
 from mock import patch, Mock, PropertyMock
 
+from django_lti_tool_provider.executor import BackgroundExecutor
 from django_lti_tool_provider.models import LtiUserData
-from django_lti_tool_provider.signals import grade_updated_handler, _send_grade
+from django_lti_tool_provider.signals import (
+    Signals, grade_updated_handler, send_lti_received, submit_grade, _send_grade
+)
+from django_lti_tool_provider.tests.utils import share_test_database_connection
 
 
 @ddt.ddt
@@ -19,7 +27,7 @@ class SignalHandlersTests(TestCase):
     @ddt.unpack
     def test_handle_grade_updated(self, user, grade, send_grade_mock):
         grade_updated_handler(Mock(), user=user, grade=grade)
-        send_grade_mock.assert_called_once_with(user, grade, None)
+        send_grade_mock.assert_called_once_with(user, grade, None, None)
 
     @ddt.data(
         (Mock(spec=User), None, 0.5),
@@ -29,11 +37,16 @@ class SignalHandlersTests(TestCase):
     @ddt.unpack
     def test_handle_grade_with_custom_key_updated(self, user, custom_key, grade, send_grade_mock):
         grade_updated_handler(Mock(), user=user, grade=grade, custom_key=custom_key)
-        send_grade_mock.assert_called_once_with(user, grade, custom_key)
+        send_grade_mock.assert_called_once_with(user, grade, custom_key, None)
+
+    def test_handle_grade_with_sequence_updated(self, send_grade_mock):
+        user = Mock(spec=User)
+        grade_updated_handler(Mock(), user=user, grade=0.5, custom_key='key', sequence=7)
+        send_grade_mock.assert_called_once_with(user, 0.5, 'key', 7)
 
 
 @ddt.ddt
-@patch('django_lti_tool_provider.signals.LtiUserData.objects.get')
+@patch('django_lti_tool_provider.signals.LtiUserData.objects.get_for_grade')
 class SendGradeTests(TestCase):
     def test_send_grade_given_none_instance_raises_assertion_error(self, _):
         with self.assertRaises(ValueError):
@@ -53,14 +66,20 @@ class SendGradeTests(TestCase):
     def test_send_grade_requests_correct_lti_user_data(self, user, custom_key, get_user_data):
         get_user_data.assert_not_called()
         _send_grade(user, 0, custom_key)
-        get_user_data.assert_called_with(user=user, custom_key=custom_key)
+        get_user_data.assert_called_with(user.pk, custom_key)
 
     @ddt.data(0.1, 0.0, 0.87, 0.15, 1.0, 0.33)
     def test_send_grade_sends_grade_request(self, grade, get_user_data):
         user_data = Mock()
         get_user_data.return_value = user_data
         _send_grade(Mock(), grade, None)
-        user_data.send_lti_grade.assert_called_with(grade)
+        user_data.send_lti_grade.assert_called_with(grade, sequence=user_data.next_grade_sequence.return_value)
+
+    def test_send_grade_uses_sender_sequence(self, get_user_data):
+        user_data = get_user_data.return_value
+        _send_grade(Mock(), 0.5, None, 42)
+        user_data.next_grade_sequence.assert_not_called()
+        user_data.send_lti_grade.assert_called_with(0.5, sequence=42)
 
     @ddt.data(
         AssertionError, ValueError, AttributeError, ZeroDivisionError,
@@ -83,3 +102,196 @@ class SendGradeTests(TestCase):
             patched_log_info.assert_called_once()
             call_args = patched_log_info.call_args[0]
             self.assertIn("No LTI parameters", call_args[0])
+
+
+class SendLtiReceivedTests(TransactionTestCase):
+    def setUp(self):
+        self.calls = []
+        self.user, self.lti_data = Mock(spec=User), Mock(spec=LtiUserData)
+
+    def _connect(self, receiver_func):
+        Signals.LTI.received.connect(receiver_func, weak=False)
+        self.addCleanup(Signals.LTI.received.disconnect, receiver_func)
+
+    def _recording_receiver(self, sender, user, lti_data, **kwargs):  # pylint: disable=unused-argument
+        self.calls.append((user, lti_data))
+
+    def test_dispatches_synchronously_by_default(self):
+        self._connect(self._recording_receiver)
+        with transaction.atomic():
+            send_lti_received(Mock(), user=self.user, lti_data=self.lti_data)
+            self.assertEqual(self.calls, [(self.user, self.lti_data)])
+
+    @override_settings(LTI_RECEIVED_SIGNAL_ON_COMMIT=True)
+    def test_on_commit_dispatches_after_commit_in_order(self):
+        self._connect(self._recording_receiver)
+        other_lti_data = Mock(spec=LtiUserData)
+        with transaction.atomic():
+            send_lti_received(Mock(), user=self.user, lti_data=self.lti_data)
+            send_lti_received(Mock(), user=self.user, lti_data=other_lti_data)
+            self.assertEqual(self.calls, [])
+
+        self.assertEqual(self.calls, [(self.user, self.lti_data), (self.user, other_lti_data)])
+
+    @override_settings(LTI_RECEIVED_SIGNAL_ON_COMMIT=True)
+    def test_on_commit_skips_dispatch_on_rollback(self):
+        self._connect(self._recording_receiver)
+        with self.assertRaises(ValueError), transaction.atomic():
+            send_lti_received(Mock(), user=self.user, lti_data=self.lti_data)
+            raise ValueError()
+
+        self.assertEqual(self.calls, [])
+
+    @override_settings(LTI_RECEIVED_SIGNAL_ON_COMMIT=True)
+    def test_on_commit_isolates_failing_receiver(self):
+        failing_receiver = Mock(side_effect=RuntimeError("receiver failed"))
+        self._connect(failing_receiver)
+        self._connect(self._recording_receiver)
+
+        with patch("django_lti_tool_provider.signals._logger.error") as patched_log_error, transaction.atomic():
+            send_lti_received(Mock(), user=self.user, lti_data=self.lti_data)
+
+        failing_receiver.assert_called_once()
+        self.assertEqual(self.calls, [(self.user, self.lti_data)])
+        patched_log_error.assert_called_once()
+
+    @override_settings(LTI_RECEIVED_SIGNAL_IN_BACKGROUND=True)
+    def test_background_dispatch_does_not_wait_for_receivers(self):
+        executor = BackgroundExecutor(workers=1)
+        self.addCleanup(executor.shutdown)
+        release, finished = threading.Event(), threading.Event()
+
+        def slow_receiver(sender, **kwargs):  # pylint: disable=unused-argument
+            release.wait(5)
+            self.calls.append(threading.current_thread())
+            finished.set()
+
+        self._connect(slow_receiver)
+        with patch('django_lti_tool_provider.signals.get_executor', return_value=executor):
+            send_lti_received(Mock(), user=self.user, lti_data=self.lti_data)
+
+        self.assertEqual(self.calls, [])
+        release.set()
+        self.assertTrue(finished.wait(5))
+        self.assertNotEqual(self.calls, [threading.current_thread()])
+
+    @override_settings(LTI_RECEIVED_SIGNAL_ON_COMMIT=True, LTI_RECEIVED_SIGNAL_IN_BACKGROUND=True)
+    def test_on_commit_and_background_submits_after_commit(self):
+        executor = Mock(spec=BackgroundExecutor)
+        with patch('django_lti_tool_provider.signals.get_executor', return_value=executor):
+            with transaction.atomic():
+                send_lti_received(Mock(), user=self.user, lti_data=self.lti_data)
+                executor.submit.assert_not_called()
+
+        executor.submit.assert_called_once()
+
+
+@patch('django_lti_tool_provider.backends.tool_provider')
+class SubmitGradeTests(TransactionTestCase):
+    fixtures = ['test_lti_db.yaml']
+
+    def setUp(self):
+        self.user = User.objects.get(username='test1')
+        LtiUserData.objects.create(user=self.user, custom_key='key', edx_lti_parameters={
+            'lis_result_sourcedid': 'sourcedid', 'lis_outcome_service_url': 'http://lms/outcome'
+        })
+        self.executor = BackgroundExecutor(workers=1, initializer=share_test_database_connection())
+        self.addCleanup(self.executor.shutdown)
+        patcher = patch('django_lti_tool_provider.signals.get_executor', return_value=self.executor)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.delivered, self.failed = [], []
+        self._connect(Signals.Grade.delivered, self.delivered)
+        self._connect(Signals.Grade.failed, self.failed)
+
+    def _connect(self, signal, calls):
+        def _receiver(sender, **kwargs):  # pylint: disable=unused-argument
+            calls.append(kwargs)
+        signal.connect(_receiver, weak=False)
+        self.addCleanup(signal.disconnect, _receiver)
+
+    @staticmethod
+    def _lms(tool_provider_constructor_mock):
+        return tool_provider_constructor_mock.return_value.post_replace_result
+
+    def test_submit_returns_before_lms_responds(self, tool_provider_constructor_mock):
+        lms_responds = threading.Event()
+        outcome = Mock()
+        outcome.is_success.return_value = True
+        self._lms(tool_provider_constructor_mock).side_effect = lambda grade: lms_responds.wait(5) and outcome
+
+        handle = submit_grade(self.user, 0.7, 'key')
+
+        self.assertFalse(handle.done())
+        self.assertEqual(self.delivered, [])
+        lms_responds.set()
+        self.assertIs(handle.result(timeout=5), outcome)
+        self.assertEqual(self.delivered, [
+            dict(signal=Signals.Grade.delivered, user=self.user, grade=0.7, custom_key='key', sequence=1,
+                 outcome=outcome)
+        ])
+        self.assertEqual(self.failed, [])
+
+    def test_delivery_error_is_reported_through_handle_and_signal(self, tool_provider_constructor_mock):
+        self._lms(tool_provider_constructor_mock).side_effect = IOError("connection refused")
+
+        handle = submit_grade(self.user, 0.7, 'key')
+
+        self.assertIsInstance(handle.exception(timeout=5), IOError)
+        self.assertEqual(len(self.failed), 1)
+        self.assertIsInstance(self.failed[0]['exception'], IOError)
+        self.assertEqual(self.delivered, [])
+
+    def test_rejected_grade_is_reported_as_failure(self, tool_provider_constructor_mock):
+        outcome = self._lms(tool_provider_constructor_mock).return_value
+        outcome.is_success.return_value = False
+
+        self.assertIs(submit_grade(self.user, 0.7, 'key').result(timeout=5), outcome)
+
+        self.assertEqual(len(self.failed), 1)
+        self.assertIs(self.failed[0]['outcome'], outcome)
+        self.assertIsNone(self.failed[0]['exception'])
+
+    def test_failing_completion_receiver_does_not_fail_delivery(self, tool_provider_constructor_mock):
+        outcome = self._lms(tool_provider_constructor_mock).return_value
+        outcome.is_success.return_value = True
+        self._connect(Signals.Grade.delivered, Mock(append=Mock(side_effect=RuntimeError())))
+
+        self.assertIs(submit_grade(self.user, 0.7, 'key').result(timeout=5), outcome)
+
+    def test_missing_lti_user_data_raises_immediately(self, _):
+        with self.assertRaises(LtiUserData.DoesNotExist):
+            submit_grade(self.user, 0.7, 'other-key')
+
+    def test_only_latest_grade_is_delivered_when_submissions_outpace_delivery(self, tool_provider_constructor_mock):
+        outcome = self._lms(tool_provider_constructor_mock).return_value
+        outcome.is_success.return_value = True
+        worker_busy = threading.Event()
+        self.executor.submit(worker_busy.wait, 5)
+
+        handles = [submit_grade(self.user, grade, 'key') for grade in (0.1, 0.2, 0.3)]
+        worker_busy.set()
+
+        self.assertEqual([handle.result(timeout=5) for handle in handles], [None, None, outcome])
+        self._lms(tool_provider_constructor_mock).assert_called_once_with(0.3)
+        self.assertEqual([call['sequence'] for call in self.delivered], [3])
+
+    def test_grade_updated_signal_returns_handle_when_asked_for_background(self, tool_provider_constructor_mock):
+        outcome = self._lms(tool_provider_constructor_mock).return_value
+        outcome.is_success.return_value = True
+
+        responses = dict(Signals.Grade.updated.send(
+            Mock(), user=self.user, grade=0.5, custom_key='key', background=True
+        ))
+
+        self.assertIs(responses[grade_updated_handler].result(timeout=5), outcome)
+
+    def test_grade_updated_signal_returns_outcome(self, tool_provider_constructor_mock):
+        outcome = self._lms(tool_provider_constructor_mock).return_value
+        outcome.is_success.return_value = True
+
+        responses = dict(Signals.Grade.updated.send(Mock(), user=self.user, grade=0.5, custom_key='key'))
+
+        self.assertIs(responses[grade_updated_handler], outcome)
+        self.assertEqual(len(self.delivered), 1)
@@ -4,15 +4,16 @@ from importlib import import_module
 from django_lti_tool_provider import AbstractApplicationHookManager
 from mock import patch, Mock
 
-from oauth2 import Request, Consumer, SignatureMethod_HMAC_SHA1
-
 from django.contrib.auth.models import User
 from django.test.utils import override_settings
 from django.test import Client, TestCase, RequestFactory
 from django.conf import settings
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
 
 from django_lti_tool_provider.models import LtiUserData
 from django_lti_tool_provider.views import LTIView
+from django_lti_tool_provider.tests.utils import sign_lti_request
 
 
 @override_settings(
@@ -43,17 +44,11 @@ class LtiRequestsTestBase(TestCase):
         self.hook_manager.optional_lti_parameters = Mock(return_value={})
         LTIView.register_authentication_manager(self.hook_manager)
 
-    @property
-    def consumer(self):
-        return Consumer(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET)
-
     def _get_signed_oauth_request(self, path, method, data=None):
         data = data if data is not None else self._data
         url = self._url_base + path
         method = method if method else 'GET'
-        req = Request.from_consumer_and_token(self.consumer, {}, method, url, data)
-        req.sign_request(SignatureMethod_HMAC_SHA1(), self.consumer, None)
-        return req
+        return sign_lti_request(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, url, data, method)
 
     def get_correct_lti_payload(self, path='/lti/', method='POST', data=None):
         req = self._get_signed_oauth_request(path, method, data)
@@ -118,7 +113,7 @@ class AnonymousLtiRequestTests(LtiRequestsTestBase):
 
 
 @ddt.ddt
-@patch('django_lti_tool_provider.views.Signals.LTI.received.send')
+@patch('django_lti_tool_provider.signals.Signals.LTI.received.send')
 class AuthenticatedLtiRequestTests(LtiRequestsTestBase):
     def _authentication_hook(self, request, user_id=None, username=None, email=None, **kwargs):
         user = User.objects.create_user(username or user_id, password='1234', email=email)
@@ -198,6 +193,73 @@ class AuthenticatedLtiRequestTests(LtiRequestsTestBase):
 
         self.assertEqual(LtiUserData.objects.all().count(), 1)
 
+    def _login_as_lti_user(self, lti_user_id, custom_key=''):
+        user = User.objects.create_user('lti_user', password='1234')
+        LtiUserData.objects.create(user=user, custom_key=custom_key, edx_lti_parameters={'user_id': lti_user_id})
+        self.assertTrue(self.client.login(username='lti_user', password='1234'))
+        return user
+
+    def test_returning_user_launching_new_resource_keeps_session(self, patched_send_lti_received):
+        user = self._login_as_lti_user(self._data['user_id'], custom_key='other resource')
+        self.hook_manager.authentication_hook = Mock()
+
+        response = self.send_lti_request(self.get_correct_lti_payload())
+
+        self._verify_redirected_to(response, self.DEFAULT_REDIRECT)
+        self.hook_manager.authentication_hook.assert_not_called()
+        self.assertEqual(int(self.client.session['_auth_user_id']), user.id)
+        self._verify_lti_created(user, self._data)
+        self.assertEqual(LtiUserData.objects.filter(user=user).count(), 2)
+
+    def test_different_lti_user_is_logged_out(self, patched_send_lti_received):
+        user = self._login_as_lti_user('another lti user')
+
+        response = self.send_lti_request(self.get_correct_lti_payload())
+
+        self._verify_redirected_to(response, self.DEFAULT_REDIRECT)
+        new_user = User.objects.exclude(id=user.id).get()
+        self.assertEqual(int(self.client.session['_auth_user_id']), new_user.id)
+        self._verify_lti_created(new_user, self._data)
+        self.assertEqual(LtiUserData.objects.get(user=user).edx_lti_parameters, {'user_id': 'another lti user'})
+
+    def test_stored_launch_without_user_id_keeps_session(self, patched_send_lti_received):
+        user = User.objects.create_user('lti_user', password='1234')
+        LtiUserData.objects.create(user=user, edx_lti_parameters={'lis_result_sourcedid': 'sourcedid'})
+        self.assertTrue(self.client.login(username='lti_user', password='1234'))
+        self.hook_manager.authentication_hook = Mock()
+
+        response = self.send_lti_request(self.get_correct_lti_payload())
+
+        self._verify_redirected_to(response, self.DEFAULT_REDIRECT)
+        self.hook_manager.authentication_hook.assert_not_called()
+        self.assertEqual(int(self.client.session['_auth_user_id']), user.id)
+
+    def test_roster_placeholder_is_not_proof_of_identity(self, patched_send_lti_received):
+        user = User.objects.create_user('lti_user', password='1234')
+        LtiUserData.objects.create(user=user, custom_key='other resource', edx_lti_parameters={
+            'user_id': self._data['user_id'], LtiUserData.PLACEHOLDER_PARAMETER: True,
+        })
+        self.assertTrue(self.client.login(username='lti_user', password='1234'))
+
+        response = self.send_lti_request(self.get_correct_lti_payload())
+
+        self._verify_redirected_to(response, self.DEFAULT_REDIRECT)
+        self.assertNotEqual(int(self.client.session['_auth_user_id']), user.id)
+
+    def test_returning_user_same_resource_looks_up_lti_data_once(self, patched_send_lti_received):
+        user = self._login_as_lti_user(self._data['user_id'])
+        payload = self.get_correct_lti_payload()
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.send_lti_request(payload)
+
+        self._verify_redirected_to(response, self.DEFAULT_REDIRECT)
+        lti_user_data_queries = [query['sql'] for query in queries if 'ltiuserdata' in query['sql']]
+        # one lookup and one update
+        self.assertEqual(len(lti_user_data_queries), 2, lti_user_data_queries)
+        self._verify_lti_created(user, self._data)
+
+
 @ddt.ddt
 class AuthenticationManagerIntegrationTests(LtiRequestsTestBase):
     TEST_URLS = "/some_url", "/some_other_url", "http://qwe.asd.zxc.com"
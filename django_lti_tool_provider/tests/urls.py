@@ -1,10 +1,12 @@
 from django.conf.urls import url
 from django.contrib.auth.views import LoginView
 
-from django_lti_tool_provider import views as lti_views
+from django_lti_tool_provider import lti13, views as lti_views
 
 
 urlpatterns = [
+    url(r'^lti13/login/$', lti13.Lti13LoginView.as_view(), name='lti13_login'),
+    url(r'^lti13/launch/$', lti13.Lti13LaunchView.as_view(), name='lti13_launch'),
     url(r'', lti_views.LTIView.as_view(), name='home'),
     url('^accounts/login/$', LoginView.as_view()),
     url(r'^lti$', lti_views.LTIView.as_view(), name='lti')
@@ -0,0 +1,296 @@
+"""
+Helpers shared by the test suite and the load harness (see run_load_test.py):
+signing LTI launches the way an LMS does, a stub LMS outcome service to post grades to and a stub LTI 1.3 platform.
+"""
+import hashlib
+import json
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+from urlparse import parse_qs, urlparse
+
+from django.db import DEFAULT_DB_ALIAS, connections
+from oauth2 import Request, Consumer, SignatureMethod_HMAC_SHA1
+
+
+OUTCOME_RESPONSE_TEMPLATE = u"""<?xml version="1.0" encoding="UTF-8"?>
+<imsx_POXEnvelopeResponse xmlns="http://www.imsglobal.org/services/ltiv1p1/xsd/imsoms_v1p0">
+  <imsx_POXHeader>
+    <imsx_POXResponseHeaderInfo>
+      <imsx_version>V1.0</imsx_version>
+      <imsx_messageIdentifier>{message_id}</imsx_messageIdentifier>
+      <imsx_statusInfo>
+        <imsx_codeMajor>{code_major}</imsx_codeMajor>
+        <imsx_severity>status</imsx_severity>
+        <imsx_description>{description}</imsx_description>
+        <imsx_messageRefIdentifier>{message_id}</imsx_messageRefIdentifier>
+        <imsx_operationRefIdentifier>replaceResult</imsx_operationRefIdentifier>
+      </imsx_statusInfo>
+    </imsx_POXResponseHeaderInfo>
+  </imsx_POXHeader>
+  <imsx_POXBody><replaceResultResponse/></imsx_POXBody>
+</imsx_POXEnvelopeResponse>
+"""
+
+
+def share_test_database_connection():
+    """
+    Returns a BackgroundExecutor initializer letting worker threads use this thread's default database connection -
+    the in-memory SQLite test database is only visible through it (like in LiveServerTestCase)
+    """
+    connection = connections[DEFAULT_DB_ALIAS]
+    connection.allow_thread_sharing = True
+
+    def _initializer():
+        connections[DEFAULT_DB_ALIAS] = connection
+    return _initializer
+
+
+def sign_lti_request(consumer_key, consumer_secret, url, data, method='POST'):
+    """ Builds an OAuth1 HMAC-SHA1 signed LTI launch request, as an LMS would """
+    consumer = Consumer(consumer_key, consumer_secret)
+    req = Request.from_consumer_and_token(consumer, {}, method, url, data)
+    req.sign_request(SignatureMethod_HMAC_SHA1(), consumer, None)
+    return req
+
+
+def get_signed_lti_payload(consumer_key, consumer_secret, url, data, method='POST'):
+    """ Returns urlencoded body of a signed LTI launch """
+    return sign_lti_request(consumer_key, consumer_secret, url, data, method).to_postdata()
+
+
+class _StubLmsRequestHandler(BaseHTTPRequestHandler):
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        server = self.server
+        with server.lock:
+            server.received.append((self.path, body))
+            message_id = len(server.received)
+
+        if server.delay:
+            time.sleep(server.delay)
+
+        content = OUTCOME_RESPONSE_TEMPLATE.format(
+            message_id=message_id,
+            code_major='failure' if server.fail else 'success',
+            description='Stub LMS {}'.format('rejected the score' if server.fail else 'stored the score'),
+        ).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/xml')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubLmsServer(object):
+    """
+    Local stand-in for an LMS outcome service: accepts any replaceResult POX request and answers with success
+    (or failure if `fail` is set), optionally after `delay` seconds. Received requests are kept in `received`.
+    """
+    def __init__(self, delay=0, fail=False, handler_class=_StubLmsRequestHandler):
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), handler_class)
+        self._server.lock = threading.Lock()
+        self._server.received = []
+        self._server.delay = delay
+        self._server.fail = fail
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self._server.server_address
+        return 'http://{host}:{port}/outcome'.format(host=host, port=port)
+
+    @property
+    def received(self):
+        return self._server.received
+
+    def start(self):
+        self._thread = threading.Thread(target=self._server.serve_forever)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
+
+
+class _StubPlatformRequestHandler(BaseHTTPRequestHandler):
+    # keep-alive, as real platforms do
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        self._record(None)
+        if self.server.fail:
+            self._respond(500, {'error': 'stub platform failure'})
+        elif self.path == '/jwks':
+            self._respond(200, self.server.jwks)
+        elif self.path.startswith('/memberships'):
+            self._memberships()
+        else:
+            self._respond(404, {'error': 'not found'})
+
+    def _memberships(self):
+        server = self.server
+        if not self._authorized():
+            return self._respond(401, {'error': 'invalid token'})
+
+        page = int(parse_qs(urlparse(self.path).query).get('page', ['0'])[0])
+        start = page * server.page_size
+        members = server.members[start:start + server.page_size]
+        # an ETag per page, of that page's members only
+        etag = '"{}"'.format(hashlib.md5(json.dumps(members, sort_keys=True).encode('utf-8')).hexdigest())
+        headers = {'ETag': etag}
+        if start + server.page_size < len(server.members):
+            headers['Link'] = '<{}>; rel="next"'.format(
+                'http://{}:{}/memberships?page={}'.format(server.server_address[0], server.server_address[1], page + 1)
+            )
+        if self.headers.getheader('if-none-match') == etag:
+            return self._respond(304, None, headers)
+        self._respond(200, {'id': self.path, 'context': {'id': 'course-1'}, 'members': members}, headers)
+
+    def _authorized(self):
+        authorization = self.headers.getheader('authorization', '')
+        return authorization[len('Bearer '):] in self.server.tokens[len(self.server.tokens) - self.server.valid_tokens:]
+
+    def do_POST(self):  # pylint: disable=invalid-name
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        self._record(body)
+        server = self.server
+        if server.fail:
+            self._respond(500, {'error': 'stub platform failure'})
+        elif self.path == '/token':
+            with server.lock:
+                token = 'token-{}'.format(len(server.tokens) + 1)
+                server.tokens.append(token)
+            self._respond(200, {'access_token': token, 'token_type': 'Bearer', 'expires_in': server.token_lifetime})
+        elif self.path.split('?')[0].endswith('/scores'):
+            if not self._authorized():
+                self._respond(401, {'error': 'invalid token'})
+            else:
+                with server.lock:
+                    server.scores.append((self.path, json.loads(body)))
+                self._respond(200, {})
+        else:
+            self._respond(404, {'error': 'not found'})
+
+    def _record(self, body):
+        with self.server.lock:
+            self.server.received.append((self.command, self.path, body))
+
+    def _respond(self, status, document, headers=None):
+        content = json.dumps(document).encode('utf-8') if document is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):  # pylint: disable=arguments-differ
+        pass
+
+
+class StubPlatformServer(StubLmsServer):
+    """
+    Local stand-in for an LTI 1.3 platform:
+    * publishes `jwks` (a JWKS document) at /jwks
+    * issues access tokens valid for `token_lifetime` seconds at /token; `tokens` lists them, only the last
+      `valid_tokens` of them are accepted
+    * accepts AGS score posts (line item URL + /scores), keeping them in `scores` as (path, score document)
+    * serves `members` as an NRPS roster at /memberships, `page_size` members per page, each page with its ETag
+
+    With `fail` set everything is answered with an error. Received requests are kept in `received` as
+    (method, path, body), `connections` counts accepted connections.
+    """
+    def __init__(self, jwks=None, fail=False, token_lifetime=3600, members=None, page_size=10,
+                 handler_class=_StubPlatformRequestHandler):
+        super(StubPlatformServer, self).__init__(fail=fail, handler_class=handler_class)
+        self._server.jwks = jwks if jwks is not None else {'keys': []}
+        self._server.token_lifetime = token_lifetime
+        self._server.tokens = []
+        self._server.valid_tokens = 1
+        self._server.scores = []
+        self._server.connections = 0
+        self._server.members = members if members is not None else []
+        self._server.page_size = page_size
+
+    @property
+    def tokens(self):
+        return self._server.tokens
+
+    @property
+    def scores(self):
+        return self._server.scores
+
+    @property
+    def connections(self):
+        return self._server.connections
+
+    @property
+    def members(self):
+        return self._server.members
+
+    @members.setter
+    def members(self, value):
+        self._server.members = value
+
+    @property
+    def jwks(self):
+        return self._server.jwks
+
+    @jwks.setter
+    def jwks(self, value):
+        self._server.jwks = value
+
+    @property
+    def fail(self):
+        return self._server.fail
+
+    @fail.setter
+    def fail(self, value):
+        self._server.fail = value
+
+    @property
+    def valid_tokens(self):
+        return self._server.valid_tokens
+
+    @valid_tokens.setter
+    def valid_tokens(self, value):
+        self._server.valid_tokens = value
+
+    def url_for(self, path):
+        host, port = self._server.server_address
+        return 'http://{host}:{port}{path}'.format(host=host, port=port, path=path)
+
+    @property
+    def jwks_url(self):
+        return self.url_for('/jwks')
+
+    @property
+    def token_url(self):
+        return self.url_for('/token')
+
+    @property
+    def memberships_url(self):
+        return self.url_for('/memberships')
@@ -0,0 +1,150 @@
+"""
+Streaming export/import of LtiUserData as newline-delimited JSON, one record per line:
+
+    {"custom_key": "...", "edx_lti_parameters": {...}, "username": "..."}
+
+Users are referenced by username, so records can be moved between deployments with different user ids. Both
+directions work in constant memory: export walks the table in primary key order chunk by chunk, import buffers at
+most one batch of records.
+"""
+import json
+import logging
+
+from django.contrib.auth.models import User
+from django.db import transaction
+import six
+
+from django_lti_tool_provider.models import LtiUserData
+
+
+_logger = logging.getLogger(__name__)
+
+RECORD_FIELDS = ('user__username', 'custom_key', 'edx_lti_parameters')
+
+
+class ImportStats(object):
+    def __init__(self):
+        self.created = 0
+        self.updated = 0
+        self.skipped = 0
+        self.missing_users = 0
+
+    def __repr__(self):
+        return u"created: {}, updated: {}, skipped existing: {}, skipped with unknown user: {}".format(
+            self.created, self.updated, self.skipped, self.missing_users
+        )
+
+
+def iter_in_chunks(queryset, chunk_size=1000):
+    """
+    Yields objects of the queryset in primary key order, fetching at most chunk_size rows at a time (keyset
+    pagination - unlike a plain iterator(), it does not depend on the database driver to avoid buffering the whole
+    result set, and each chunk query is a short indexed range scan).
+    """
+    last_pk = None
+    while True:
+        chunk_queryset = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk_queryset = chunk_queryset.filter(pk__gt=last_pk)
+        chunk = list(chunk_queryset[:chunk_size])
+        if not chunk:
+            return
+        for item in chunk:
+            yield item
+        last_pk = _pk_of(chunk[-1])
+        if len(chunk) < chunk_size:
+            return
+
+
+def _pk_of(item):
+    # values_list querysets below put the pk first
+    return item[0] if isinstance(item, tuple) else item.pk
+
+
+def export_lti_user_data(stream, queryset=None, chunk_size=1000):
+    """ Writes LtiUserData records from queryset (all records by default) to stream. Returns number of records """
+    queryset = queryset if queryset is not None else LtiUserData.objects.all()
+    rows = iter_in_chunks(queryset.values_list('pk', *RECORD_FIELDS), chunk_size)
+    count = 0
+    for _, username, custom_key, edx_lti_parameters in rows:
+        stream.write(serialize_record(username, custom_key, edx_lti_parameters))
+        count += 1
+    return count
+
+
+def serialize_record(username, custom_key, edx_lti_parameters):
+    if isinstance(edx_lti_parameters, six.string_types):
+        # depending on jsonfield version, values_list returns stored JSON undecoded
+        edx_lti_parameters = json.loads(edx_lti_parameters)
+    return json.dumps(
+        {'username': username, 'custom_key': custom_key, 'edx_lti_parameters': edx_lti_parameters or {}},
+        sort_keys=True
+    ) + '\n'
+
+
+def iter_records(stream):
+    for line_number, line in enumerate(stream, start=1):
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            record = json.loads(line)
+            yield record['username'], record.get('custom_key') or '', record.get('edx_lti_parameters') or {}
+        except (ValueError, KeyError):
+            raise ValueError(u"Malformed LtiUserData record on line {}".format(line_number))
+
+
+def import_lti_user_data(stream, batch_size=1000, update_existing=False):
+    """
+    Reads LtiUserData records from stream and stores them, a batch at a time: users are resolved with one query
+    per batch, new records are inserted with a single bulk insert. Existing records (same user and custom key)
+    are overwritten only if update_existing is set. Returns ImportStats.
+    """
+    stats = ImportStats()
+    batch = []
+    for record in iter_records(stream):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            _import_batch(batch, update_existing, stats)
+            batch = []
+    if batch:
+        _import_batch(batch, update_existing, stats)
+    return stats
+
+
+def _import_batch(batch, update_existing, stats):
+    user_ids = dict(
+        User.objects.filter(username__in=set(username for username, _, _ in batch)).values_list('username', 'id')
+    )
+
+    # later records for the same user and key win, as they would with one-by-one import
+    records = {}
+    for username, custom_key, edx_lti_parameters in batch:
+        if username not in user_ids:
+            stats.missing_users += 1
+            _logger.warning(u"Skipping LtiUserData record for unknown user %s", username)
+            continue
+        records[(user_ids[username], custom_key)] = edx_lti_parameters
+
+    existing = {
+        (user_id, custom_key): pk
+        for pk, user_id, custom_key in LtiUserData.objects.filter(
+            user_id__in=set(user_id for user_id, _ in records)
+        ).values_list('pk', 'user_id', 'custom_key')
+        if (user_id, custom_key) in records
+    }
+
+    with transaction.atomic():
+        LtiUserData.objects.bulk_create([
+            LtiUserData(user_id=user_id, custom_key=custom_key, edx_lti_parameters=edx_lti_parameters)
+            for (user_id, custom_key), edx_lti_parameters in records.items()
+            if (user_id, custom_key) not in existing
+        ])
+        stats.created += len(records) - len(existing)
+
+        if update_existing:
+            for key, pk in existing.items():
+                LtiUserData.objects.filter(pk=pk).update(edx_lti_parameters=records[key])
+            stats.updated += len(existing)
+        else:
+            stats.skipped += len(existing)
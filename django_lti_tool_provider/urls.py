@@ -1,10 +1,12 @@
 from django.conf.urls import url
 
-from django_lti_tool_provider import views as lti_views
+from django_lti_tool_provider import lti13, views as lti_views
 
 
 app_name = 'django_lti_tool_provider'
 
 urlpatterns = [
+    url(r'^lti13/login/$', lti13.Lti13LoginView.as_view(), name='lti13_login'),
+    url(r'^lti13/launch/$', lti13.Lti13LaunchView.as_view(), name='lti13_launch'),
     url(r'', lti_views.LTIView.as_view(), name='lti')
 ]
@@ -1,19 +1,22 @@
-from django.contrib.auth import logout
+from django.contrib.auth import BACKEND_SESSION_KEY, get_user_model, login, logout
 from django.core.exceptions import ImproperlyConfigured
 from django.utils.decorators import method_decorator
 from django.views.decorators.clickjacking import xframe_options_exempt
 from django.views.generic import View
-import oauth2
 import logging
+import sys
+
+import six
 
 from django.conf import settings
 from django.http import HttpResponseRedirect, HttpResponseBadRequest
 from django.views.decorators.csrf import csrf_exempt
 
-from ims_lti_py.tool_provider import DjangoToolProvider
-
-from django_lti_tool_provider.models import LtiUserData, WrongUserError
-from django_lti_tool_provider.signals import Signals
+from django_lti_tool_provider.dedupe import NOT_CLAIMED, LaunchOutcome, launch_registry
+from django_lti_tool_provider.models import LtiUserData
+from django_lti_tool_provider.pipeline import LaunchContext, run_stages
+from django_lti_tool_provider.protocol import InvalidLtiRequest, validate_launch
+from django_lti_tool_provider.signals import send_lti_received
 
 
 _logger = logging.getLogger(__name__)
@@ -31,6 +34,12 @@ class LTIView(View):
 
     SESSION_KEY = 'lti_parameters'
 
+    # errors _get_lti_parameters_from_request raises for requests that fail validation
+    INVALID_REQUEST_ERRORS = (InvalidLtiRequest,)
+
+    # stages a launch goes through, see pipeline module
+    LAUNCH_STAGES = ('dedupe', 'validate', 'resolve_user', 'authenticate', 'persist', 'notify', 'redirect')
+
     @method_decorator(csrf_exempt)
     @method_decorator(xframe_options_exempt)
     def dispatch(self, *args, **kwargs):
@@ -46,44 +55,171 @@ class LTIView(View):
         return self.process_request(request)
 
     def process_request(self, request):
-        if request.user.is_authenticated:
+        return run_stages(self.__class__, LaunchContext(request), self.LAUNCH_STAGES)
+
+    @classmethod
+    def stage_dedupe(cls, context):
+        """ Reuses the outcome of the original launch for copies of a double-submitted one, see dedupe module """
+        request = context.request
+        key = cls._launch_key(request) if launch_registry.enabled else None
+        if key is None:
+            return None
+
+        # the session might be cycled by logging the user in - the key it came with is needed to recognize copies
+        session_key = request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+        outcome = launch_registry.claim(key)
+        if outcome == NOT_CLAIMED:
+            # the key belongs to a launch still in flight - it completes or releases it
+            return None
+        if outcome is not None:
+            # the key is made of request fields anyone can copy - the copy must be signed as well as the original
             try:
-                lti_parameters = self._get_lti_parameters_from_request(request)
-                if not self._right_user(request.user, lti_parameters):
-                    _logger.debug(u"Logging out user %s in favor of new LTI session.", request.user.username)
-                    logout(request)
-            except (oauth2.Error, AttributeError):
+                cls._verify_duplicate_launch(request, outcome)
+            except cls.INVALID_REQUEST_ERRORS as e:
+                return cls._invalid_request(e)
+            _logger.info(u"Duplicate LTI launch, reusing outcome of the original launch")
+            return cls._replay_launch(request, outcome)
+
+        def _record_outcome(response):
+            if response is not None and response.status_code == 302 and request.user.is_authenticated:
+                launch_registry.complete(key, LaunchOutcome(
+                    request.user.pk, request.session.get(BACKEND_SESSION_KEY), response['Location'],
+                    session_keys=(session_key, request.session.session_key)
+                ))
+            else:
+                launch_registry.release(key)
+        context.on_finish(_record_outcome)
+        return None
+
+    @classmethod
+    def stage_validate(cls, context):
+        """
+        Validates the launch. For an anonymous user, an invalid launch is a bad request; an authenticated user might
+        be coming back without LTI parameters (see process_authenticated_lti) - the error is kept for later stages.
+        """
+        try:
+            context.lti_parameters = cls._get_lti_parameters_from_request(context.request)
+        except cls.INVALID_REQUEST_ERRORS + (AttributeError,) as e:
+            if context.request.user.is_authenticated:
                 # Not a new visit, or better to keep existing auth.
-                pass
-        if not request.user.is_authenticated:
-            try:
-                lti_parameters = self._get_lti_parameters_from_request(request)
-            except oauth2.Error as e:
-                _logger.exception(u"Invalid LTI Request")
-                return HttpResponseBadRequest(u"Invalid LTI Request: " + e.message)
+                context.validation_error = sys.exc_info()
+            elif isinstance(e, cls.INVALID_REQUEST_ERRORS):
+                return cls._invalid_request(e)
+            else:
+                raise
+        return None
 
-            lti_parameters_mapping = self.PASS_TO_AUTHENTICATION_HOOK.copy()
+    @classmethod
+    def stage_resolve_user(cls, context):
+        """ Logs out an authenticated user who is not the person the launch is for """
+        request = context.request
+        if request.user.is_authenticated and context.lti_parameters is not None:
+            same_user, context.lti_user_data = cls._match_lti_user(request.user, context.lti_parameters)
+            if not same_user:
+                _logger.debug(u"Logging out user %s in favor of new LTI session.", request.user.username)
+                logout(request)
+        return None
+
+    @classmethod
+    def stage_authenticate(cls, context):
+        """ Runs the authentication hook for an anonymous user """
+        request = context.request
+        if request.user.is_authenticated:
+            return None
+
+        lti_parameters = context.lti_parameters
+        lti_parameters_mapping = cls.PASS_TO_AUTHENTICATION_HOOK.copy()
+
+        lti_data = {
+            hook_name: lti_parameters.get(lti_name, None)
+            for lti_name, hook_name in lti_parameters_mapping.iteritems()
+        }
+
+        lti_data['extra_params'] = {
+            hook_name: lti_parameters.get(lti_name, None)
+            for lti_name, hook_name in cls.authentication_manager.optional_lti_parameters().iteritems()
+        }
 
-            lti_data = {
-                hook_name: lti_parameters.get(lti_name, None)
-                for lti_name, hook_name in lti_parameters_mapping.iteritems()
-            }
+        _logger.debug(u"Executing authentication hook with parameters %s", lti_data)
 
-            lti_data['extra_params'] = {
-                hook_name: lti_parameters.get(lti_name, None)
-                for lti_name, hook_name in self.authentication_manager.optional_lti_parameters().iteritems()
-            }
+        cls.authentication_manager.authentication_hook(request, **lti_data)
+        context.lti_user_data = None
+        return None
 
-            _logger.debug(u"Executing authentication hook with parameters %s", lti_data)
+    @classmethod
+    def stage_persist(cls, context):
+        """
+        Stores LTI parameters of an authenticated user's launch in the DB. Parameters of an anonymous user's launch
+        are kept in the session instead, until authentication brings them back (see process_anonymous_lti).
+        """
+        request = context.request
+        if not request.user.is_authenticated:
+            _logger.info('Processing anonymous LTI request')
+            request.session[cls.SESSION_KEY] = context.lti_parameters
+            request.session.save()
+            return None
 
-            self.authentication_manager.authentication_hook(request, **lti_data)
+        _logger.info('Processing authenticated LTI request')
+        if cls.SESSION_KEY in request.session and not cls._is_new_lti_request(request):
+            context.lti_parameters = request.session[cls.SESSION_KEY]
+            del request.session[cls.SESSION_KEY]
+            context.lti_user_data = None
+        elif context.lti_parameters is None:
+            if not isinstance(context.validation_error[1], cls.INVALID_REQUEST_ERRORS):
+                six.reraise(*context.validation_error)
+            return cls._invalid_request(context.validation_error[1])
 
+        context.lti_user_data = LtiUserData.store_lti_parameters(
+            request.user, cls.authentication_manager, cls.lti_param_filter(context.lti_parameters),
+            context.lti_user_data
+        )
+        return None
+
+    @classmethod
+    def stage_notify(cls, context):
+        """ Sends Signals.LTI.received for an authenticated user's launch """
+        if context.request.user.is_authenticated:
+            send_lti_received(cls, user=context.request.user, lti_data=context.lti_user_data)
+        return None
+
+    @classmethod
+    def stage_redirect(cls, context):
+        request = context.request
         if request.user.is_authenticated:
-            _logger.info('Processing authenticated LTI request')
-            return self.process_authenticated_lti(request)
+            redirect_to = cls.authentication_manager.authenticated_redirect_to(request, context.lti_parameters)
         else:
-            _logger.info('Processing anonymous LTI request')
-            return self.process_anonymous_lti(request)
+            redirect_to = cls.authentication_manager.anonymous_redirect_to(request, context.lti_parameters)
+        return HttpResponseRedirect(redirect_to)
+
+    @classmethod
+    def _invalid_request(cls, error):
+        _logger.exception(u"Invalid LTI Request")
+        return HttpResponseBadRequest(u"Invalid LTI Request: " + error.message)
+
+    @classmethod
+    def _launch_key(cls, request):
+        """ Dedupe registry key of the launch (see dedupe module), or None if it can't be told apart """
+        if not request.POST.get('oauth_nonce'):
+            return None
+        return launch_registry.launch_key(*[
+            request.POST.get(name) for name in ('oauth_consumer_key', 'oauth_nonce', 'oauth_signature', 'user_id')
+        ])
+
+    @classmethod
+    def _verify_duplicate_launch(cls, request, outcome):  # pylint: disable=unused-argument
+        """
+        Verifies a copy of a launch about to reuse the original's outcome (LaunchOutcome); raises on failure. An LTI
+        1.1 launch is not bound to a session - the copy only needs a valid signature.
+        """
+        validate_launch(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, request)
+
+    @classmethod
+    def _replay_launch(cls, request, outcome):
+        if request.user.pk != outcome.user_id:
+            if request.user.is_authenticated:
+                logout(request)
+            login(request, get_user_model().objects.get(pk=outcome.user_id), backend=outcome.backend)
+        return HttpResponseRedirect(outcome.location)
 
     @classmethod
     def lti_param_filter(cls, parameters):
@@ -95,24 +231,32 @@ class LTIView(View):
 
     @classmethod
     def _right_user(cls, user, lti_parameters):
-        try:
-            info, created = LtiUserData.get_or_create_by_parameters(
-                user, cls.authentication_manager, cls.lti_param_filter(lti_parameters), create=False
-            )
-            if created:
-                # If this is the first time the user's data is being created, that means
-                # that the user predated the LTI request.
-                info.delete()
-                return False
-            return True
-        except (WrongUserError, LtiUserData.DoesNotExist):
-            return False
+        return cls._match_lti_user(user, lti_parameters)[0]
+
+    @classmethod
+    def _match_lti_user(cls, user, lti_parameters):
+        """
+        Tells whether the logged in user is the person the LTI launch is for. Returns the verdict and user's
+        LtiUserData found on the way (for the launched resource if there is one - to be updated without another
+        lookup).
+
+        A user who launched any resource with the same LTI user_id (or whose stored launch has no user_id) is the same
+        person, even if this resource is new to them - such launches keep the session. A user who never made an LTI
+        launch predates the LTI request and is logged out, as is a user whose stored LTI user_id differs. Roster
+        placeholders (see roster module) don't count as launches.
+        """
+        lti_parameters = cls.lti_param_filter(lti_parameters)
+        lti_user_data = LtiUserData.get_for_launch(user, cls.authentication_manager, lti_parameters)
+        if lti_user_data is None:
+            return False, None
+        lti_user_id = lti_parameters.get('user_id')
+        if lti_user_data.edx_lti_parameters.get('user_id', lti_user_id) != lti_user_id:
+            return False, None
+        return True, lti_user_data
 
     @classmethod
     def _get_lti_parameters_from_request(cls, request):
-        provider = DjangoToolProvider(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, request.POST)
-        provider.valid_request(request)
-        return provider.to_params()
+        return validate_launch(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, request)
 
     @classmethod
     def register_authentication_manager(cls, manager):
@@ -120,49 +264,31 @@ class LTIView(View):
         cls.authentication_manager = manager
 
     @classmethod
-    def process_anonymous_lti(cls, request):
+    def process_anonymous_lti(cls, request, lti_parameters=None):
         """
         This method handles LTI request if it was sent prior to tool authorization. In such a case, we need user
         authenticated first. Unfortunately, it looses POST data in the process, so when it gets back original LTI
         request is gone. So we save important parts of it into session to retrieve when authentication happens
         """
-        try:
-            lti_parameters = cls._get_lti_parameters_from_request(request)
-        except oauth2.Error, e:
-            _logger.exception(u"Invalid LTI Request")
-            return HttpResponseBadRequest(u"Invalid LTI Request: " + e.message)
-
-        request.session[cls.SESSION_KEY] = lti_parameters
-        request.session.save()
-        return HttpResponseRedirect(cls.authentication_manager.anonymous_redirect_to(request, lti_parameters))
+        stages = ('persist', 'redirect') if lti_parameters is not None else ('validate', 'persist', 'redirect')
+        return run_stages(cls, LaunchContext(request, lti_parameters), stages)
 
     @classmethod
-    def process_authenticated_lti(cls, request):
+    def process_authenticated_lti(cls, request, lti_parameters=None, lti_user_data=None):
         """
         There are two options:
         1. This is actual LTI request made with cookies already set - need parsing and validating LTI parameters
+           (unless process_request already did and passed them as lti_parameters)
         2. This is OpenID redirect from edx if actual LTI request was send anonymously - already validated
            LTI parameters and stored them in session - take them from session
 
         When lti parameters are ready (either taken from session or parsed and validated from request) store them
         in DB for later
         """
-        if cls.SESSION_KEY in request.session and not cls._is_new_lti_request(request):
-            lti_parameters = request.session[cls.SESSION_KEY]
-            del request.session[cls.SESSION_KEY]
-        else:
-            try:
-                lti_parameters = cls._get_lti_parameters_from_request(request)
-            except oauth2.Error, e:
-                _logger.exception(u"Invalid LTI Request")
-                return HttpResponseBadRequest(u"Invalid LTI Request: " + e.message)
-
-        lti_data = LtiUserData.store_lti_parameters(
-            request.user, cls.authentication_manager, cls.lti_param_filter(lti_parameters)
-        )
-        Signals.LTI.received.send(cls, user=request.user, lti_data=lti_data)
-
-        return HttpResponseRedirect(cls.authentication_manager.authenticated_redirect_to(request, lti_parameters))
+        stages = ('persist', 'notify', 'redirect')
+        if lti_parameters is None:
+            stages = ('validate',) + stages
+        return run_stages(cls, LaunchContext(request, lti_parameters, lti_user_data), stages)
 
     @classmethod
     def _is_new_lti_request(cls, request):
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Memory benchmark for grade workers: resident set size of a worker looking up outcome endpoints of a synthetic
+LtiUserData table, with per-call model loads (what grade delivery does by default), with a dict of full model
+instances (a naive worker-side cache) and with the compact endpoint cache (LTI_ENDPOINT_CACHE_SIZE, see
+django_lti_tool_provider.endpoints).
+
+The table (one row per learner, with launch parameters of typical size) is generated once in an on-disk SQLite
+database; each strategy then runs in a fresh interpreter, doing --lookups lookups of learners drawn at random from
+a working set of --working-set learners (the learners currently getting grades), and reports the RSS it grew by,
+peak and at the end, and its lookup rate.
+
+    python run_endpoint_cache_benchmark.py --rows 1000000 --working-set 100000 --lookups 300000
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+STRATEGIES = ('model', 'model-cache', 'endpoint-cache')
+
+SETTINGS = r"""
+import sys
+from django.conf import settings
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': %(database)r}},
+    INSTALLED_APPS=[
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django_lti_tool_provider',
+    ],
+    SECRET_KEY='endpoint_benchmark_secret_key',
+    LTI_ENDPOINT_CACHE_SIZE=%(cache_size)d,
+    LTI_ENDPOINT_CACHE_TTL=3600,
+)
+import django
+django.setup()
+"""
+
+GENERATE_SCRIPT = SETTINGS + r"""
+import json
+from django.core.management import call_command
+from django.db import connection, transaction
+
+call_command('migrate', verbosity=0)
+rows, courses = %(rows)d, %(courses)d
+
+
+def parameters(index):
+    course = index %% courses
+    return json.dumps({
+        'user_id': 'a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d7%%08d' %% index,
+        'lis_person_sourcedid': 'learner%%d' %% index,
+        'lis_person_contact_email_primary': 'learner%%d@example.com' %% index,
+        'lis_person_name_full': 'Learner Number %%d' %% index,
+        'lis_result_sourcedid': 'course-v1:Org+Course%%d+Run:lms.example.com-%%08d:a2b3c4d5e6f7' %% (course, index),
+        'lis_outcome_service_url': 'https://lms.example.com/courses/course-v1:Org+Course%%d+Run/xblock/block-v1:'
+                                   'Org+Course%%d+Run+type@lti_consumer+block@grades/handler_noauth/outcome'
+                                   %% (course, course),
+        'context_id': 'course-v1:Org+Course%%d+Run' %% course,
+        'context_title': 'Course number %%d' %% course,
+        'context_label': 'Course%%d' %% course,
+        'resource_link_id': 'lms.example.com-a2b3c4d5e6f7a8b9c0d1e2f3a4b5c6d7',
+        'roles': 'Student',
+        'launch_presentation_return_url': '',
+        'launch_presentation_locale': 'en',
+        'lti_version': 'LTI-1p0',
+        'lti_message_type': 'basic-lti-launch-request',
+        'tool_consumer_info_product_family_code': 'Open edX',
+        'tool_consumer_instance_guid': 'lms.example.com',
+    })
+
+
+with transaction.atomic():
+    cursor = connection.cursor()
+    for start in range(0, rows, 10000):
+        chunk = range(start + 1, min(rows, start + 10000) + 1)
+        cursor.executemany(
+            "INSERT INTO auth_user (id, username, password, email, first_name, last_name, is_superuser, is_staff, "
+            "is_active, date_joined) VALUES (%%s, %%s, '!', '', '', '', 0, 0, 1, '2020-01-01 00:00:00')",
+            [(index, 'learner%%d' %% index) for index in chunk]
+        )
+        cursor.executemany(
+            "INSERT INTO django_lti_tool_provider_ltiuserdata (id, user_id, custom_key, edx_lti_parameters, updated, "
+            "grade_sequence, delivered_grade_sequence) VALUES (%%s, %%s, 'block', %%s, '2020-01-01 00:00:00', 0, 0)",
+            [(index, index, parameters(index)) for index in chunk]
+        )
+"""
+
+MEASURE_SCRIPT = SETTINGS + r"""
+import gc
+import json
+import random
+import resource
+import time
+
+from django_lti_tool_provider.endpoints import endpoint_cache
+from django_lti_tool_provider.models import LtiUserData
+
+strategy, working_set, lookups = %(strategy)r, %(working_set)d, %(lookups)d
+
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        return int(statm.read().split()[1]) * resource.getpagesize() // 1024
+
+
+def delivery_fields(lti_user_data):
+    parameters = lti_user_data.edx_lti_parameters
+    return parameters['lis_result_sourcedid'], parameters['lis_outcome_service_url']
+
+
+instances = {}
+
+
+def lookup(user_id):
+    if strategy == 'model':
+        return delivery_fields(LtiUserData.objects.for_read().get(user_id=user_id, custom_key='block'))
+    if strategy == 'model-cache':
+        if user_id not in instances:
+            instances[user_id] = LtiUserData.objects.for_read().get(user_id=user_id, custom_key='block')
+        return delivery_fields(instances[user_id])
+    return delivery_fields(endpoint_cache.get(user_id, 'block').to_lti_user_data())
+
+
+random.seed(1)
+users = [random.randint(1, %(rows)d) for _ in range(working_set)]
+lookup(users[0])  # warms up imports, the database connection and query compilation
+gc.collect()
+baseline_rss, baseline_peak = rss_kb(), resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+started = time.time()
+for _ in range(lookups):
+    lookup(random.choice(users))
+elapsed = time.time() - started
+gc.collect()
+
+print(json.dumps({
+    'rss_growth_kb': rss_kb() - baseline_rss,
+    'peak_growth_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline_peak,
+    'lookups_per_second': lookups / elapsed,
+}))
+"""
+
+
+def run_child(script, parameters):
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    output = subprocess.check_output([sys.executable, '-c', script % parameters], env=env)
+    return output.decode('utf-8').strip().splitlines()[-1] if output.strip() else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000, help="LtiUserData rows in the synthetic table")
+    parser.add_argument('--courses', type=int, default=200, help="Courses the rows are spread over")
+    parser.add_argument('--working-set', type=int, default=100000, help="Distinct learners looked up")
+    parser.add_argument('--lookups', type=int, default=300000, help="Lookups per strategy")
+    parser.add_argument('--cache-size', type=int, default=None,
+                        help="Endpoint cache size (default: the working set size)")
+    options = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='lti_endpoint_benchmark_')
+    parameters = {
+        'database': os.path.join(directory, 'benchmark.sqlite3'),
+        'rows': options.rows,
+        'courses': options.courses,
+        'working_set': options.working_set,
+        'lookups': options.lookups,
+        'cache_size': options.cache_size or options.working_set,
+    }
+    try:
+        print(u"Generating {} LtiUserData rows...".format(options.rows))
+        run_child(GENERATE_SCRIPT, parameters)
+        print(u"{} lookups over a working set of {} learners, endpoint cache size {}:".format(
+            options.lookups, options.working_set, parameters['cache_size']
+        ))
+        for strategy in STRATEGIES:
+            result = json.loads(run_child(MEASURE_SCRIPT, dict(parameters, strategy=strategy)))
+            print(u"  {:<15} RSS +{:>8.1f} MB (peak +{:>8.1f} MB), {:>8.0f} lookups/s".format(
+                strategy, result['rss_growth_kb'] / 1024.0, result['peak_growth_kb'] / 1024.0,
+                result['lookups_per_second']
+            ))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Import-time benchmark for the Django LTI Tool Provider: how long django.setup() takes with the app installed, and
+which heavy protocol dependencies it drags in.
+
+Each sample runs in a fresh interpreter (so nothing is cached in sys.modules), configures minimal settings,
+calls django.setup() and imports the app's models - what every management command, worker and test pays. It then
+instantiates a tool provider, timing the part of the protocol stack import deferred to the first launch or grade.
+Run it on two checkouts to compare them.
+
+    python run_import_benchmark.py --runs 20
+"""
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+
+HEAVY_MODULES = ('ims_lti_py', 'oauth2', 'httplib2', 'lxml', 'jwt', 'cryptography')
+
+CHILD_SCRIPT = r"""
+import json
+import sys
+import time
+
+started = time.time()
+from django.conf import settings
+settings.configure(
+    DATABASES={'default': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'}},
+    INSTALLED_APPS=[
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django_lti_tool_provider',
+    ],
+    SECRET_KEY='import_benchmark_secret_key',
+)
+import django
+django.setup()
+import django_lti_tool_provider.models
+setup_seconds = time.time() - started
+
+heavy_modules = %(heavy_modules)r
+loaded_at_setup = sorted(name for name in heavy_modules if name in sys.modules)
+
+started = time.time()
+from django_lti_tool_provider import protocol
+protocol.tool_provider('key', 'secret', {})
+protocol_seconds = time.time() - started
+
+print(json.dumps({
+    'setup_seconds': setup_seconds,
+    'protocol_seconds': protocol_seconds,
+    'loaded_at_setup': loaded_at_setup,
+}))
+"""
+
+
+def run_sample():
+    script = CHILD_SCRIPT % {'heavy_modules': HEAVY_MODULES}
+    env = dict(os.environ)
+    package_root = os.path.dirname(os.path.abspath(__file__))
+    env['PYTHONPATH'] = os.pathsep.join(filter(None, [package_root, env.get('PYTHONPATH')]))
+    output = subprocess.check_output([sys.executable, '-c', script], env=env)
+    return json.loads(output.decode('utf-8').strip().splitlines()[-1])
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(fraction * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=10, help="Number of fresh interpreters to sample")
+    options = parser.parse_args()
+
+    samples = [run_sample() for _ in range(options.runs)]
+    setup_ms = [sample['setup_seconds'] * 1000 for sample in samples]
+    protocol_ms = [sample['protocol_seconds'] * 1000 for sample in samples]
+
+    print(u"django.setup() + models import, {} runs:".format(options.runs))
+    print(u"  median {:.1f} ms, p90 {:.1f} ms, min {:.1f} ms".format(
+        percentile(setup_ms, 0.5), percentile(setup_ms, 0.9), min(setup_ms)
+    ))
+    print(u"protocol stack import, deferred to the first launch or grade:")
+    print(u"  median {:.1f} ms".format(percentile(protocol_ms, 0.5)))
+    print(u"heavy modules loaded by setup: {}".format(", ".join(samples[0]['loaded_at_setup']) or "none"))
+
+
+if __name__ == '__main__':
+    main()
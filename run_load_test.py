@@ -0,0 +1,319 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+Load harness for the Django LTI Tool Provider: simulates a whole class following the same LTI link at once.
+
+Signed launches (same resource link, one per user, some of them double-clicked) are replayed concurrently from
+several worker processes against LTIView, backed by an on-disk SQLite database and a local stub LMS outcome service.
+Reports latency percentiles, IntegrityError/race counts and database lock waits. With --outcome-backend, grades go
+through another outcome backend (see django_lti_tool_provider.backends) - e.g. `memory` to load-test grading with
+no network at all.
+
+    python run_load_test.py --users 300 --processes 8 --double-click 0.2 --grades
+    python run_load_test.py --users 300 --grades --outcome-backend memory
+    python run_load_test.py --users 300 --double-click 0.5 --dedupe
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+_DB_DIR = tempfile.mkdtemp(prefix='lti_load_test_')
+
+from django.conf import settings  # pylint: disable=wrong-import-position
+
+settings.configure(
+    DEBUG=False,
+    DATABASES={
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': os.path.join(_DB_DIR, 'lti_load_test.sqlite3'),
+            'OPTIONS': {'timeout': 5},
+        }
+    },
+    # shared by the worker processes, for launch dedupe (--dedupe)
+    CACHES={
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': os.path.join(_DB_DIR, 'cache'),
+        }
+    },
+    ALLOWED_HOSTS=['testserver'],
+    INSTALLED_APPS=[
+        'django.contrib.auth',
+        'django.contrib.contenttypes',
+        'django.contrib.sessions',
+        'django_lti_tool_provider'
+    ],
+    MIDDLEWARE=[
+        'django.middleware.common.CommonMiddleware',
+        'django.contrib.sessions.middleware.SessionMiddleware',
+        'django.contrib.auth.middleware.AuthenticationMiddleware',
+    ],
+    PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'],
+    ROOT_URLCONF='django_lti_tool_provider.tests.urls',
+    USE_TZ=True,
+    LTI_CLIENT_KEY='lti_client_key',
+    LTI_CLIENT_SECRET='lti_client_secret',
+    SECRET_KEY='load_test_secret_key_not_need_to_look_like_actual_secret_key',
+)
+
+import django  # pylint: disable=wrong-import-position
+django.setup()
+
+# pylint: disable=wrong-import-position
+from django.contrib.auth import login
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import IntegrityError, OperationalError, connections
+from django.db.backends import utils as backend_utils
+from django.test import Client
+
+from django_lti_tool_provider import AbstractApplicationHookManager
+from django_lti_tool_provider.models import LtiUserData, PendingGrade
+from django_lti_tool_provider.signals import Signals
+from django_lti_tool_provider.tests.utils import StubLmsServer, get_signed_lti_payload
+from django_lti_tool_provider.views import LTIView
+
+
+LAUNCH_URL = 'http://testserver/lti/'
+RESOURCE_LINK_ID = 'load-test-resource-link'
+WRITE_STATEMENTS = ('INSERT', 'UPDATE', 'DELETE')
+OUTCOME_BACKENDS = {
+    'http': 'django_lti_tool_provider.backends.HttpBackend',
+    'outbox': 'django_lti_tool_provider.backends.OutboxBackend',
+    'memory': 'django_lti_tool_provider.backends.InMemoryBackend',
+    'null': 'django_lti_tool_provider.backends.NullBackend',
+}
+
+
+class LoadTestHookManager(AbstractApplicationHookManager):
+    """ Creates (or reuses) a user per LTI user and logs them in, like a typical SSO-less tool would """
+    def authentication_hook(self, request, user_id=None, username=None, email=None, extra_params=None):
+        user, _ = User.objects.get_or_create(username=username, defaults={'email': email})
+        user.backend = 'django.contrib.auth.backends.ModelBackend'
+        login(request, user)
+
+    def authenticated_redirect_to(self, request, lti_data):
+        return '/launched'
+
+    def vary_by_key(self, lti_data):
+        return lti_data.get('resource_link_id')
+
+
+class _WriteTimer(object):
+    """ Records how long write statements take - under SQLite this is dominated by waiting on the database lock """
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.reset()
+
+    def reset(self):
+        self.waits = []
+        self.lock_errors = 0
+
+    def install(self):
+        timer = self
+
+        def _timed(original):
+            def wrapper(cursor, sql, *args, **kwargs):
+                if not sql.lstrip().upper().startswith(WRITE_STATEMENTS):
+                    return original(cursor, sql, *args, **kwargs)
+                start = time.time()
+                try:
+                    return original(cursor, sql, *args, **kwargs)
+                except OperationalError as exc:
+                    if 'locked' in str(exc):
+                        timer.lock_errors += 1
+                    raise
+                finally:
+                    elapsed = time.time() - start
+                    if elapsed >= timer.threshold:
+                        timer.waits.append(elapsed)
+            return wrapper
+
+        backend_utils.CursorWrapper.execute = _timed(backend_utils.CursorWrapper.execute)
+        backend_utils.CursorWrapper.executemany = _timed(backend_utils.CursorWrapper.executemany)
+
+
+_write_timer = _WriteTimer(threshold=0.005)
+
+
+def _init_worker():
+    # connections must not be shared with the parent process
+    connections.close_all()
+    random.seed(os.getpid())
+
+
+def _classify(exc):
+    if isinstance(exc, IntegrityError):
+        return 'IntegrityError'
+    if isinstance(exc, OperationalError) and 'locked' in str(exc):
+        return 'database locked'
+    return exc.__class__.__name__
+
+
+def _launch(task):
+    """ Runs a single launch (and optionally a grade update) in a worker process, returns measurements """
+    index, payload, send_grade = task
+    _write_timer.reset()
+    result = {'index': index, 'error': None, 'status': None, 'grade_error': None, 'grade_latency': None}
+
+    start = time.time()
+    try:
+        response = Client().post('/lti/', payload, content_type='application/x-www-form-urlencoded')
+        result['status'] = response.status_code
+    except Exception as exc:  # pylint: disable=broad-except
+        result['error'] = _classify(exc)
+    result['latency'] = time.time() - start
+
+    if send_grade and result['status'] == 302:
+        start = time.time()
+        try:
+            user = User.objects.get(username=_username(index))
+            Signals.Grade.updated.send(
+                LoadTestHookManager, user=user, grade=random.random(), custom_key=RESOURCE_LINK_ID
+            )
+        except Exception as exc:  # pylint: disable=broad-except
+            result['grade_error'] = _classify(exc)
+        result['grade_latency'] = time.time() - start
+
+    result['lock_waits'] = list(_write_timer.waits)
+    result['lock_errors'] = _write_timer.lock_errors
+    return result
+
+
+def _username(index):
+    return 'learner{}'.format(index)
+
+
+def _build_tasks(options, outcome_service_url):
+    tasks = []
+    for index in range(options.users):
+        data = {
+            'lti_version': 'LTI-1p0',
+            'lti_message_type': 'basic-lti-launch-request',
+            'resource_link_id': RESOURCE_LINK_ID,
+            'context_id': 'LoadX/LOAD-101/now',
+            'user_id': 'lti-user-{}'.format(index),
+            'roles': 'Student',
+            'lis_person_sourcedid': _username(index),
+            'lis_person_contact_email_primary': '{}@example.com'.format(_username(index)),
+            'lis_result_sourcedid': 'sourcedid-{}'.format(index),
+            'lis_outcome_service_url': outcome_service_url,
+        }
+        payload = get_signed_lti_payload(settings.LTI_CLIENT_KEY, settings.LTI_CLIENT_SECRET, LAUNCH_URL, data)
+        clicks = 2 if random.random() < options.double_click else 1
+        # double clicks re-submit the very same signed form, and arrive next to each other
+        tasks.extend((index, payload, options.grades and click == 0) for click in range(clicks))
+    return tasks
+
+
+def percentile(values, pct):
+    """ Nearest-rank percentile of a list of numbers """
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(int(round(pct / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
+
+def _format_latencies(label, values):
+    return u"{label:<16} n={count:<6} p50={p50:8.1f}ms p90={p90:8.1f}ms p99={p99:8.1f}ms max={max:8.1f}ms".format(
+        label=label, count=len(values),
+        p50=percentile(values, 50) * 1000, p90=percentile(values, 90) * 1000,
+        p99=percentile(values, 99) * 1000, max=(max(values) if values else 0) * 1000,
+    )
+
+
+def _count(values):
+    counts = {}
+    for value in values:
+        counts[value] = counts.get(value, 0) + 1
+    return counts
+
+
+def report(options, tasks, results, wall_time, lms):
+    launches = [result['latency'] for result in results]
+    grades = [result['grade_latency'] for result in results if result['grade_latency'] is not None]
+    lock_waits = [wait for result in results for wait in result['lock_waits']]
+    errors = _count(result['error'] for result in results if result['error'])
+    grade_errors = _count(result['grade_error'] for result in results if result['grade_error'])
+    statuses = _count(result['status'] for result in results if result['status'])
+    distinct_users = len(set(task[0] for task in tasks))
+
+    print(u"Launches: {} ({} users, {} double clicks) from {} processes in {:.2f}s - {:.1f} launches/s".format(
+        len(tasks), distinct_users, len(tasks) - distinct_users, options.processes, wall_time, len(tasks) / wall_time
+    ))
+    print(_format_latencies(u"launch latency", launches))
+    if options.grades:
+        print(_format_latencies(u"grade latency", grades))
+        print(u"Grades received by stub LMS: {}, grade errors: {} ({} outcome backend)".format(
+            len(lms.received), grade_errors or 'none', options.outcome_backend
+        ))
+        if options.outcome_backend == 'outbox':
+            print(u"Grades queued in the outbox: {}".format(PendingGrade.objects.count()))
+    print(u"Response statuses: {}".format(statuses))
+    print(u"Launch errors: {}".format(errors or 'none'))
+    print(u"IntegrityErrors (lost races): {}".format(
+        errors.get('IntegrityError', 0) + grade_errors.get('IntegrityError', 0)
+    ))
+    print(_format_latencies(u"DB lock waits", lock_waits))
+    print(u"DB lock timeouts: {}".format(sum(result['lock_errors'] for result in results)))
+
+    connections.close_all()
+    users = User.objects.filter(username__startswith='learner').count()
+    lti_rows = LtiUserData.objects.filter(custom_key=RESOURCE_LINK_ID).count()
+    print(u"Users created: {}/{}, LtiUserData rows: {}/{} ({} launches left no LtiUserData behind)".format(
+        users, distinct_users, lti_rows, distinct_users, distinct_users - lti_rows
+    ))
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=200, help="Number of distinct learners launching")
+    parser.add_argument('--processes', type=int, default=multiprocessing.cpu_count(), help="Worker processes")
+    parser.add_argument('--double-click', type=float, default=0.1,
+                        help="Fraction of learners submitting the launch form twice")
+    parser.add_argument('--grades', action='store_true', help="Send a grade to the stub LMS after each launch")
+    parser.add_argument('--lms-delay', type=float, default=0.0, help="Stub LMS response delay, in seconds")
+    parser.add_argument('--outcome-backend', choices=sorted(OUTCOME_BACKENDS), default='http',
+                        help="Outcome backend grades go through")
+    parser.add_argument('--dedupe', action='store_true',
+                        help="Enable launch dedupe (LTI_LAUNCH_DEDUPE), so double clicks reuse the original launch")
+    parser.add_argument('--seed', type=int, default=None, help="Random seed, for repeatable runs")
+    options = parser.parse_args(argv)
+
+    random.seed(options.seed)
+    # before the worker processes are forked, so that they inherit it
+    settings.LTI_OUTCOME_BACKEND = OUTCOME_BACKENDS[options.outcome_backend]
+    settings.LTI_LAUNCH_DEDUPE = options.dedupe
+    call_command('migrate', verbosity=0)
+    LTIView.register_authentication_manager(LoadTestHookManager())
+    _write_timer.install()
+
+    try:
+        with StubLmsServer(delay=options.lms_delay) as lms:
+            tasks = _build_tasks(options, lms.url)
+            connections.close_all()
+            pool = multiprocessing.Pool(options.processes, initializer=_init_worker)
+            start = time.time()
+            try:
+                results = list(pool.imap_unordered(_launch, tasks, chunksize=1))
+            finally:
+                pool.close()
+                pool.join()
+            wall_time = time.time() - start
+            report(options, tasks, results, wall_time, lms)
+    finally:
+        connections.close_all()
+        shutil.rmtree(_DB_DIR, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
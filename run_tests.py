@@ -13,7 +13,11 @@ settings.configure(
     DATABASES={
         'default': {
             'ENGINE': 'django.db.backends.sqlite3',
-        }
+        },
+        # stands in for a read replica in django_lti_tool_provider.tests.test_routers
+        'replica': {
+            'ENGINE': 'django.db.backends.sqlite3',
+        },
     },
     SITE_ID=1,
     INSTALLED_APPS=[
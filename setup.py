@@ -21,7 +21,7 @@
 # Imports ###########################################################
 
 import os
-from setuptools import setup
+from setuptools import find_packages, setup
 
 with open(os.path.join(os.path.dirname(__file__), 'README.md')) as readme:
     README = readme.read()
@@ -46,7 +46,7 @@ setup(
     license="GNU AFFERO GENERAL PUBLIC LICENSE",
     description='IMS LTI Tool Provider Django Applocation',
     long_description=README,
-    packages=['django_lti_tool_provider'],
+    packages=find_packages(exclude=['django_lti_tool_provider.tests']),
     install_requires=[
         'Django>=1.8',
         'oauth2>=1.5.211',
@@ -54,6 +54,9 @@ setup(
         'six',
         'ims_lti_py'  # PyPi version is broken, install via requirements.txt
     ],
+    extras_require={
+        'lti13': ['PyJWT[crypto]>=1.7'],
+    },
     package_data=package_data("django_lti_tool_provider", []),
     classifiers=[
         'Environment :: Web Environment',